@@ -0,0 +1,210 @@
+import gzip
+import io
+import logging
+import lzma
+import socket
+import zlib
+
+# zstd is optional: it's in the standard library from Python 3.14, otherwise it needs the
+# zstandard package.
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The errors a dropped or stalled connection shows up as.  Before Python 3.10 a socket
+# timeout isn't a TimeoutError.
+connection_errors = (ConnectionError, TimeoutError, socket.timeout)
+
+
+class DecodeError(Exception):
+    """
+    Raised when a compressed body can't be decompressed.
+    """
+
+
+class LengthReader(io.RawIOBase):
+    """
+    Reads a request body whose size is given by Content-Length, stopping at the end of the
+    body rather than waiting on the connection.
+    """
+
+    def __init__(self, rfile, length: int):
+        self.rfile = rfile
+        self.remaining = length
+        self.received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.remaining <= 0:
+            return 0
+
+        view = memoryview(b)[: self.remaining]
+        n = self.rfile.readinto(view) or 0
+        self.remaining -= n
+        self.received += n
+        return n
+
+    def is_complete(self) -> bool:
+        return self.remaining == 0
+
+
+class ChunkedReader(io.RawIOBase):
+    """
+    Reads a request body sent with "Transfer-Encoding: chunked", for clients that don't know
+    the size of what they are sending up front.  Each chunk is read straight into the
+    caller's buffer.
+    """
+
+    # Chunk size lines and trailers are tiny; anything longer isn't HTTP.
+    max_line_length = 4096
+
+    def __init__(self, rfile):
+        self.rfile = rfile
+        self.chunk_remaining = 0
+        self.started = False
+        self.finished = False
+        self.complete = False
+        self.received = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.finished:
+            return 0
+
+        if self.chunk_remaining == 0 and not self.next_chunk():
+            return 0
+
+        view = memoryview(b)[: self.chunk_remaining]
+        n = self.rfile.readinto(view) or 0
+        self.chunk_remaining -= n
+        self.received += n
+        return n
+
+    def next_chunk(self) -> bool:
+        # Every chunk but the first is followed by a CRLF.
+        if self.started and self.read_line() is None:
+            return False
+
+        self.started = True
+
+        line = self.read_line()
+        if line is None:
+            return False
+
+        try:
+            # Ignore any chunk extensions after the size.
+            size = int(line.split(b";")[0], 16)
+        except ValueError:
+            # Treat garbage like a dropped connection; the body is incomplete.
+            logging.error(f"Invalid chunk size line {line[:32]!r}")
+            self.finished = True
+            return False
+
+        if size == 0:
+            # Skip any trailers up to the blank line that ends the body.
+            while True:
+                line = self.read_line()
+                if not line:
+                    break
+
+            self.finished = True
+            self.complete = line is not None
+            return False
+
+        self.chunk_remaining = size
+        return True
+
+    def read_line(self):
+        line = self.rfile.readline(self.max_line_length + 1)
+        if not line.endswith(b"\n"):
+            # Either the connection dropped or the line is far too long.
+            return None
+
+        return line.strip()
+
+    def is_complete(self) -> bool:
+        return self.complete
+
+
+def open_body(rfile, headers):
+    """
+    Returns a reader for the request body, or None if the request doesn't say how long its
+    body is.
+    """
+
+    if headers["transfer-encoding"] is not None:
+        if headers["transfer-encoding"].strip().lower() != "chunked":
+            return None
+
+        return ChunkedReader(rfile)
+
+    try:
+        return LengthReader(rfile, int(headers["content-length"]))
+    except (TypeError, ValueError):
+        return None
+
+
+class Decoder(io.RawIOBase):
+    """
+    Decompresses a body as it is read, raising DecodeError if it isn't what it claims to be.
+    The decompressors each raise their own errors, and gzip's are plain OSErrors before
+    Python 3.8, so they would otherwise look just like a failure to write the upload.
+    """
+
+    errors = tuple(
+        error
+        for error in [
+            OSError,
+            lzma.LZMAError,
+            zlib.error,
+            zstd.ZstdError if zstd is not None else None,
+            zstandard.ZstdError if zstandard is not None else None,
+        ]
+        if error is not None
+    )
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        try:
+            return self.reader.readinto(b)
+        except connection_errors:
+            raise
+        except self.errors as e:
+            raise DecodeError(str(e)) from e
+
+
+def open_decoder(body: io.RawIOBase, content_encoding):
+    """
+    Returns a reader that decompresses the body as it is read, using only a small fixed
+    buffer whatever the compression ratio.  Raises ValueError for an unsupported encoding.
+    """
+
+    encoding = (content_encoding or "identity").strip().lower()
+
+    if encoding == "identity":
+        return body
+    if encoding in ("gzip", "x-gzip"):
+        return Decoder(gzip.GzipFile(fileobj=body, mode="rb"))
+    if encoding == "xz":
+        return Decoder(lzma.LZMAFile(body, mode="rb"))
+    if encoding == "zstd" and zstd is not None:
+        return Decoder(zstd.ZstdFile(body, mode="rb"))
+    if encoding == "zstd" and zstandard is not None:
+        return Decoder(zstandard.ZstdDecompressor().stream_reader(body, closefd=False))
+
+    raise ValueError(f"Unsupported content encoding '{encoding}'")
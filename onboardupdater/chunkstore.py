@@ -0,0 +1,261 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import os
+import tempfile
+from threading import Lock
+from typing import List, Optional
+
+from .staging import StagingWriter, remove_file
+
+
+def is_sha256(value) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class ChunkManifest:
+    """
+    The list of chunks, by SHA-256, that make up a bundle, in order.  How the bundle was cut
+    into chunks (fixed size or content defined) is up to the client; the device only needs
+    the hashes.
+    """
+
+    def __init__(self, chunks: List[str], sha256: Optional[str] = None):
+        self.chunks = chunks
+        # SHA-256 of the whole bundle, if the client gave one.
+        self.sha256 = sha256
+
+    @staticmethod
+    def from_json(json: dict) -> "ChunkManifest":
+        """
+        Raises ValueError if the manifest is malformed.
+        """
+
+        if not isinstance(json, dict):
+            raise ValueError("Manifest is not an object")
+
+        chunks = json.get("chunks")
+        if not isinstance(chunks, list) or not chunks:
+            raise ValueError("Manifest has no chunks")
+
+        chunks = [chunk.lower() if isinstance(chunk, str) else chunk for chunk in chunks]
+        if not all(is_sha256(chunk) for chunk in chunks):
+            raise ValueError("Manifest has an invalid chunk hash")
+
+        sha256 = json.get("sha256")
+        if sha256 is not None:
+            sha256 = sha256.lower() if isinstance(sha256, str) else sha256
+            if not is_sha256(sha256):
+                raise ValueError("Manifest has an invalid bundle hash")
+
+        return ChunkManifest(chunks, sha256)
+
+
+class ChunkStore:
+    """
+    A content-addressed store of bundle chunks, kept in a directory next to
+    update_write_path with one file per chunk named by its SHA-256.  Consecutive bundles
+    share most of their chunks so a client only needs to send the chunks that have changed.
+
+    The store is kept under a disk budget by evicting the least recently used chunks.  Use
+    is tracked in memory and mirrored in each chunk file's mtime so that the order survives
+    a restart.  Chunks in the current manifest are never evicted.
+    """
+
+    def __init__(self, update_write_path: str, budget_bytes: int):
+        self.path = f"{update_write_path}.chunks"
+        self.budget_bytes = budget_bytes
+        # Chunk hash to size, least recently used first.
+        self.chunks = OrderedDict()
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def load(self) -> None:
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            entries = list(os.scandir(self.path))
+        except OSError:
+            logging.error(f"Unable to open chunk store '{self.path}'")
+            return
+
+        chunks = []
+        for entry in entries:
+            if is_sha256(entry.name):
+                stat = entry.stat()
+                chunks.append((stat.st_mtime, entry.name, stat.st_size))
+            else:
+                # Left over from a chunk upload that was cut short.
+                remove_file(entry.path)
+
+        with self.lock:
+            for _, sha256, size in sorted(chunks):
+                self.chunks[sha256] = size
+                self.total_bytes += size
+
+        logging.info(f"Chunk store has {len(chunks)} chunks, {self.total_bytes} bytes")
+
+    def get_chunk_path(self, sha256: str) -> str:
+        return os.path.join(self.path, sha256)
+
+    def get_missing(self, manifest: ChunkManifest) -> List[str]:
+        """
+        Returns the chunks in the manifest that aren't in the store, each once, in order.
+        """
+
+        missing = []
+        seen = set()
+
+        with self.lock:
+            for sha256 in manifest.chunks:
+                if sha256 not in self.chunks and sha256 not in seen:
+                    missing.append(sha256)
+                    seen.add(sha256)
+
+        return missing
+
+    def put(self, sha256: str, reader, chunk_size: int, throttle=None) -> Optional[int]:
+        """
+        Stores a chunk read from reader.  Returns its size, or None if what was read doesn't
+        match sha256.  It is up to the caller to check whether the reader got everything it
+        expected.  Raises OSError if the chunk can't be written.
+        """
+
+        fd, temp_path = tempfile.mkstemp(prefix=f"{sha256}.", suffix=".part", dir=self.path)
+        digest = hashlib.sha256()
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        size = 0
+
+        try:
+            with open(fd, "wb") as f:
+                while True:
+                    n = reader.readinto(view)
+                    if not n:
+                        break
+
+                    f.write(view[:n])
+                    digest.update(view[:n])
+                    size += n
+
+                    if throttle is not None:
+                        throttle.wait(n)
+
+            if digest.hexdigest() != sha256:
+                remove_file(temp_path)
+                return None
+
+            os.replace(temp_path, self.get_chunk_path(sha256))
+        except OSError:
+            remove_file(temp_path)
+            raise
+
+        with self.lock:
+            self.total_bytes += size - self.chunks.pop(sha256, 0)
+            self.chunks[sha256] = size
+
+        return size
+
+    def get_size(self, manifest: ChunkManifest) -> int:
+        """
+        Returns the size of the bundle the manifest describes, counting only the chunks that
+        are in the store.
+        """
+
+        with self.lock:
+            return sum(self.chunks.get(sha256, 0) for sha256 in manifest.chunks)
+
+    def assemble(
+        self, manifest: ChunkManifest, path: str, chunk_size: int, digest=None, throttle=None, sync_bytes: int = 0
+    ) -> int:
+        """
+        Writes the chunks in the manifest, in order, into the existing file at path and
+        returns the number of bytes written.  If a hashlib digest is given, it is updated
+        with the bundle as it is written.  The bundle is synced and dropped from the page
+        cache every sync_bytes, if given.  Raises KeyError if a chunk is missing or has been
+        corrupted on disk, in which case it is dropped from the store, and OSError if the
+        bundle can't be written.
+        """
+
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        written = 0
+
+        with open(path, "r+b") as f:
+            writer = StagingWriter(f, sync_bytes)
+
+            for sha256 in manifest.chunks:
+                chunk_digest = hashlib.sha256()
+
+                try:
+                    with open(self.get_chunk_path(sha256), "rb") as chunk:
+                        while True:
+                            n = chunk.readinto(view)
+                            if not n:
+                                break
+
+                            writer.write(view[:n])
+                            chunk_digest.update(view[:n])
+                            written += n
+
+                            if digest is not None:
+                                digest.update(view[:n])
+
+                            if throttle is not None:
+                                throttle.wait(n)
+                except FileNotFoundError:
+                    self.discard(sha256)
+                    raise KeyError(sha256)
+
+                if chunk_digest.hexdigest() != sha256:
+                    logging.error(f"Chunk {sha256} is corrupt")
+                    self.discard(sha256)
+                    raise KeyError(sha256)
+
+                self.touch(sha256)
+
+            writer.sync()
+
+        return written
+
+    def touch(self, sha256: str) -> None:
+        with self.lock:
+            if sha256 not in self.chunks:
+                return
+
+            self.chunks.move_to_end(sha256)
+
+        try:
+            os.utime(self.get_chunk_path(sha256))
+        except OSError:
+            logging.error(f"Unable to touch chunk {sha256}")
+
+    def discard(self, sha256: str) -> None:
+        with self.lock:
+            self.total_bytes -= self.chunks.pop(sha256, 0)
+
+        remove_file(self.get_chunk_path(sha256))
+
+    def evict(self, manifest: Optional[ChunkManifest] = None) -> None:
+        """
+        Removes the least recently used chunks until the store is within its budget, keeping
+        any chunks in manifest.
+        """
+
+        keep = set(manifest.chunks) if manifest is not None else set()
+        evicted = []
+
+        with self.lock:
+            for sha256, size in list(self.chunks.items()):
+                if self.total_bytes <= self.budget_bytes:
+                    break
+
+                if sha256 not in keep:
+                    del self.chunks[sha256]
+                    self.total_bytes -= size
+                    evicted.append(sha256)
+
+        for sha256 in evicted:
+            remove_file(self.get_chunk_path(sha256))
+
+        if evicted:
+            logging.info(f"Evicted {len(evicted)} chunks; chunk store now has {self.total_bytes} bytes")
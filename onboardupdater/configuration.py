@@ -5,8 +5,23 @@ class Configuration:
     def __init__(self):
         # Leave hostname empty so that we bind to any network interface.
         self.hostname = ""
+        # Status changes are journaled here so they survive a restart or power loss; None
+        # disables the journal.  Writes are synced at most every flush interval and the
+        # journal is compacted once it grows beyond max_bytes.
+        self.journal_path = "/tmp/onboardupdater.journal"
+        self.journal_flush_interval_s = 0.5
+        self.journal_max_bytes = 64 * 1024
         self.log_level = logging.INFO
+        # Log records are written as JSON lines by a thread of their own.  The log is rotated
+        # once it reaches max_bytes.  Records beyond the queue size are dropped rather than
+        # holding anything up, and each distinct message is let through at most burst times
+        # per rate limit period.
         self.log_path = "/tmp/onboardupdater.log"
+        self.log_max_bytes = 1024 * 1024
+        self.log_backup_count = 3
+        self.log_queue_size = 1000
+        self.log_rate_limit_period_s = 10
+        self.log_rate_limit_burst = 5
         # Commands are tokenized so they can easily be used by the subprocess module.
         self.override_cmds = ["rauc", "status", "mark-active", "booted"]
         self.reboot_after_update = True
@@ -16,6 +31,123 @@ class Configuration:
         self.reboot_sleep_time_s = 2
         self.revert_cmds = ["rauc", "status", "mark-active", "other"]
         self.server_port = 8080
+        # Handle each connection on its own thread, up to this many at a time.  Further
+        # connections wait to be accepted.
+        self.server_threaded = True
+        self.server_max_connections = 8
+        # Connections are kept open between requests.  An idle connection holds one of the
+        # connection slots above, so it is closed after this long without a request; the
+        # same timeout applies to a client that stalls part way through sending a request.
+        # A connection is also closed after this many requests.
+        self.server_idle_timeout_s = 10
+        self.server_max_requests_per_connection = 100
+        # "transitions" runs the state machine with the transitions package.  "table" uses a
+        # small built-in engine instead, which starts up faster since it doesn't import
+        # transitions at all.
+        self.state_engine = "transitions"
+        # How often states that ask for a periodic "tick" trigger get one.  Other states
+        # only wake the state runner when a trigger is posted.  The scheduled state uses the
+        # tick to re-check whether it may install.
+        self.tick_period_s = 30
+        # Status long-polls and event streams each hold a connection open, so keep this
+        # below server_max_connections to leave room for everything else.
+        self.status_max_subscribers = 4
+        # A long-poll returns the unchanged status after this long.
+        self.status_wait_timeout_s = 30
+        # How many changes to the status fields in history_fields are kept for /history.  The
+        # upload progress fields are left out by default as they would soon crowd out the
+        # rest.  Zero keeps no history.  With history_log_on_failure, the history is written
+        # to the log whenever an update fails.
+        self.history_capacity = 512
+        self.history_fields = ["state", "rauc_state", "last_error", "boot_state", "bundle_sha256"]
+        self.history_log_on_failure = False
+        # An idle event stream sends a comment this often so dead clients are noticed.
+        self.status_stream_keepalive_s = 15
+        # Chunks of previous bundles are kept next to update_write_path so that a delta
+        # upload only has to send the chunks that changed.  The least recently used chunks
+        # are evicted once the store grows beyond the budget.
+        self.chunk_store_budget_bytes = 512 * 1024 * 1024
+        self.chunk_max_bytes = 16 * 1024 * 1024
+        # A manifest takes about 70 bytes per chunk, so this allows for tens of thousands.
+        self.chunk_manifest_max_bytes = 4 * 1024 * 1024
+        # A fetched bundle is downloaded in segments of this size over this many connections
+        # at once.  A dropped connection is retried, from where its segment got to, up to
+        # fetch_retries times in a row without receiving anything before the fetch fails.
+        self.fetch_connections = 4
+        self.fetch_segment_bytes = 8 * 1024 * 1024
+        self.fetch_retries = 5
+        self.fetch_retry_backoff_s = 1
+        self.fetch_timeout_s = 30
         self.update_cmds = ["rauc", "install"]
+        # How the install is followed.  "stdout" runs update_cmds and parses their output.
+        # "dbus" asks the RAUC service to install over D-Bus and follows its progress
+        # signals instead; it needs the jeepney package and ignores update_cmds.  The bus is
+        # "SYSTEM", "SESSION" or a D-Bus address.
+        self.progress_source = "stdout"
+        self.rauc_dbus_bus = "SYSTEM"
+        # "immediate" installs an update as soon as it has been uploaded.  "staged" stops once
+        # the bundle is verified on disk and waits for POST /install.  "pipelined" starts
+        # installing as soon as the upload starts, with RAUC streaming the bundle from a
+        # loopback server as it arrives.  An upload can ask to be staged or pipelined either
+        # way with ?stage or ?pipeline.
+        self.install_mode = "immediate"
+        # In a pipelined install, a read of the bundle waits this long for bytes that haven't
+        # arrived yet before the installer is cut off.
+        self.pipeline_stall_timeout_s = 60
+        # A scheduled install only starts inside this window of local time, given as
+        # ("HH:MM", "HH:MM"); the window may wrap past midnight.  None means any time.
+        self.install_window = None
+        # A scheduled install only starts when this command exits with 0, e.g. a check that
+        # the vehicle is parked.  None means the device always counts as idle.  The check runs
+        # in the background; one that is still going at the first tick after
+        # install_idle_timeout_s is stopped and counts as not idle.
+        self.install_idle_cmds = None
+        self.install_idle_timeout_s = 10
+        # Uploads are copied to disk through a buffer of this size so memory use stays flat
+        # regardless of the size of the bundle.
+        self.upload_chunk_size = 64 * 1024
+        # The staged bundle is synced and dropped from the page cache every sync_bytes as it
+        # is written, since it is only read once more by RAUC and would otherwise push out
+        # pages the rest of the system needs.  Zero leaves caching to the kernel.  An upload
+        # of known size is refused up front unless it leaves min_free_bytes free.
+        self.staging_sync_bytes = 8 * 1024 * 1024
+        self.staging_min_free_bytes = 64 * 1024 * 1024
+        # Upload progress in the status is refreshed at most this often.
+        self.upload_progress_interval_s = 0.5
+        # Limit how fast the staged bundle is written so the recorder keeps enough eMMC
+        # bandwidth.  Zero means no limit.
+        self.upload_rate_limit_bps = 0
+        self.upload_rate_limit_burst = 1024 * 1024
+        # Pause writing the staged bundle while the "some avg10" I/O pressure in
+        # /proc/pressure/io is above this percentage.  None disables the check.  An upload is
+        # paused for at most io_pressure_max_stall_s in all, after which it carries on
+        # regardless, so that sustained pressure can't hold the upload lock forever.
+        self.io_pressure_threshold = None
+        self.io_pressure_check_period_s = 1
+        self.io_pressure_backoff_s = 2
+        self.io_pressure_max_stall_s = 60
+        # CPU and I/O priority for the RAUC commands, applied with nice and ionice.  None
+        # leaves the priority alone.  Note that "rauc install" only asks the RAUC service to
+        # do the install, so for the install itself the cgroup below, pointed at the RAUC
+        # service's cgroup, is what actually throttles the work.
+        self.rauc_nice = None
+        self.rauc_ionice_class = None
+        self.rauc_ionice_level = None
+        # A cgroup v2 directory that RAUC commands are moved into, and the io.max (e.g.
+        # "179:0 wbps=10485760") and cpu.weight values written to it before each command.
+        # None leaves cgroups alone.
+        self.rauc_cgroup_path = None
+        self.rauc_cgroup_io_max = None
+        self.rauc_cgroup_cpu_weight = None
         self.update_write_path = "/tmp/update.raucb"
         self.version_path = "/etc/version.json"
+        # The version file is watched with inotify, or polled this often where inotify isn't
+        # available.
+        self.version_poll_period_s = 5
+        # The command that reports the slots as JSON for /slots.  It is only run at start and
+        # after an install, override or revert, and is given up on after slots_timeout_s.
+        self.slots_cmds = ["rauc", "status", "--detailed", "--output-format=json"]
+        self.slots_timeout_s = 10
+        # When a RAUC command is cancelled it gets SIGTERM, then SIGKILL if it is still running
+        # after this long.
+        self.worker_kill_timeout_s = 2
@@ -0,0 +1,146 @@
+import logging
+from typing import Callable, Dict, List, Tuple
+
+
+class MachineError(Exception):
+    """
+    Raised when a trigger isn't valid from the current state, whichever engine is in use.
+    """
+
+
+def get_callbacks(model, names) -> List[Callable]:
+    if names is None:
+        return []
+
+    if isinstance(names, str):
+        names = [names]
+
+    return [getattr(model, name) for name in names]
+
+
+class TableEngine:
+    """
+    A small state machine engine built from the same declarative states and transitions
+    lists as the transitions package takes.  Everything is looked up when the engine is
+    built, so a trigger is a single dictionary lookup and starting up doesn't pay for
+    importing and building a transitions Machine.
+
+    Only the parts of transitions the model uses are supported: on_enter and on_exit
+    callbacks on states, and transitions with a source (a name, a list or "*"), a dest
+    (None for an internal transition, which doesn't leave the state) and before and after
+    callbacks, which run before the source state is left and after the dest state is
+    entered.  Callbacks get the trigger's data, as with transitions.  The engine binds state and
+    trigger() onto the model just as transitions does.
+    """
+
+    supported_state_keys = {"name", "on_enter", "on_exit"}
+    supported_transition_keys = {"trigger", "source", "dest", "before", "after"}
+
+    def __init__(self, model, states: List[dict], transitions: List[dict], initial: str):
+        self.model = model
+        self.on_enter: Dict[str, List[Callable]] = {}
+        self.on_exit: Dict[str, List[Callable]] = {}
+        # (source, trigger) to (dest, before callbacks, after callbacks).
+        self.table: Dict[Tuple[str, str], Tuple[str, List[Callable], List[Callable]]] = {}
+        # State to the triggers valid from it, in the order they were declared.
+        self.triggers: Dict[str, List[str]] = {}
+
+        for state in states:
+            unsupported = set(state) - self.supported_state_keys
+            if unsupported:
+                raise ValueError(f"Unsupported state options {sorted(unsupported)}")
+
+            self.on_enter[state["name"]] = get_callbacks(model, state.get("on_enter"))
+            self.on_exit[state["name"]] = get_callbacks(model, state.get("on_exit"))
+            self.triggers[state["name"]] = []
+
+        for transition in transitions:
+            unsupported = set(transition) - self.supported_transition_keys
+            if unsupported:
+                raise ValueError(f"Unsupported transition options {sorted(unsupported)}")
+
+            sources = transition["source"]
+            if sources == "*":
+                sources = list(self.triggers)
+            elif isinstance(sources, str):
+                sources = [sources]
+
+            for source in sources:
+                key = (source, transition["trigger"])
+                # As with transitions, the first transition declared for a source wins.
+                if key not in self.table:
+                    self.table[key] = (
+                        transition["dest"],
+                        get_callbacks(model, transition.get("before")),
+                        get_callbacks(model, transition.get("after")),
+                    )
+                    self.triggers[source].append(transition["trigger"])
+
+        if initial not in self.triggers:
+            raise ValueError(f"Unknown initial state '{initial}'")
+
+        model.state = initial
+        model.trigger = self.trigger
+
+    def trigger(self, name: str, data: any = None) -> bool:
+        source = self.model.state
+
+        try:
+            dest, before, after = self.table[(source, name)]
+        except KeyError:
+            raise MachineError(f"Can't trigger event {name} from state {source}!")
+
+        for callback in before:
+            callback(data)
+
+        if dest is not None:
+            for callback in self.on_exit[source]:
+                callback(data)
+
+            self.model.state = dest
+            logging.info(f"Transitioned from {source} to {dest} on {name}")
+
+            for callback in self.on_enter[dest]:
+                callback(data)
+
+        for callback in after:
+            callback(data)
+
+        return True
+
+    def get_triggers(self, state: str) -> List[str]:
+        return self.triggers.get(state, [])
+
+
+class TransitionsEngine:
+    """
+    Runs the state machine with the transitions package.  Its MachineError is re-raised as
+    ours so callers don't need to know which engine is in use.
+    """
+
+    def __init__(self, model, states: List[dict], transitions: List[dict], initial: str):
+        # Imported here so that the table engine never pays for it.
+        from transitions import Machine, MachineError as TransitionsMachineError
+
+        self.error = TransitionsMachineError
+        # transitions adds its own options to the state dicts so give it copies.
+        self.machine = Machine(
+            model=model,
+            states=[dict(state) for state in states],
+            transitions=[dict(transition) for transition in transitions],
+            initial=initial,
+        )
+        self.fire = model.trigger
+        model.trigger = self.trigger
+
+    def trigger(self, name: str, data: any = None) -> bool:
+        try:
+            return self.fire(name, data)
+        except self.error as e:
+            raise MachineError(e.value)
+
+    def get_triggers(self, state: str) -> List[str]:
+        return self.machine.get_triggers(state)
+
+
+engines = {"table": TableEngine, "transitions": TransitionsEngine}
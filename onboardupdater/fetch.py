@@ -0,0 +1,335 @@
+import http.client
+import logging
+import os
+import socket
+from threading import Lock, Thread
+import time
+from typing import Callable, List, Optional
+from urllib.parse import urlsplit
+
+from .chunkstore import is_sha256
+from .configuration import Configuration
+from .throttle import WriteThrottle
+from .staging import create_staging_file, flush_and_drop, has_free_space, remove_file
+from .upload import UpdateFile, hash_file
+
+
+class FetchRequest:
+    """
+    A bundle for the updater to download itself rather than have pushed to it.
+    """
+
+    def __init__(self, url: str, sha256: str, size: int, stage_only: bool = False):
+        self.url = url
+        self.sha256 = sha256
+        self.size = size
+        self.stage_only = stage_only
+
+    @staticmethod
+    def from_json(json: dict, stage_only: bool = False) -> "FetchRequest":
+        """
+        Raises ValueError if the request is malformed.
+        """
+
+        if not isinstance(json, dict):
+            raise ValueError("Fetch request is not an object")
+
+        url = json.get("url")
+        if not isinstance(url, str) or urlsplit(url).scheme not in ("http", "https") or not urlsplit(url).hostname:
+            raise ValueError(f"Invalid URL {url!r}")
+
+        sha256 = json.get("sha256")
+        sha256 = sha256.lower() if isinstance(sha256, str) else sha256
+        if not is_sha256(sha256):
+            raise ValueError(f"Invalid SHA-256 {sha256!r}")
+
+        size = json.get("size")
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            raise ValueError(f"Invalid size {size!r}")
+
+        return FetchRequest(url, sha256, size, stage_only)
+
+
+class FetchError(Exception):
+    pass
+
+
+class Segment:
+    """
+    A byte range of the bundle.  offset is how far the segment has got, so a segment cut off
+    by a dropped connection is resumed from there rather than from its start.
+    """
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.offset = start
+
+    def is_complete(self) -> bool:
+        return self.offset > self.end
+
+
+class Downloader:
+    """
+    Downloads a bundle into a staging file with several Range requests in flight at once.
+    The bundle is split into segments which a few threads take in turn, each thread keeping
+    one keep-alive connection to the server and writing what it receives straight to its
+    place in the file.  A dropped connection is retried from where the segment got to.
+
+    Like a Worker, the download runs on a thread of its own and on_exit is called with the
+    downloaded UpdateFile, or None and an error, when it is done.  A cancelled download
+    removes its staging file and never calls on_exit.  A download cancelled just after it
+    called on_exit removes the file it handed over too, since the state machine has moved
+    on without it.
+    """
+
+    def __init__(
+        self,
+        config: Configuration,
+        request: FetchRequest,
+        on_progress: Callable[[int, int, int], None],
+        on_exit: Callable[[Optional[UpdateFile], str], None],
+    ):
+        self.config = config
+        self.request = request
+        self.on_progress = on_progress
+        self.on_exit = on_exit
+        self.url = urlsplit(request.url)
+        self.path = ""
+        self.segments = self.get_segments()
+        self.next_segment = 0
+        self.received = 0
+        self.start_time = 0.0
+        self.last_progress = 0.0
+        self.error = ""
+        self.cancelled = False
+        self.delivered = False
+        self.connections = []
+        self.throttle = WriteThrottle(config)
+        self.throttle_lock = Lock()
+        self.lock = Lock()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def get_segments(self) -> List[Segment]:
+        size = self.request.size
+        segment_bytes = self.config.fetch_segment_bytes
+        return [Segment(start, min(start + segment_bytes, size) - 1) for start in range(0, size, segment_bytes)]
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def cancel(self) -> None:
+        with self.lock:
+            self.cancelled = True
+            connections = list(self.connections)
+
+            if self.delivered:
+                remove_file(self.path)
+
+        # Shutting the sockets down wakes any thread blocked on a read.
+        for connection in connections:
+            if connection.sock is not None:
+                try:
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def run(self) -> None:
+        if not has_free_space(self.config.update_write_path, self.request.size, self.config.staging_min_free_bytes):
+            self.finish(None, "not enough free space for the update")
+            return
+
+        try:
+            # Preallocated rather than truncated to size so the segments, which arrive out of
+            # order, don't leave the bundle fragmented.
+            self.path = create_staging_file(self.config.update_write_path, self.request.size)
+        except OSError:
+            logging.error(f"Unable to create a staging file next to '{self.config.update_write_path}'")
+            self.finish(None, "unable to open file for writing")
+            return
+
+        self.start_time = time.monotonic()
+        self.on_progress(0, 0, 0)
+
+        count = min(self.config.fetch_connections, len(self.segments))
+        threads = [Thread(target=self.fetch_segments, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.report_progress(force=True)
+
+        if self.cancelled or self.error:
+            remove_file(self.path)
+            self.finish(None, self.error)
+            return
+
+        try:
+            sha256 = hash_file(self.path, self.config.upload_chunk_size, self.config.staging_sync_bytes > 0)
+        except OSError:
+            logging.error(f"Unable to read back '{self.path}'")
+            remove_file(self.path)
+            self.finish(None, "unable to read downloaded update")
+            return
+
+        self.finish(UpdateFile(self.path, self.request.size, sha256, self.request.sha256, self.request.stage_only), "")
+
+    def finish(self, update: Optional[UpdateFile], error: str) -> None:
+        # on_exit is called under the lock, as for a Worker, so a cancel either comes before
+        # it and stops it or comes after it and sees what was delivered.
+        with self.lock:
+            if self.cancelled:
+                if update is not None:
+                    remove_file(update.path)
+                return
+
+            self.delivered = update is not None
+            self.on_exit(update, error)
+
+    def fetch_segments(self) -> None:
+        connection = self.connect()
+        fd = None
+
+        try:
+            try:
+                fd = os.open(self.path, os.O_WRONLY)
+            except OSError:
+                raise FetchError("unable to write downloaded update")
+
+            while True:
+                with self.lock:
+                    if self.cancelled or self.error or self.next_segment == len(self.segments):
+                        return
+
+                    segment = self.segments[self.next_segment]
+                    self.next_segment += 1
+
+                connection = self.fetch_segment(connection, fd, segment)
+        except FetchError as e:
+            with self.lock:
+                if not self.cancelled and not self.error:
+                    logging.error(f"Download of {self.request.url} failed; {e}")
+                    self.error = str(e)
+        finally:
+            if fd is not None:
+                os.close(fd)
+            self.disconnect(connection)
+
+    def fetch_segment(self, connection: http.client.HTTPConnection, fd: int, segment: Segment):
+        """
+        Fetches the rest of the segment, retrying on a new connection if one drops.  Only
+        attempts that get nothing count towards the retry limit, so a long segment over a
+        flaky link isn't given up on while it is still making progress.  Returns the
+        connection to use for the next segment.  Raises FetchError if the server won't give
+        us the segment or it can't be written.
+        """
+
+        attempts = 0
+
+        while not segment.is_complete():
+            offset = segment.offset
+
+            try:
+                self.receive_range(connection, fd, segment)
+            except (http.client.HTTPException, OSError) as e:
+                if self.cancelled:
+                    return connection
+
+                attempts = 1 if segment.offset > offset else attempts + 1
+                if attempts > self.config.fetch_retries:
+                    raise FetchError(f"gave up after {attempts} attempts: {e!r}")
+
+                logging.info(f"Retrying bytes {segment.offset}-{segment.end} of {self.request.url}: {e!r}")
+                time.sleep(self.config.fetch_retry_backoff_s)
+                if self.cancelled:
+                    return connection
+
+                self.disconnect(connection)
+                connection = self.connect()
+
+        return connection
+
+    def receive_range(self, connection: http.client.HTTPConnection, fd: int, segment: Segment) -> None:
+        target = self.url.path or "/"
+        if self.url.query:
+            target += f"?{self.url.query}"
+
+        connection.request("GET", target, headers={"Range": f"bytes={segment.offset}-{segment.end}"})
+        response = connection.getresponse()
+
+        if response.status == 206:
+            content_range = response.getheader("Content-Range", "")
+            if content_range != f"bytes {segment.offset}-{segment.end}/{self.request.size}":
+                raise FetchError(f"server sent {content_range!r} for bytes {segment.offset}-{segment.end}")
+        elif response.status == 200 and segment.offset == 0 and segment.end == self.request.size - 1:
+            # A server that ignores Range is fine if we wanted the whole bundle anyway.
+            pass
+        else:
+            response.read()
+            raise FetchError(f"unexpected response {response.status} {response.reason}")
+
+        buffer = bytearray(self.config.upload_chunk_size)
+        view = memoryview(buffer)
+        sync_bytes = self.config.staging_sync_bytes
+        synced = segment.offset
+
+        while not segment.is_complete():
+            n = response.readinto(view[: segment.end - segment.offset + 1])
+            if not n:
+                raise http.client.IncompleteRead(b"", segment.end - segment.offset + 1)
+
+            try:
+                os.pwrite(fd, view[:n], segment.offset)
+                segment.offset += n
+
+                # Keep what has been received out of the page cache, as for uploads.
+                if sync_bytes and (segment.offset - synced >= sync_bytes or segment.is_complete()):
+                    flush_and_drop(fd, synced, segment.offset - synced)
+                    synced = segment.offset
+            except OSError:
+                logging.error(f"Unable to write download to '{self.path}'")
+                raise FetchError("unable to write downloaded update")
+
+            # The throttle is shared by all the connections so it has a lock of its own.
+            with self.throttle_lock:
+                self.throttle.wait(n)
+
+            with self.lock:
+                self.received += n
+
+            self.report_progress()
+
+        # Leave the connection ready for the next request.
+        if response.read(1):
+            raise FetchError("server sent more than the requested range")
+
+    def connect(self) -> http.client.HTTPConnection:
+        if self.url.scheme == "https":
+            connection = http.client.HTTPSConnection(self.url.netloc, timeout=self.config.fetch_timeout_s)
+        else:
+            connection = http.client.HTTPConnection(self.url.netloc, timeout=self.config.fetch_timeout_s)
+
+        with self.lock:
+            self.connections.append(connection)
+
+        return connection
+
+    def disconnect(self, connection: http.client.HTTPConnection) -> None:
+        connection.close()
+
+        with self.lock:
+            self.connections.remove(connection)
+
+    def report_progress(self, force: bool = False) -> None:
+        now = time.monotonic()
+
+        with self.lock:
+            if not force and now - self.last_progress < self.config.upload_progress_interval_s:
+                return
+
+            self.last_progress = now
+            received = self.received
+
+        rate = int(received / max(now - self.start_time, 1e-3))
+        self.on_progress(received, received, rate)
@@ -0,0 +1,85 @@
+import logging
+from typing import List, Optional
+
+
+class HistoryEvent:
+    """
+    One change to one status field.  Slotted so that a full history takes as little memory
+    as possible.
+    """
+
+    __slots__ = ("seq", "time", "field", "value")
+
+    def __init__(self, seq: int, time: float, field: str, value: any):
+        self.seq = seq
+        self.time = time
+        self.field = field
+        self.value = value
+
+    def to_dict(self) -> dict:
+        return {"seq": self.seq, "time": self.time, "field": self.field, "value": self.value}
+
+
+class History:
+    """
+    The last capacity changes to the status, oldest first, so that what led up to a failure
+    can be seen after the fact.  Events are numbered from 1 so a client can ask for only
+    those after the last one it saw.
+
+    The buffer is allocated up front and overwritten in place, so appending is O(1) and the
+    memory used never grows.  There is no lock of its own; the model only touches it under
+    the status lock.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.events: List[Optional[HistoryEvent]] = [None] * capacity
+        # The sequence number the next event gets.
+        self.next_seq = 1
+
+    def append(self, time: float, field: str, value: any) -> None:
+        index = self.next_seq % self.capacity
+        event = self.events[index]
+
+        if event is None:
+            self.events[index] = HistoryEvent(self.next_seq, time, field, value)
+        else:
+            # Reuse the record that has dropped off the end rather than allocate a new one.
+            event.seq = self.next_seq
+            event.time = time
+            event.field = field
+            event.value = value
+
+        self.next_seq += 1
+
+    def get_first_seq(self) -> int:
+        return max(1, self.next_seq - self.capacity)
+
+    def get_since(self, seq: int) -> List[dict]:
+        """
+        Returns the events numbered after seq that are still held, oldest first.
+        """
+
+        first = max(seq + 1, self.get_first_seq())
+        return [self.events[n % self.capacity].to_dict() for n in range(first, self.next_seq)]
+
+    def get_snapshot(self, seq: int) -> dict:
+        """
+        Returns the events after seq along with the number to ask for next time.  Dropped is
+        true if some of the events asked for have already been overwritten.
+        """
+
+        # A number we haven't got to yet must be from before a restart, so start over.
+        if seq >= self.next_seq:
+            seq = 0
+
+        return {
+            "next": self.next_seq - 1,
+            "dropped": seq + 1 < self.get_first_seq(),
+            "events": self.get_since(seq),
+        }
+
+    def log(self) -> None:
+        for n in range(self.get_first_seq(), self.next_seq):
+            event = self.events[n % self.capacity]
+            logging.error(f"History {event.seq} at {event.time:.3f}: {event.field} = {event.value!r}")
@@ -0,0 +1,284 @@
+import ctypes
+import ctypes.util
+from json import dumps, loads
+import logging
+import os
+import struct
+import subprocess
+from threading import Event, RLock, Thread
+import time
+from typing import Optional
+from uuid import uuid4
+
+from .configuration import Configuration
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+inotify_event = struct.Struct("iIII")
+
+
+def get_object(value: any, name: str) -> dict:
+    """
+    Returns value if it is an object, or an empty one if it is missing.  Raises ValueError
+    if it is anything else.
+    """
+
+    if value is None:
+        return {}
+
+    if not isinstance(value, dict):
+        raise ValueError(f"RAUC {name} is not an object")
+
+    return value
+
+
+def parse_slots(output: bytes) -> dict:
+    """
+    Picks out what clients care about from the JSON that "rauc status --detailed
+    --output-format=json" prints: which slot is booted and which is primary, and for each
+    slot its state, whether it is marked good and the version of the bundle installed in
+    it.  Raises ValueError if the output isn't what we expect.
+    """
+
+    status = loads(output)
+    if not isinstance(status, dict):
+        raise ValueError("RAUC status is not an object")
+
+    entries = status.get("slots") or []
+    # Each slot is listed as an object of its own, keyed by the slot name.
+    if isinstance(entries, dict):
+        entries = [entries]
+
+    if not isinstance(entries, list):
+        raise ValueError("RAUC slots are not a list")
+
+    slots = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ValueError("RAUC slot is not an object")
+
+        for name, slot in entry.items():
+            if not isinstance(slot, dict):
+                raise ValueError(f"RAUC slot {name} is not an object")
+
+            slot_status = get_object(slot.get("slot_status"), f"{name} slot_status")
+            bundle = get_object(slot_status.get("bundle"), f"{name} bundle")
+            installed = get_object(slot_status.get("installed"), f"{name} installed")
+
+            slots[name] = {
+                "class": slot.get("class"),
+                "device": slot.get("device"),
+                "bootname": slot.get("bootname"),
+                "state": slot.get("state"),
+                "boot_status": slot.get("boot_status"),
+                "bundle_version": bundle.get("version"),
+                "installed": installed.get("timestamp"),
+            }
+
+    return {
+        "compatible": status.get("compatible"),
+        "variant": status.get("variant"),
+        "booted": status.get("booted"),
+        "boot_primary": status.get("boot_primary"),
+        "slots": slots,
+    }
+
+
+class VersionWatcher:
+    """
+    Calls on_change whenever the file at path may have changed.  The directory is watched
+    with inotify rather than the file so that a file replaced by a rename is still
+    noticed.  Where inotify isn't available (or the directory doesn't exist yet) the file
+    is polled every poll_period_s instead.
+    """
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, path: str, poll_period_s: float, on_change):
+        self.directory, name = os.path.split(os.path.abspath(path))
+        self.path = path
+        self.name = os.fsencode(name)
+        self.poll_period_s = poll_period_s
+        self.on_change = on_change
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def run(self) -> None:
+        fd = self.open_inotify()
+
+        if fd is None:
+            self.poll()
+        else:
+            self.watch(fd)
+
+    def open_inotify(self) -> Optional[int]:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+        except (AttributeError, OSError):
+            fd = -1
+
+        if fd < 0:
+            logging.info(f"inotify isn't available; polling '{self.path}' for changes")
+            return None
+
+        if libc.inotify_add_watch(fd, os.fsencode(self.directory), self.mask) < 0:
+            logging.info(f"Unable to watch '{self.directory}'; polling '{self.path}' for changes")
+            os.close(fd)
+            return None
+
+        return fd
+
+    def watch(self, fd: int) -> None:
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                logging.error(f"Stopped watching '{self.path}'")
+                os.close(fd)
+                self.poll()
+                return
+
+            changed = False
+            offset = 0
+            while offset + inotify_event.size <= len(data):
+                _, _, _, length = inotify_event.unpack_from(data, offset)
+                offset += inotify_event.size
+                changed = changed or data[offset : offset + length].rstrip(b"\0") == self.name
+                offset += length
+
+            if changed:
+                self.on_change()
+
+    def poll(self) -> None:
+        last = None
+
+        while True:
+            try:
+                stat = os.stat(self.path)
+                current = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                current = None
+
+            if current != last:
+                last = current
+                self.on_change()
+
+            time.sleep(self.poll_period_s)
+
+
+class Inventory:
+    """
+    What is installed on the device: the version file and RAUC's view of the slots.  Both
+    are kept ready to send, along with a tag that changes whenever they do, so that serving
+    them costs no file or process access.
+
+    The version file is re-read when it changes on disk.  The slots are re-read at start
+    and whenever the state machine has just installed, reverted or overridden, which are
+    the only times they change under us.  The RAUC command runs on a thread of its own so
+    that neither requests nor the state runner wait on it, and back-to-back refreshes are
+    folded into one.
+    """
+
+    def __init__(self, config: Configuration):
+        self.config = config
+        self.lock = RLock()
+        # Tags are random per process, as for the status, so a tag is never reused across a
+        # restart.
+        self.epoch = uuid4().hex[:8]
+        self.version = b""
+        self.version_count = 0
+        self.slots = b""
+        self.slots_count = 0
+        self.slots_stale = Event()
+        self.slots_thread = Thread(target=self.run_slots, daemon=True)
+        self.watcher = VersionWatcher(config.version_path, config.version_poll_period_s, self.read_version)
+
+    def start(self) -> None:
+        # Read the version straight away so /version is ready by the time the runner is.
+        self.read_version()
+        self.watcher.start()
+        self.refresh_slots()
+        self.slots_thread.start()
+
+    def get_version(self) -> Optional[bytes]:
+        with self.lock:
+            return self.version or None
+
+    def get_version_tag(self) -> str:
+        with self.lock:
+            return f'"{self.epoch}-v{self.version_count}"'
+
+    def get_slots(self) -> Optional[bytes]:
+        with self.lock:
+            return self.slots or None
+
+    def get_slots_tag(self) -> str:
+        with self.lock:
+            return f'"{self.epoch}-s{self.slots_count}"'
+
+    def read_version(self) -> None:
+        try:
+            with open(self.config.version_path, "rb") as f:
+                version = f.read()
+        except OSError:
+            logging.error(f"Unable to read version file at {self.config.version_path}")
+            version = b""
+
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.version_count += 1
+                logging.info(f"Read version file at {self.config.version_path}")
+
+    def refresh_slots(self) -> None:
+        self.slots_stale.set()
+
+    def run_slots(self) -> None:
+        while True:
+            self.slots_stale.wait()
+            self.slots_stale.clear()
+
+            # Whatever goes wrong, keep the thread going for the next refresh.
+            try:
+                self.read_slots()
+            except Exception:
+                logging.exception(f"Unable to read the slots with {self.config.slots_cmds}")
+
+    def read_slots(self) -> None:
+        try:
+            result = subprocess.run(
+                self.config.slots_cmds,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=self.config.slots_timeout_s,
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.error(f"Unable to run {self.config.slots_cmds}; {e!r}")
+            return
+
+        if result.returncode != 0:
+            logging.error(f"{self.config.slots_cmds} failed; {result.stderr.decode(errors='replace').strip()}")
+            return
+
+        try:
+            fields = parse_slots(result.stdout)
+        except ValueError as e:
+            logging.error(f"Unable to parse the output of {self.config.slots_cmds}; {e}")
+            return
+
+        slots = dumps(fields).encode("utf-8")
+
+        with self.lock:
+            if slots != self.slots:
+                self.slots = slots
+                self.slots_count += 1
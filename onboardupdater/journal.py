@@ -0,0 +1,153 @@
+from json import loads
+import logging
+import os
+from threading import Condition, Thread
+import time
+from typing import List, Optional
+
+from .configuration import Configuration
+from .rauc import RaucProgressParser
+from .status import Status
+
+# States whose work is lost if the process stops part way through.  Recovering from any of
+# these goes to failed with the interrupted operation as the last error.
+interrupted_states = ["fetch_update", "write_update", "rauc_update", "pipelined_update", "override", "revert"]
+
+# Upload progress changes several times a second and means nothing after a restart, so it
+# is left out of the journal rather than costing a sync each time.
+unjournaled_fields = ["upload_received", "upload_written", "upload_rate"]
+
+
+class Journal:
+    """
+    An append-only record of the status, one JSON line per change, so that the status can
+    be restored after a restart or power loss.
+
+    Recording a change only queues it; a background thread writes queued records in
+    batches and syncs them to disk at most every flush_interval_s, so the state runner
+    never waits on flash.  When the file grows beyond max_bytes, it is compacted down to
+    the latest record.
+    """
+
+    def __init__(self, path: str, flush_interval_s: float, max_bytes: int):
+        self.path = path
+        self.flush_interval_s = flush_interval_s
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.latest = None
+        self.changed = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def load(self) -> Optional[dict]:
+        """
+        Returns the last complete record, or None if there isn't one.  A power cut can leave
+        a partial last line, which is skipped.
+        """
+
+        try:
+            with open(self.path, "rb") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None
+        except OSError:
+            logging.error(f"Unable to read journal '{self.path}'")
+            return None
+
+        for line in reversed(lines):
+            try:
+                return loads(line)
+            except ValueError:
+                continue
+
+        return None
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def record(self, json: bytes) -> None:
+        with self.changed:
+            self.pending.append(json)
+            self.changed.notify()
+
+    def run(self) -> None:
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending)
+                batch = self.pending
+                self.pending = []
+
+            try:
+                self.write(batch)
+            except OSError:
+                logging.error(f"Unable to write journal '{self.path}'")
+
+            # Let changes pile up for a while so that a burst costs only one sync.
+            time.sleep(self.flush_interval_s)
+
+    def write(self, batch: list) -> None:
+        self.latest = batch[-1]
+
+        with open(self.path, "ab") as f:
+            f.write(b"\n".join(batch) + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+
+        if size > self.max_bytes:
+            self.compact()
+
+    def compact(self) -> None:
+        # Write the latest record to a new file and swap it in, so a power cut leaves
+        # either the old or the new journal.
+        temp_path = f"{self.path}.tmp"
+
+        with open(temp_path, "wb") as f:
+            f.write(self.latest + b"\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.path)
+
+
+def recover_status(record: Optional[dict], config: Configuration, states: List[str]) -> Status:
+    """
+    Works out the status to start with from the last journal record, given the names of the
+    states the model has.  Returns a fresh ready status if there is nothing to recover.
+    """
+
+    status = Status("ready")
+
+    if record is None:
+        return status
+
+    for field, value in record.items():
+        if hasattr(status, field) and field not in unjournaled_fields:
+            setattr(status, field, value)
+
+    bundle_exists = os.path.exists(config.update_write_path)
+    if not bundle_exists:
+        status.bundle_sha256 = ""
+
+    if status.state in interrupted_states:
+        logging.error(f"Interrupted during {status.state}")
+        status.last_error = f"interrupted during {status.state}"
+        status.state = "failed"
+    elif status.state not in states:
+        # Written by another version of the OU, or corrupted; either way there's no knowing
+        # what was going on, and a state the model doesn't have would leave it stuck.
+        logging.error(f"Unknown state {status.state!r} in journal")
+        status.last_error = f"unknown state {status.state!r} in journal"
+        status.state = "failed"
+    elif status.state in ("staged", "scheduled") and not bundle_exists:
+        logging.error(f"Staged update '{config.update_write_path}' is missing")
+        status.state = "ready"
+    elif status.state == "reboot":
+        # This is where we expect to be after an update or revert.
+        status.state = "ready"
+
+    # Nothing is installing yet, so an install that was going has stopped.
+    if status.rauc_state.startswith(RaucProgressParser.in_progress):
+        status.rauc_state = ""
+
+    logging.info(f"Recovered state {status.state} from journal")
+    return status
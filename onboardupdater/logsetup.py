@@ -0,0 +1,163 @@
+from datetime import datetime, timezone
+from json import dumps
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Full, Queue
+from threading import Lock, local
+import time
+
+from .configuration import Configuration
+
+
+class LogContext:
+    """
+    What the state machine is doing, attached to every log record.  The state runner sets
+    the trigger it is handling and the model sets the state it has entered.  The state
+    applies to every thread, but the trigger is kept per thread so that only records
+    logged while handling it, on the runner thread, are tagged with it.
+    """
+
+    def __init__(self):
+        self.state = ""
+        self.local = local()
+
+    @property
+    def trigger(self) -> str:
+        return getattr(self.local, "trigger", "")
+
+    @trigger.setter
+    def trigger(self, trigger: str) -> None:
+        self.local.trigger = trigger
+
+
+log_context = LogContext()
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.state = log_context.state
+        record.trigger = log_context.trigger
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most burst records with the same message in each period_s.  The first
+    record after a quiet period says how many were suppressed, so a burst of the same
+    error costs a couple of lines rather than one per occurrence.
+    """
+
+    # Forget about messages not seen for a period once there are this many.
+    max_keys = 1024
+
+    def __init__(self, period_s: float, burst: int):
+        logging.Filter.__init__(self)
+        self.period_s = period_s
+        self.burst = burst
+        # Message to [period start, count in period, suppressed count].
+        self.counts = {}
+        self.lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.levelno, record.getMessage())
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.counts.get(key)
+
+            if entry is None or now - entry[0] >= self.period_s:
+                if len(self.counts) >= self.max_keys:
+                    self.forget(now)
+
+                suppressed = entry[2] if entry is not None else 0
+                self.counts[key] = [now, 1, 0]
+                record.suppressed = suppressed
+                return True
+
+            entry[1] += 1
+            if entry[1] > self.burst:
+                entry[2] += 1
+                return False
+
+            record.suppressed = 0
+            return True
+
+    def forget(self, now: float) -> None:
+        self.counts = {key: entry for key, entry in self.counts.items() if now - entry[0] < self.period_s}
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without ever waiting.  If the queue is full
+    (i.e. the disk has fallen far behind) the record is dropped and counted instead.
+    """
+
+    def __init__(self, queue: Queue):
+        QueueHandler.__init__(self, queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The listener is in the same process so the record can go as it is; formatting is
+        # left to the listener thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.dropped:
+            record.dropped = self.dropped
+
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a line of JSON.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "state": getattr(record, "state", ""),
+            "trigger": getattr(record, "trigger", ""),
+            "message": record.getMessage(),
+        }
+
+        for field in ["suppressed", "dropped"]:
+            if getattr(record, field, 0):
+                line[field] = getattr(record, field)
+
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+
+        return dumps(line)
+
+
+def setup_logging(config: Configuration) -> QueueListener:
+    """
+    Sets up logging so that the threads doing the work only ever put records on a queue.
+    A listener thread formats them as JSON and writes them to a size-rotated log file.
+    Returns the listener, which should be stopped on exit to flush what is left.
+    """
+
+    file_handler = RotatingFileHandler(
+        config.log_path, maxBytes=config.log_max_bytes, backupCount=config.log_backup_count
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    queue_handler = NonBlockingQueueHandler(Queue(config.log_queue_size))
+    queue_handler.addFilter(RateLimitFilter(config.log_rate_limit_period_s, config.log_rate_limit_burst))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(config.log_level)
+    root.addHandler(queue_handler)
+
+    listener = QueueListener(queue_handler.queue, file_handler)
+    listener.start()
+    return listener
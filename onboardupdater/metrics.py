@@ -0,0 +1,182 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, List, Tuple
+
+
+class Metric:
+    """
+    A named family of values, one per combination of label values.  Each metric has a lock
+    of its own that is only held for a dictionary update, so recording is cheap enough to
+    leave on all the time.
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = Lock()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+        with self.lock:
+            items = sorted(self.values.items())
+
+        for label_values, value in items:
+            lines += self.render_value(label_values, value)
+
+        return lines
+
+    def render_value(self, label_values: tuple, value) -> List[str]:
+        return [f"{self.name}{self.format_labels(label_values)} {format_number(value)}"]
+
+    def format_labels(self, label_values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{escape(value)}"' for name, value in zip(self.labels, label_values)]
+        if extra:
+            pairs.append(extra)
+
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A gauge whose value is read from a function when the metrics are rendered, for things
+    like queue depth that are cheaper to sample than to track.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        Metric.__init__(self, name, help)
+        self.read = read
+
+    def render(self) -> List[str]:
+        with self.lock:
+            self.values = {(): self.read()}
+
+        return Metric.render(self)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: List[float], labels: Tuple[str, ...] = ()):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        # Store a count per bucket rather than cumulative counts; render() adds them up.
+        index = bisect_left(self.buckets, value)
+
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def render_value(self, label_values: tuple, counts: list) -> List[str]:
+        lines = []
+        total = 0
+
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            total += count
+            le = "+Inf" if bound == float("inf") else format_number(bound)
+            labels = self.format_labels(label_values, 'le="%s"' % le)
+            lines.append(f"{self.name}_bucket{labels} {total}")
+
+        labels = self.format_labels(label_values)
+        lines.append(f"{self.name}_sum{labels} {format_number(counts[-1])}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Bucket bounds in seconds.  States range from milliseconds (write_update) to hours
+# (staged); HTTP requests are normally quick but uploads can take minutes.
+state_buckets = [0.01, 0.1, 1, 5, 15, 60, 300, 900, 3600, 14400, 86400]
+request_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 120, 600]
+install_buckets = [10, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+# Bytes per second.
+throughput_buckets = [64e3, 256e3, 1e6, 4e6, 16e6, 64e6]
+
+
+class Metrics:
+    """
+    All the metrics the updater keeps, rendered in the Prometheus text format for
+    GET /metrics.
+    """
+
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, queue_depth: Callable[[], float]):
+        self.state_duration = Histogram(
+            "onboardupdater_state_duration_seconds", "Time spent in each state.", state_buckets, ("state",)
+        )
+        self.triggers = Counter(
+            "onboardupdater_triggers_total", "Triggers processed by the state runner.", ("trigger",)
+        )
+        self.rejected_triggers = Counter(
+            "onboardupdater_rejected_triggers_total",
+            "Triggers rejected by the state machine as invalid for the current state.",
+            ("trigger", "state"),
+        )
+        self.trigger_queue_depth = Gauge(
+            "onboardupdater_trigger_queue_depth", "Triggers waiting for the state runner.", queue_depth
+        )
+        self.upload_throughput = Histogram(
+            "onboardupdater_upload_throughput_bytes_per_second",
+            "Rate at which completed uploads were written to disk.",
+            throughput_buckets,
+        )
+        self.install_duration = Histogram(
+            "onboardupdater_rauc_install_duration_seconds",
+            "Time from the first to the last progress percentage reported by rauc install.",
+            install_buckets,
+        )
+        self.requests = Counter(
+            "onboardupdater_http_requests_total", "HTTP requests handled.", ("method", "route", "code")
+        )
+        self.request_duration = Histogram(
+            "onboardupdater_http_request_duration_seconds",
+            "Time taken to handle HTTP requests.",
+            request_buckets,
+            ("method", "route"),
+        )
+
+    def render(self) -> bytes:
+        metrics = [
+            self.state_duration,
+            self.triggers,
+            self.rejected_triggers,
+            self.trigger_queue_depth,
+            self.upload_throughput,
+            self.install_duration,
+            self.requests,
+            self.request_duration,
+        ]
+
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+
+        return ("\n".join(lines) + "\n").encode("utf-8")
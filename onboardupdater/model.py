@@ -1,17 +1,29 @@
 from copy import deepcopy
+from json import dumps
 import logging
 import os
-import subprocess
-import sys
-from threading import RLock
+from threading import Condition, RLock
+from typing import List, Optional, Tuple, Union
+from uuid import uuid4
 import time
 
-from transitions import Machine
-
 from .configuration import Configuration
-from .rauc import get_rauc_status
+from .engine import engines
+from .fetch import Downloader, FetchRequest
+from .history import History
+from .inventory import Inventory
+from .journal import Journal, unjournaled_fields
+from .logsetup import log_context
+from .metrics import Metrics
+from .pipeline import BundleServer, PipelinedBundle
+from .progress import ProgressSource, create_progress_source
+from .rauc import RaucProgressParser
+from .schedule import is_install_window_open
+from .staging import remove_file
 from .status import Status
 from .trigger import Trigger
+from .upload import UpdateFile
+from .worker import Worker
 
 # https://github.com/pytransitions/transitions#states
 states = [
@@ -19,13 +31,33 @@ states = [
         "name": "ready",
         "on_enter": "on_enter_ready",
     },
+    {
+        "name": "fetch_update",
+        "on_enter": "on_enter_fetch_update",
+        "on_exit": "on_exit_fetch_update",
+    },
     {
         "name": "write_update",
         "on_enter": "on_enter_write_update",
     },
+    {
+        "name": "staged",
+        "on_enter": "on_enter_staged",
+    },
+    {
+        "name": "scheduled",
+        "on_enter": "on_enter_scheduled",
+        "on_exit": "on_exit_scheduled",
+    },
     {
         "name": "rauc_update",
         "on_enter": "on_enter_rauc_update",
+        "on_exit": "on_exit_rauc_update",
+    },
+    {
+        "name": "pipelined_update",
+        "on_enter": "on_enter_pipelined_update",
+        "on_exit": "on_exit_pipelined_update",
     },
     {
         "name": "override",
@@ -53,17 +85,48 @@ transitions = [
         "source": "ready",
         "dest": "write_update",
     },
+    {
+        "trigger": "fetch",
+        "source": "ready",
+        "dest": "fetch_update",
+    },
+    {
+        "trigger": "pipeline",
+        "source": "ready",
+        "dest": "pipelined_update",
+    },
     {
         "trigger": "revert",
         "source": "ready",
         "dest": "revert",
     },
+    # fetch_update
+    {
+        "trigger": "fetch_update_success",
+        "source": "fetch_update",
+        "dest": "write_update",
+    },
+    {
+        "trigger": "fetch_update_failed",
+        "source": "fetch_update",
+        "dest": "failed",
+    },
+    {
+        "trigger": "cancel",
+        "source": "fetch_update",
+        "dest": "ready",
+    },
     # write_update
     {
         "trigger": "write_update_success",
         "source": "write_update",
         "dest": "rauc_update",
     },
+    {
+        "trigger": "write_update_staged",
+        "source": "write_update",
+        "dest": "staged",
+    },
     {
         "trigger": "write_update_failed",
         "source": "write_update",
@@ -74,6 +137,50 @@ transitions = [
         "source": "write_update",
         "dest": "ready",
     },
+    # staged
+    {
+        "trigger": "install",
+        "source": "staged",
+        "dest": "scheduled",
+    },
+    {
+        "trigger": "update",
+        "source": "staged",
+        "dest": "write_update",
+    },
+    {
+        "trigger": "fetch",
+        "source": "staged",
+        "dest": "fetch_update",
+    },
+    {
+        "trigger": "pipeline",
+        "source": "staged",
+        "dest": "pipelined_update",
+    },
+    {
+        "trigger": "cancel",
+        "source": "staged",
+        "dest": "ready",
+        "before": "drop_staged_update",
+    },
+    # scheduled
+    {
+        "trigger": "tick",
+        "source": "scheduled",
+        "dest": None,
+        "after": "check_install_window",
+    },
+    {
+        "trigger": "install_window_open",
+        "source": "scheduled",
+        "dest": "rauc_update",
+    },
+    {
+        "trigger": "cancel",
+        "source": "scheduled",
+        "dest": "staged",
+    },
     # rauc_update
     {
         "trigger": "rauc_update_success",
@@ -90,6 +197,45 @@ transitions = [
         "source": "rauc_update",
         "dest": "override",
     },
+    # pipelined_update
+    {
+        "trigger": "pipeline_upload_success",
+        "source": "pipelined_update",
+        "dest": None,
+        "after": "on_pipeline_upload_success",
+    },
+    {
+        "trigger": "pipeline_upload_failed",
+        "source": "pipelined_update",
+        "dest": None,
+        "after": "fail_pipeline",
+    },
+    {
+        "trigger": "pipeline_install_success",
+        "source": "pipelined_update",
+        "dest": None,
+        "after": "on_pipeline_install_success",
+    },
+    {
+        "trigger": "pipeline_success",
+        "source": "pipelined_update",
+        "dest": "reboot",
+    },
+    {
+        "trigger": "pipeline_failed",
+        "source": "pipelined_update",
+        "dest": "failed",
+    },
+    {
+        "trigger": "pipeline_rollback",
+        "source": "pipelined_update",
+        "dest": "override",
+    },
+    {
+        "trigger": "cancel",
+        "source": "pipelined_update",
+        "dest": "override",
+    },
     # override
     {
         "trigger": "rauc_override_success",
@@ -107,6 +253,16 @@ transitions = [
         "source": "failed",
         "dest": "write_update",
     },
+    {
+        "trigger": "fetch",
+        "source": "failed",
+        "dest": "fetch_update",
+    },
+    {
+        "trigger": "pipeline",
+        "source": "failed",
+        "dest": "pipelined_update",
+    },
     # revert
     {
         "trigger": "rauc_revert_success",
@@ -127,129 +283,425 @@ transitions = [
 ]
 
 
-class Model(Machine):
+class Model:
     """
-    This is the state machine model, inheriting from the transitions state machine class.
-    Generally we do work on a state's entrance function.  A state can dictate subsequent
-    transitions by posting a transition trigger back to the parent runner.
+    This is the state machine model.  The states and transitions above are run either by the
+    transitions package or by our own table-driven engine, depending on the configuration;
+    either way the engine binds state and trigger() onto the model.  Generally we do work on
+    a state's entrance function.  A state can dictate subsequent transitions by posting a
+    transition trigger back to the parent runner.  A state that needs to do something
+    periodically has an internal "tick" transition; the runner posts ticks only while in
+    such a state.
+
+    Long-running commands (RAUC install, override and revert) are run on a Worker so the
+    runner can keep processing triggers; the worker posts the follow-on trigger when its
+    command exits.  A bundle fetch runs on a Downloader in the same way, and the install is
+    followed by a ProgressSource, which reads either the output of "rauc install" or the
+    RAUC service's D-Bus signals.  A pipelined install points the install at a BundleServer
+    while the upload is still coming in.  Leaving a state cancels any worker it started.
 
     Any access of the status object should be protected using the lock:  the state workers
     are called from the runner thread while the HTTP request handler thread queries
     the status object.
+
+    The status is also kept pre-encoded as JSON along with a version number that goes up
+    whenever a field actually changes, so polling the status costs no serialization.  The
+    epoch is random per process so a version from before a restart is never mistaken for a
+    current one.  Every change other than upload progress is also recorded in the journal,
+    if there is one, so the status can be restored after a restart.  Status subscribers wait
+    on the status_changed condition for the version to move on; they always pick up the
+    latest snapshot rather than every change, so a slow subscriber can't hold up the state
+    runner.  Changes to the fields that matter after the fact are also appended to the
+    history, under the same lock.
     """
 
-    def __init__(self, config: Configuration, post_trigger):
+    def __init__(
+        self,
+        config: Configuration,
+        post_trigger,
+        status: Optional[Status] = None,
+        journal: Optional[Journal] = None,
+        metrics: Optional[Metrics] = None,
+        inventory: Optional[Inventory] = None,
+    ):
         self.config = config
         self.post_trigger = post_trigger
-        self.status = Status("ready")
+        self.status = status or Status("ready")
+        self.journal = journal
+        self.metrics = metrics or Metrics(lambda: 0)
+        self.inventory = inventory
+        # For timing how long is spent in each state.
+        self.timed_state = self.status.state
+        self.state_entered = time.monotonic()
+        log_context.state = self.status.state
         self.status_lock = RLock()
-
-        Machine.__init__(
-            self,
-            initial="ready",
-            states=states,
-            transitions=transitions,
-        )
+        self.status_changed = Condition(self.status_lock)
+        self.status_epoch = uuid4().hex[:8]
+        self.status_version = 0
+        self.status_json = dumps(vars(self.status)).encode("utf-8")
+        self.worker = None
+        self.history = History(config.history_capacity) if config.history_capacity > 0 else None
+        self.history_fields = set(config.history_fields)
+
+        if self.journal is not None:
+            self.journal.record(self.get_journal_record())
+
+        # The pipelined install in progress, if any, and how far along each side of it is.
+        self.pipelined_bundle = None
+        self.pipeline_update = None
+        self.pipeline_installed = False
+        self.bundle_server = None
+        # When the idle check in progress, if any, was started.
+        self.idle_check_started = None
+        self.engine = engines[config.state_engine](self, states, transitions, self.status.state)
+
+    def get_triggers(self, state: str) -> List[str]:
+        return self.engine.get_triggers(state)
 
     def get_status(self) -> Status:
         with self.status_lock:
             return deepcopy(self.status)
 
-    def update_last_error(self, error: str) -> None:
+    def get_status_snapshot(self) -> Tuple[int, bytes]:
         with self.status_lock:
-            self.status.last_error = error
+            return self.status_version, self.status_json
+
+    def wait_for_status(self, version: int, timeout_s: Optional[float]) -> Tuple[int, bytes]:
+        """
+        Returns the status snapshot once its version differs from the one given, or the
+        unchanged snapshot after timeout_s.
+        """
+
+        with self.status_changed:
+            self.status_changed.wait_for(lambda: self.status_version != version, timeout_s)
+            return self.status_version, self.status_json
+
+    def get_history(self, seq: int) -> Optional[bytes]:
+        """
+        Returns the status changes after seq as JSON, or None if no history is kept.
+        """
+
+        if self.history is None:
+            return None
 
-    def update_state(self) -> None:
         with self.status_lock:
-            self.status.state = self.state
+            snapshot = self.history.get_snapshot(seq)
 
-    def update_rauc_state(self, rauc_state: str) -> None:
+        # Encode outside the lock so as not to hold up the state runner.
+        return dumps(snapshot).encode("utf-8")
+
+    def set_status_field(self, field: str, value: any) -> None:
+        self.set_status_fields({field: value})
+
+    def set_status_fields(self, fields: dict) -> None:
         with self.status_lock:
-            self.status.rauc_state = rauc_state
+            changed = False
+            journaled = False
+            for field, value in fields.items():
+                if getattr(self.status, field) != value:
+                    setattr(self.status, field, value)
+                    changed = True
+                    journaled = journaled or field not in unjournaled_fields
+
+                    if self.history is not None and field in self.history_fields:
+                        self.history.append(time.time(), field, value)
+
+            if not changed:
+                return
+
+            self.status_version += 1
+            self.status_json = dumps(vars(self.status)).encode("utf-8")
+            self.status_changed.notify_all()
+
+            if self.journal is not None and journaled:
+                self.journal.record(self.get_journal_record())
+
+    def get_journal_record(self) -> bytes:
+        record = {field: value for field, value in vars(self.status).items() if field not in unjournaled_fields}
+        return dumps(record).encode("utf-8")
+
+    def update_last_error(self, error: str) -> None:
+        self.set_status_field("last_error", error)
+
+    def update_state(self) -> None:
+        # Every state's entrance function calls this so it is where we time states.
+        now = time.monotonic()
+        self.metrics.state_duration.observe(now - self.state_entered, self.timed_state)
+        self.timed_state = self.state
+        self.state_entered = now
+        log_context.state = self.state
+
+        self.set_status_field("state", self.state)
+
+    def update_rauc_state(self, rauc_state: str) -> None:
+        self.set_status_field("rauc_state", rauc_state)
 
     def update_boot_state(self, boot_state: str) -> None:
-        with self.status_lock:
-            self.status.boot_state = boot_state
+        self.set_status_field("boot_state", boot_state)
+
+    def update_bundle_sha256(self, sha256: str) -> None:
+        self.set_status_field("bundle_sha256", sha256)
+
+    def update_upload_progress(self, received: int, written: int, rate: int) -> None:
+        self.set_status_fields({"upload_received": received, "upload_written": written, "upload_rate": rate})
+
+    def start_worker(self, worker: Union[Worker, Downloader, ProgressSource]) -> None:
+        self.worker = worker
+        self.worker.start()
+
+    def stop_worker(self) -> None:
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
 
     def on_enter_ready(self, data: any) -> None:
         self.update_state()
 
-    def on_enter_write_update(self, data: any) -> None:
+    def on_enter_fetch_update(self, data: FetchRequest) -> None:
+        self.update_state()
+
+        def on_exit(update: Optional[UpdateFile], error: str) -> None:
+            if update is not None:
+                self.post_trigger(Trigger("fetch_update_success", update))
+            else:
+                self.post_trigger(Trigger("fetch_update_failed", f"unable to fetch update: {error}"))
+
+        self.start_worker(Downloader(self.config, data, self.update_upload_progress, on_exit))
+
+    def on_exit_fetch_update(self, data: any) -> None:
+        # Leaving on the download's own result, the bundle goes on to write_update.  Leaving
+        # any other way, on a cancel, stops the download and drops the bundle even if it
+        # had just finished.
+        if isinstance(data, UpdateFile):
+            self.worker = None
+        else:
+            self.stop_worker()
+
+    def on_enter_write_update(self, data: UpdateFile) -> None:
         self.update_state()
 
+        # The upload has already been streamed to a staging file; all that's left is to
+        # check it and move it into place.  A bad digest fails here, well before RAUC would
+        # have to read the whole bundle back to find out.
+        if not data.is_digest_valid():
+            logging.error(f"Staged update '{data.path}' has SHA-256 {data.sha256}, expected {data.expected_sha256}")
+            remove_file(data.path)
+            self.post_trigger(
+                Trigger(
+                    "write_update_failed",
+                    f"bundle digest mismatch: expected sha256 {data.expected_sha256}, got {data.sha256}",
+                )
+            )
+            return
+
         try:
-            with open(self.config.update_write_path, "wb") as f:
-                f.write(data)
+            size = os.path.getsize(data.path)
+            if size != data.size:
+                logging.error(f"Staged update '{data.path}' is {size} bytes, expected {data.size}")
+                remove_file(data.path)
+                self.post_trigger(Trigger("write_update_failed", "staged update file is incomplete"))
+                return
+
+            os.replace(data.path, self.config.update_write_path)
+            self.update_bundle_sha256(data.sha256)
+
+            if data.stage_only:
+                self.post_trigger(Trigger("write_update_staged"))
+            else:
                 self.post_trigger(Trigger("write_update_success"))
         except OSError:
-            logging.error(f"Unable to open '{self.config.update_write_path}' for writing")
+            logging.error(f"Unable to move '{data.path}' to '{self.config.update_write_path}'")
             self.post_trigger(Trigger("write_update_failed", "unable to open file for writing"))
         except BaseException:
             logging.error(f"Unknown error trying to write update file {self.config.update_write_path}")
             self.post_trigger(Trigger("write_update_failed", "unknown error trying to write update file"))
 
-    def on_enter_rauc_update(self, data: any) -> None:
+    def on_enter_staged(self, data: any) -> None:
+        # The bundle is verified and in place; nothing more happens until "install".
+        self.update_state()
+
+    def drop_staged_update(self, data: any) -> None:
+        # This runs before leaving staged so that ready is never seen with the bundle still
+        # reported.
+        remove_file(self.config.update_write_path)
+        self.update_bundle_sha256("")
+
+    def on_enter_scheduled(self, data: any) -> None:
         self.update_state()
+        self.idle_check_started = None
+        self.check_install_window(data)
 
-        # RAUC writes most of its output to stdout but if it fails, then the failure message
-        # goes to stderr.  Just put everything in stdout to make our parsing easier.
-        process = subprocess.Popen(
-            self.config.update_cmds + [self.config.update_write_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
+    def check_install_window(self, data: any) -> None:
+        # This runs on entry and then on every tick until the install can go ahead.  The idle
+        # check runs on a worker so that a slow one doesn't hold up a cancel.
+        if self.idle_check_started is not None:
+            if time.monotonic() - self.idle_check_started < self.config.install_idle_timeout_s:
+                return
 
-        lines = []
-        return_code = None
+            logging.error(f"Install idle check {self.config.install_idle_cmds} timed out")
+            self.stop_worker()
+            self.idle_check_started = None
 
-        while True:
-            output = process.stdout.readline()
-            if output:
-                line = output.strip().decode("utf-8")
-                lines.append(line)
+        if not is_install_window_open(self.config):
+            return
 
-            self.update_rauc_state(get_rauc_status(lines))
+        if self.config.install_idle_cmds is None:
+            self.post_trigger(Trigger("install_window_open"))
+            return
 
-            return_code = process.poll()
-            if return_code is not None:
-                sys.stdout.flush()
-                for output in process.stdout.readlines():
-                    line = output.strip().decode("utf-8")
-                    lines.append(line)
+        def on_exit(return_code: int) -> None:
+            self.idle_check_started = None
 
-                rauc_state = get_rauc_status(lines)
-                self.update_rauc_state(rauc_state)
+            if return_code == 0:
+                self.post_trigger(Trigger("install_window_open"))
 
-                if return_code == 0:
-                    self.post_trigger(Trigger("rauc_update_success"))
-                else:
-                    logging.error(f"Error with RAUC update; {rauc_state}")
-                    self.post_trigger(Trigger("rauc_update_failed", "error trying to install update"))
-                break
+        self.idle_check_started = time.monotonic()
+        self.start_worker(Worker(self.config.install_idle_cmds, None, on_exit, self.config.worker_kill_timeout_s))
 
-            time.sleep(0.1)
+    def on_exit_scheduled(self, data: any) -> None:
+        # A no-op unless an idle check is still going.
+        self.stop_worker()
+        self.idle_check_started = None
+
+    def on_enter_rauc_update(self, data: any) -> None:
+        self.update_state()
+        self.start_install(self.config.update_write_path, "rauc_update_success", "rauc_update_failed")
+
+    def start_install(self, path: str, success_trigger: str, failed_trigger: str) -> None:
+        """
+        Installs the bundle at path, which may be a URL, posting one of the triggers given
+        once the install is over.
+        """
+
+        def on_exit(return_code: int, rauc_state: str) -> None:
+            self.update_rauc_state(rauc_state)
+            self.refresh_slots()
+
+            duration = source.get_install_duration()
+            if duration is not None:
+                self.metrics.install_duration.observe(duration)
+
+            if return_code == 0:
+                self.post_trigger(Trigger(success_trigger))
+            else:
+                logging.error(f"Error with RAUC update; {rauc_state}")
+                self.post_trigger(Trigger(failed_trigger, "error trying to install update"))
+
+        source = create_progress_source(self.config, path, self.update_rauc_state, on_exit)
+        self.start_worker(source)
+
+    def on_exit_rauc_update(self, data: any) -> None:
+        # This is a no-op if the install already finished; on a cancel it stops the install
+        # before the override starts.
+        self.stop_worker()
+        self.clear_stopped_install()
+
+    def clear_stopped_install(self) -> None:
+        # An install stopped part way through never reports how it ended, so don't leave it
+        # looking as though it is still going.
+        if self.get_status().rauc_state.startswith(RaucProgressParser.in_progress):
+            self.update_rauc_state("")
+
+    def on_enter_pipelined_update(self, data: PipelinedBundle) -> None:
+        self.update_state()
+
+        # The install reads the bundle from a loopback server as the upload writes it.  Both
+        # the verified upload and the install have to come in before we can reboot.
+        self.pipelined_bundle = data
+        self.pipeline_update = None
+        self.pipeline_installed = False
+        self.bundle_server = BundleServer(self.config, data)
+        self.bundle_server.start()
+        self.start_install(self.bundle_server.get_url(), "pipeline_install_success", "pipeline_failed")
+
+    def on_pipeline_upload_success(self, data: UpdateFile) -> None:
+        if not data.is_digest_valid():
+            logging.error(f"Pipelined update '{data.path}' has SHA-256 {data.sha256}, expected {data.expected_sha256}")
+            self.fail_pipeline(f"bundle digest mismatch: expected sha256 {data.expected_sha256}, got {data.sha256}")
+            return
+
+        self.pipeline_update = data
+        self.finish_pipeline()
+
+    def on_pipeline_install_success(self, data: any) -> None:
+        self.pipeline_installed = True
+        self.finish_pipeline()
+
+    def finish_pipeline(self) -> None:
+        if self.pipeline_update is None or not self.pipeline_installed:
+            return
+
+        # The bundle is only moved into place once RAUC is done reading it.
+        try:
+            os.replace(self.pipeline_update.path, self.config.update_write_path)
+        except OSError:
+            logging.error(f"Unable to move '{self.pipeline_update.path}' to '{self.config.update_write_path}'")
+            self.fail_pipeline("unable to open file for writing")
+            return
+
+        self.update_bundle_sha256(self.pipeline_update.sha256)
+        self.post_trigger(Trigger("pipeline_success"))
+
+    def fail_pipeline(self, error: str) -> None:
+        # Once RAUC has installed the bundle, the only way to undo it is to mark the booted
+        # slot active again, as a cancel does.
+        if self.pipeline_installed:
+            logging.error(f"Rolling back pipelined install; {error}")
+            self.update_last_error(error)
+            self.post_trigger(Trigger("pipeline_rollback"))
+        else:
+            self.post_trigger(Trigger("pipeline_failed", error))
+
+    def on_exit_pipelined_update(self, data: any) -> None:
+        # Stop the install, if it is still going, before anything else.  Stopping the server
+        # also stops the upload if it is still coming in.
+        self.stop_worker()
+        self.clear_stopped_install()
+        self.bundle_server.stop()
+
+        # A no-op if the bundle was moved into place.  After the server has stopped, no
+        # session can hand the bundle over any more.
+        if self.pipelined_bundle.temporary:
+            remove_file(self.pipelined_bundle.path)
 
     def on_enter_override(self, data: any) -> None:
         self.update_state()
 
-        process = subprocess.run(self.config.override_cmds)
+        def on_exit(return_code: int) -> None:
+            self.refresh_slots()
 
-        if process.returncode == 0:
-            self.post_trigger(Trigger("rauc_override_success"))
-        else:
-            self.post_trigger(Trigger("rauc_override_failed", "error trying to override update"))
+            if return_code == 0:
+                self.post_trigger(Trigger("rauc_override_success"))
+            else:
+                self.post_trigger(Trigger("rauc_override_failed", "error trying to override update"))
+
+        self.start_worker(Worker(self.config.override_cmds, None, on_exit, self.config.worker_kill_timeout_s))
 
     def on_enter_failed(self, data: any) -> None:
         self.update_state()
         self.update_last_error(data)
 
+        if self.config.history_log_on_failure and self.history is not None:
+            with self.status_lock:
+                self.history.log()
+
     def on_enter_revert(self, data: any) -> None:
         self.update_state()
 
-        process = subprocess.run(self.config.revert_cmds)
+        def on_exit(return_code: int) -> None:
+            self.refresh_slots()
 
-        if process.returncode == 0:
-            self.post_trigger(Trigger("rauc_revert_success"))
-        else:
-            self.post_trigger(Trigger("rauc_revert_failed", "error trying to revert to the other firmware"))
+            if return_code == 0:
+                self.post_trigger(Trigger("rauc_revert_success"))
+            else:
+                self.post_trigger(Trigger("rauc_revert_failed", "error trying to revert to the other firmware"))
+
+        self.start_worker(Worker(self.config.revert_cmds, None, on_exit, self.config.worker_kill_timeout_s))
+
+    def refresh_slots(self) -> None:
+        # Even a command that failed may have left the slots changed.
+        if self.inventory is not None:
+            self.inventory.refresh_slots()
 
     def on_enter_reboot(self, data: any) -> None:
         self.update_state()
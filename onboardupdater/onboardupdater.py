@@ -1,16 +1,19 @@
 from http.server import HTTPServer
-import logging
 import threading
 
 from .configuration import Configuration
+from .logsetup import setup_logging
 from .requesthandler import RequestHandler
+from .server import BoundedThreadingHTTPServer
 from .staterunner import StateRunner
 
 
 class OnboardUpdater:
     """
     This class creates the multi-threading model.  A worker thread is used to run the
-    state machine while the main thread is given over to the HTTP server.
+    state machine while the main thread is given over to the HTTP server.  By default the
+    HTTP server itself hands each connection to a thread of its own so that status queries
+    are answered while an upload is in flight.
     """
 
     def __init__(self, config: Configuration):
@@ -21,7 +24,11 @@ class OnboardUpdater:
         def request_handler(*args):
             RequestHandler(self.config, self.state_runner, *args)
 
-        self.server = HTTPServer((config.hostname, config.server_port), request_handler)
+        address = (config.hostname, config.server_port)
+        if config.server_threaded:
+            self.server = BoundedThreadingHTTPServer(address, request_handler, config.server_max_connections)
+        else:
+            self.server = HTTPServer(address, request_handler)
 
     def start(self) -> None:
         # By setting daemon=True, the worker thread will be terminated automatically when the
@@ -44,7 +51,10 @@ def main() -> None:
 
     config = Configuration()
 
-    logging.basicConfig(filename=config.log_path, level=config.log_level)
+    listener = setup_logging(config)
 
-    ou = OnboardUpdater(config)
-    ou.start()
+    try:
+        ou = OnboardUpdater(config)
+        ou.start()
+    finally:
+        listener.stop()
@@ -0,0 +1,262 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+from threading import Condition, Thread
+from typing import Callable, List, Optional, Tuple
+from uuid import uuid4
+
+from .configuration import Configuration
+
+
+class PipelineAbortedError(Exception):
+    """
+    Raised to whoever is writing or reading a pipelined bundle once the pipelined install
+    is over, whether it was cancelled or failed.
+    """
+
+
+class PipelinedBundle:
+    """
+    A bundle that is installed while it is still arriving.  Writers say which ranges of the
+    file at path they have written and readers wait for the ranges they need.  Ranges may
+    arrive in any order, so a client can send the end of the bundle first, which is where
+    RAUC looks for the signature.
+
+    A temporary bundle is a staging file that belongs to the state machine and is removed if
+    the install doesn't go ahead; otherwise the file belongs to an upload session until the
+    session is committed and hands it over.
+    """
+
+    def __init__(self, path: str, size: int, temporary: bool):
+        self.path = path
+        self.size = size
+        self.temporary = temporary
+        # Sorted, non-overlapping [start, end) ranges that have been written.
+        self.ranges: List[List[int]] = []
+        self.aborted = False
+        self.changed = Condition()
+
+    def add(self, start: int, end: int) -> None:
+        with self.changed:
+            merged = [start, end]
+            ranges = []
+
+            for existing in self.ranges:
+                if existing[1] < merged[0] or existing[0] > merged[1]:
+                    ranges.append(existing)
+                else:
+                    merged = [min(existing[0], merged[0]), max(existing[1], merged[1])]
+
+            ranges.append(merged)
+            ranges.sort()
+            self.ranges = ranges
+            self.changed.notify_all()
+
+    def has(self, start: int, end: int) -> bool:
+        return any(existing[0] <= start and end <= existing[1] for existing in self.ranges)
+
+    def get_contiguous(self) -> int:
+        """
+        Returns how much of the bundle, from the start, has been written.
+        """
+
+        with self.changed:
+            if self.ranges and self.ranges[0][0] == 0:
+                return self.ranges[0][1]
+
+            return 0
+
+    def wait_for(self, start: int, end: int, timeout_s: float) -> None:
+        """
+        Waits until the range has been written.  Raises PipelineAbortedError if the install
+        is over and TimeoutError if the range doesn't arrive within timeout_s.
+        """
+
+        with self.changed:
+            if not self.changed.wait_for(lambda: self.aborted or self.has(start, end), timeout_s):
+                raise TimeoutError(f"Bytes {start}-{end - 1} didn't arrive in time")
+
+            if self.aborted:
+                raise PipelineAbortedError()
+
+    def hand_over(self) -> bool:
+        """
+        Makes the bundle the state machine's to remove, once the upload session that wrote
+        it has been committed.  Returns False if the install is already over, in which case
+        the session keeps it.
+        """
+
+        with self.changed:
+            if self.aborted:
+                return False
+
+            self.temporary = True
+            return True
+
+    def abort(self) -> None:
+        with self.changed:
+            self.aborted = True
+            self.changed.notify_all()
+
+    def track(self, start: int, progress: Optional[Callable[[int], None]] = None) -> Callable[[int], None]:
+        """
+        Returns a progress callback for stream_to_file that marks what has been written
+        from start as it is written, and stops the write once the install is over.
+        """
+
+        def on_progress(written: int) -> None:
+            if self.aborted:
+                raise PipelineAbortedError()
+
+            self.add(start, start + written)
+
+            if progress is not None:
+                progress(written)
+
+        return on_progress
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the first and last byte of a single "bytes=" range, None if there is no range
+    or it isn't one we handle (so the whole bundle is served), or raises ValueError if it
+    can't be satisfied.
+    """
+
+    if value is None:
+        return None
+
+    unit, _, spec = value.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+
+    first, _, last = spec.strip().partition("-")
+
+    try:
+        if first == "":
+            # A suffix range: the last n bytes.
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+    if start >= size or start > end:
+        raise ValueError(f"Unsatisfiable range '{value}'")
+
+    return start, end
+
+
+class BundleRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves a pipelined bundle to the installer, with Range support.  A range that hasn't
+    fully arrived yet is sent as it comes in; if the install is over first, the connection
+    is dropped part way through the response.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, config: Configuration, bundle: PipelinedBundle, route: str, *args):
+        self.config = config
+        self.bundle = bundle
+        self.route = route
+        BaseHTTPRequestHandler.__init__(self, *args)
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f"Bundle server: {format % args}")
+
+    def do_HEAD(self):
+        self.serve(False)
+
+    def do_GET(self):
+        self.serve(True)
+
+    def serve(self, send_body: bool) -> None:
+        if self.path != self.route:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = self.bundle.size
+
+        try:
+            byte_range = parse_range(self.headers["range"], size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if send_body:
+            self.send_range(start, end)
+
+    def send_range(self, start: int, end: int) -> None:
+        try:
+            fd = os.open(self.bundle.path, os.O_RDONLY)
+        except OSError:
+            logging.error(f"Unable to open '{self.bundle.path}' to serve it")
+            self.close_connection = True
+            return
+
+        try:
+            position = start
+
+            while position <= end:
+                n = min(self.config.upload_chunk_size, end + 1 - position)
+                self.bundle.wait_for(position, position + n, self.config.pipeline_stall_timeout_s)
+                self.wfile.write(os.pread(fd, n, position))
+                position += n
+        except (PipelineAbortedError, TimeoutError, OSError) as e:
+            # The response can't be finished, so the only way to tell the installer is to
+            # drop the connection.
+            logging.debug(f"Bundle server: stopped serving bytes {start}-{end}; {e!r}")
+            self.close_connection = True
+        finally:
+            os.close(fd)
+
+
+class BundleServer:
+    """
+    An HTTP server on a loopback port of its own that serves a pipelined bundle to RAUC's
+    streaming installer.  The bundle is served under a random name so that nothing else
+    on the device stumbles onto it.
+    """
+
+    def __init__(self, config: Configuration, bundle: PipelinedBundle):
+        self.bundle = bundle
+        self.route = f"/{uuid4().hex}.raucb"
+
+        def request_handler(*args):
+            BundleRequestHandler(config, bundle, self.route, *args)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), request_handler)
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def get_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{self.route}"
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        # Wake any request waiting on bytes that will now never come, then stop listening.
+        self.bundle.abort()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,232 @@
+from abc import ABC, abstractmethod
+from collections import deque
+import logging
+import socket
+from threading import Thread
+import time
+from typing import Callable, Optional
+
+from .configuration import Configuration
+from .rauc import RaucProgressParser
+from .throttle import apply_cgroup, get_priority_cmds
+from .worker import Worker
+
+# jeepney is optional; it is only needed to follow an install over D-Bus.
+try:
+    from jeepney import DBusAddress, HeaderFields, MatchRule, MessageType, Properties, new_method_call
+    from jeepney.bus_messages import message_bus
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+
+class ProgressSource(ABC):
+    """
+    Runs a RAUC install and follows how it is going.  on_status is called with a string
+    suitable for the rauc_state member of the Status class whenever the progress changes,
+    and on_exit with 0 or an error code when the install is over.  Like a Worker, the
+    install is followed from a thread of its own and a cancelled source never calls
+    on_exit.
+
+    Sources also note when the first and latest progress percentages arrived, for timing
+    the install.
+    """
+
+    def __init__(
+        self,
+        config: Configuration,
+        path: str,
+        on_status: Callable[[str], None],
+        on_exit: Callable[[int, str], None],
+    ):
+        self.config = config
+        self.path = path
+        self.on_status = on_status
+        self.on_exit = on_exit
+        self.first_percent_time = None
+        self.last_percent_time = None
+
+    @abstractmethod
+    def start(self) -> None:
+        pass
+
+    @abstractmethod
+    def cancel(self) -> None:
+        pass
+
+    def report(self, status: str, has_percent: bool) -> None:
+        if has_percent:
+            self.last_percent_time = time.monotonic()
+            if self.first_percent_time is None:
+                self.first_percent_time = self.last_percent_time
+
+        self.on_status(status)
+
+    def get_install_duration(self) -> Optional[float]:
+        if self.first_percent_time is None:
+            return None
+
+        return self.last_percent_time - self.first_percent_time
+
+
+class StdoutProgressSource(ProgressSource):
+    """
+    Runs "rauc install" and parses the progress from its stdout.
+    """
+
+    def __init__(self, *args):
+        ProgressSource.__init__(self, *args)
+        self.parser = RaucProgressParser()
+        self.worker = Worker(
+            get_priority_cmds(self.config) + self.config.update_cmds + [self.path],
+            self.on_output,
+            self.on_worker_exit,
+            self.config.worker_kill_timeout_s,
+            lambda pid: apply_cgroup(self.config, pid),
+        )
+
+    def start(self) -> None:
+        self.on_status(self.parser.status())
+        self.worker.start()
+
+    def cancel(self) -> None:
+        self.worker.cancel()
+
+    def on_output(self, line: str) -> None:
+        self.parser.feed(line)
+        self.report(self.parser.status(), self.parser.last_line_has_percent)
+
+    def on_worker_exit(self, return_code: int) -> None:
+        self.on_exit(return_code, self.parser.status())
+
+
+class DBusProgressSource(ProgressSource):
+    """
+    Asks the RAUC service to install the bundle over D-Bus and follows the install through
+    the service's Progress and LastError properties and its Completed signal, so nothing
+    depends on the wording of the command line tool's output.  Needs jeepney.
+
+    RAUC has no way to cancel an install over D-Bus; cancelling stops following it, which
+    is no different from killing "rauc install".
+    """
+
+    bus_name = "de.pengutronix.rauc"
+    interface = "de.pengutronix.rauc.Installer"
+
+    def __init__(self, *args):
+        ProgressSource.__init__(self, *args)
+        self.installer = DBusAddress("/", bus_name=self.bus_name, interface=self.interface)
+        self.connection = None
+        self.cancelled = False
+        self.last_error = ""
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.on_status(f"{RaucProgressParser.in_progress}: starting")
+        # There is no child to move into the cgroup but its limits still apply to the service.
+        apply_cgroup(self.config)
+        self.thread.start()
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+        # Shutting the socket down wakes the thread if it is waiting for a signal.
+        if self.connection is not None:
+            try:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self) -> None:
+        try:
+            self.connection = open_dbus_connection(self.config.rauc_dbus_bus)
+        except (OSError, ValueError, KeyError):
+            logging.error(f"Unable to connect to the D-Bus {self.config.rauc_dbus_bus} bus")
+            self.finish(-1, f"{RaucProgressParser.failed}: unable to connect to rauc")
+            return
+
+        # Don't start an install that has already been cancelled.
+        if self.cancelled:
+            self.connection.close()
+            return
+
+        try:
+            result = self.install()
+        except OSError:
+            # Either cancelled or the bus went away.
+            self.last_error = "lost connection to rauc"
+            result = -1
+        finally:
+            self.connection.close()
+
+        if result == 0:
+            self.finish(0, RaucProgressParser.success)
+        elif self.last_error:
+            self.finish(result, f"{RaucProgressParser.failed}: {self.last_error.lower()}")
+        else:
+            self.finish(result, RaucProgressParser.failed)
+
+    def install(self) -> int:
+        """
+        Starts the install and returns its result once it has completed, or -1 if RAUC
+        refused it.
+        """
+
+        # Listen before asking for the install so no signal can be missed.  The bus matches
+        # the sender by its well-known name; locally signals carry RAUC's unique name so
+        # only the path is matched.
+        rule = MatchRule(type="signal", sender=self.bus_name, path="/")
+        self.connection.send_and_get_reply(message_bus.AddMatch(rule))
+
+        with self.connection.filter(MatchRule(type="signal", path="/"), queue=deque()) as signals:
+            reply = self.connection.send_and_get_reply(
+                new_method_call(self.installer, "InstallBundle", "sa{sv}", (self.path, {}))
+            )
+            if reply.header.message_type == MessageType.error:
+                self.last_error = str(reply.body[0]) if reply.body else "install refused"
+                return -1
+
+            while True:
+                signal = self.connection.recv_until_filtered(signals)
+                member = signal.header.fields.get(HeaderFields.member)
+
+                if member == "PropertiesChanged" and signal.body[0] == self.interface:
+                    self.on_properties_changed(signal.body[1])
+                elif member == "Completed":
+                    result = signal.body[0]
+                    if result != 0 and not self.last_error:
+                        self.last_error = self.get_property("LastError")
+                    return result
+
+    def on_properties_changed(self, changed: dict) -> None:
+        if "LastError" in changed:
+            self.last_error = changed["LastError"][1]
+
+        if "Progress" in changed:
+            # Progress is (percentage, message, depth).
+            percent, _, _ = changed["Progress"][1]
+            # Formatted as "rauc install" prints it, so the status looks the same either way.
+            self.report(f"{RaucProgressParser.in_progress}: {percent:3d}%", True)
+
+    def get_property(self, name: str) -> str:
+        reply = self.connection.send_and_get_reply(Properties(self.installer).get(name))
+        if reply.header.message_type == MessageType.error:
+            return ""
+
+        return reply.body[0][1]
+
+    def finish(self, return_code: int, status: str) -> None:
+        if not self.cancelled:
+            self.on_exit(return_code, status)
+
+
+def create_progress_source(
+    config: Configuration, path: str, on_status: Callable[[str], None], on_exit: Callable[[int, str], None]
+) -> ProgressSource:
+    if config.progress_source == "dbus":
+        if open_dbus_connection is not None:
+            return DBusProgressSource(config, path, on_status, on_exit)
+
+        logging.error("jeepney is not installed; following the install through rauc's output instead")
+
+    return StdoutProgressSource(config, path, on_status, on_exit)
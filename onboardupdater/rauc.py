@@ -1,10 +1,19 @@
-from typing import List
+from typing import List, Optional
 
 
-def get_rauc_status(lines: List) -> str:
+class RaucProgressParser:
     """
-    Takes a list of lines read from stdout being produced by the "rauc install" command
-    and produces a string suitable for setting in the rauc_state member of the Status class.
+    Parses the stdout of the "rauc install" command one line at a time.  Each line is
+    handled in constant time and only the latest progress is kept, so memory doesn't grow
+    with the length of the install log.
+
+    RAUC prints a line when a step starts ("Checking bundle") and another when it ends
+    ("Checking bundle done." or "Checking bundle failed."); depth tracks how many steps
+    are currently open.
+
+    The status strings are the ones clients have always seen: the percentage is shown as
+    RAUC printed it, padding and all (e.g. "in progress:  40%"), and the first LastError is
+    reported once the install has failed.
 
     See the "mock_rauc_[success|failed].sh" files to get an idea of what the RAUC
     stdout looks like.
@@ -14,26 +23,83 @@ def get_rauc_status(lines: List) -> str:
     success = "success"
     failed = "failed"
 
-    if len(lines) == 0:
-        return f"{in_progress}: starting"
+    def __init__(self):
+        self.percent: Optional[int] = None
+        # The text before the "%" on the latest progress line.
+        self.percent_text = ""
+        self.phase = ""
+        self.depth = 0
+        self.last_error = ""
+        self.succeeded = False
+        self.has_failed = False
+        self.line_count = 0
+        self.last_line_has_percent = False
 
-    last_line = lines[-1]
+    def feed(self, line: str) -> None:
+        self.line_count += 1
+        self.last_line_has_percent = False
+        self.succeeded = False
+        self.has_failed = False
 
-    # Figure out if there is a % value in the string.
-    percent_tokens = last_line.split("%")
-    if len(percent_tokens) > 1:
-        return f"{in_progress}: {percent_tokens[0]}%"
+        if line.startswith("LastError: "):
+            if not self.last_error:
+                self.last_error = line[11:]
+            # RAUC only reports an error once the install has failed.
+            self.has_failed = True
+            return
 
-    if "succeeded" in last_line:
-        return f"{success}"
+        # Progress lines look like " 40% Checking bundle done."
+        percent, sep, phase = line.partition("%")
+        if sep:
+            self.percent_text = percent
+            self.last_line_has_percent = True
 
-    if "failed" not in last_line:
-        return f"{in_progress}: pending"
+            if percent.strip().isdigit():
+                self.percent = int(percent)
+                self.phase = phase.strip()
 
-    for line in lines:
-        if "LastError: " not in line or "LastError: " != line[0:11]:
-            continue
+                if self.phase.endswith(" done.") or self.phase.endswith(" failed."):
+                    self.depth = max(self.depth - 1, 0)
+                else:
+                    self.depth += 1
+            return
+
+        if "succeeded" in line:
+            self.succeeded = True
+        elif "failed" in line:
+            self.has_failed = True
+
+    def status(self) -> str:
+        """
+        Produces a string suitable for setting in the rauc_state member of the Status class.
+        """
+
+        if self.line_count == 0:
+            return f"{self.in_progress}: starting"
+
+        if self.last_line_has_percent:
+            return f"{self.in_progress}: {self.percent_text}%"
+
+        if self.succeeded:
+            return f"{self.success}"
 
-        return f"{failed}: {line[11:].lower()}"
+        if not self.has_failed:
+            return f"{self.in_progress}: pending"
+
+        if self.last_error:
+            return f"{self.failed}: {self.last_error.lower()}"
+
+        return f"{self.failed}"
+
+
+def get_rauc_status(lines: List) -> str:
+    """
+    Takes a list of lines read from stdout being produced by the "rauc install" command
+    and produces a string suitable for setting in the rauc_state member of the Status class.
+    """
+
+    parser = RaucProgressParser()
+    for line in lines:
+        parser.feed(line)
 
-    return f"{failed}"
+    return parser.status()
@@ -1,64 +1,847 @@
+import hashlib
 from http.server import BaseHTTPRequestHandler
 from json import dumps, loads
+import logging
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
 
+from .body import DecodeError, LengthReader, connection_errors, open_body, open_decoder
+from .chunkstore import ChunkManifest, is_sha256
 from .configuration import Configuration
-from .response import BadRouteResponse, NoDataResponse
+from .fetch import FetchRequest
+from .pipeline import PipelineAbortedError, PipelinedBundle
+from .response import (
+    BadRouteResponse,
+    ChunkMismatchResponse,
+    ChunkTooLargeResponse,
+    IncompleteDataResponse,
+    InsufficientStorageResponse,
+    InvalidDigestResponse,
+    InvalidFetchRequestResponse,
+    InvalidManifestResponse,
+    InvalidParameterResponse,
+    InvalidRangeResponse,
+    InvalidUpdateStateResponse,
+    ManifestTooLargeResponse,
+    MissingChunksResponse,
+    NoDataResponse,
+    NoManifestResponse,
+    NoUploadSessionResponse,
+    NotModifiedResponse,
+    SuccessResonse,
+    TooManySubscribersResponse,
+    UndecodableDataResponse,
+    UnsupportedEncodingResponse,
+    UpdateAbortedResponse,
+    UploadInProgressResponse,
+    UploadIncompleteResponse,
+    WriteFailedResponse,
+)
+from .staging import create_staging_file, has_free_space, remove_file
 from .staterunner import Response, StateRunner
+from .throttle import WriteThrottle
+from .upload import (
+    StreamInterruptedError,
+    UpdateFile,
+    UploadProgress,
+    UploadSession,
+    get_expected_sha256,
+    stream_to_file,
+)
+
+
+# Routes we report metrics for.  Anything else is lumped together so that clients can't
+# make up new metric labels.
+metric_routes = [
+    "/bootstate",
+    "/cancel",
+    "/history",
+    "/install",
+    "/metrics",
+    "/revert",
+    "/slots",
+    "/status",
+    "/status/stream",
+    "/update",
+    "/update/assemble",
+    "/update/fetch",
+    "/update/manifest",
+    "/upload",
+    "/version",
+]
+
+
+def get_route_label(route: str) -> str:
+    if route.startswith("/update/chunk/"):
+        return "/update/chunk/{sha256}"
+    if route.startswith("/upload/"):
+        return "/upload/{id}/commit" if route.endswith("/commit") else "/upload/{id}"
+
+    return route if route in metric_routes else "other"
 
 
 class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Connections are kept open between requests (HTTP/1.1) so that a client polling the
+    status doesn't pay for a new TCP connection each time.  A connection is closed once it
+    has been idle for server_idle_timeout_s, after server_max_requests_per_connection
+    requests, or whenever a request body hasn't been read to the end, since what is left of
+    it can't be told apart from the next request.
+
+    Responses are written through a buffer and flushed once the request is handled, so the
+    headers and body of a response normally go out in a single write.
+    """
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
     def __init__(self, config: Configuration, state_runner: StateRunner, *args):
         self.config = config
         self.state_runner = state_runner
+        self.timeout = config.server_idle_timeout_s
+        self.requests_handled = 0
         BaseHTTPRequestHandler.__init__(self, *args)
 
+    def log_message(self, format: str, *args) -> None:
+        # The base class writes straight to stderr; send requests through the logging queue
+        # instead so a slow disk or terminal never holds up a response.
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def log_error(self, format: str, *args) -> None:
+        # Idle keep-alive connections timing out are nothing to worry about.
+        level = logging.DEBUG if format.startswith("Request timed out") else logging.WARNING
+        logging.log(level, f"{self.address_string()} {format % args}")
+
     def end_headers(self) -> None:
         self.send_header('Access-Control-Allow-Origin', '*')
+        if self.close_connection:
+            self.send_header("Connection", "close")
         return super().end_headers()
 
+    def handle_expect_100(self) -> bool:
+        # Make sure "100 Continue" isn't left sitting in the write buffer while the client
+        # waits for it before sending the body.
+        result = BaseHTTPRequestHandler.handle_expect_100(self)
+        self.wfile.flush()
+        return result
+
+    def parse_path(self) -> None:
+        self.request_start = time.monotonic()
+        url = urlsplit(self.path)
+        self.route = url.path
+        self.query = parse_qs(url.query, keep_blank_values=True)
+
+        # A request without Content-Length or Transfer-Encoding has no body.  One with a body
+        # we can't find the end of leaves the connection unusable.
+        self.body = open_body(self.rfile, self.headers)
+        if self.body is None and (
+            self.headers["content-length"] is not None or self.headers["transfer-encoding"] is not None
+        ):
+            self.close_connection = True
+
+        # Without a thread per connection an idle connection would hold up everyone else.
+        self.requests_handled += 1
+        if self.requests_handled >= self.config.server_max_requests_per_connection or not self.config.server_threaded:
+            self.close_connection = True
+
     def do_GET(self):
-        if self.path == "/version":
+        self.parse_path()
+
+        if self.route == "/version":
             self.respond(self.state_runner.get_version())
-        elif self.path == "/status":
-            self.respond(self.state_runner.get_status())
+        elif self.route == "/slots":
+            self.respond(self.state_runner.get_slots())
+        elif self.route == "/history":
+            self.respond(self.get_history())
+        elif self.route == "/metrics":
+            self.respond(self.state_runner.get_metrics())
+        elif self.route == "/status":
+            if "wait" in self.query:
+                self.respond(self.wait_for_status())
+            else:
+                self.respond(self.state_runner.get_status())
+        elif self.route == "/status/stream":
+            self.stream_status()
+        elif self.route.startswith("/upload/"):
+            self.respond(self.get_upload_session(self.route[8:]))
         else:
             self.respond(BadRouteResponse())
 
     def do_POST(self):
-        if self.path == "/update":
-            length = self.headers["content-length"]
+        self.parse_path()
 
-            # length here is a string.
-            if length is None or length == "0":
+        if self.route == "/update":
+            body = self.body
+
+            if body is None or (isinstance(body, LengthReader) and body.remaining <= 0):
                 self.respond(NoDataResponse())
                 return
 
-            data = self.rfile.read(int(length))
-            self.respond(self.state_runner.post_update(data))
-        elif self.path == "/cancel":
+            # Check before touching the disk; if RAUC is installing we must not clobber anything.
+            if not self.state_runner.can_trigger("update"):
+                self.respond(InvalidUpdateStateResponse())
+                return
+
+            self.respond(self.receive_update(body))
+        elif self.route == "/update/fetch":
+            self.respond(self.receive_fetch())
+        elif self.route == "/update/manifest":
+            self.respond(self.receive_manifest())
+        elif self.route == "/update/assemble":
+            self.respond(self.assemble_update())
+        elif self.route == "/upload":
+            self.respond(self.create_upload_session())
+        elif self.route.startswith("/upload/") and self.route.endswith("/commit"):
+            self.respond(self.commit_upload_session(self.route[8:-7]))
+        elif self.route == "/install":
+            self.respond(self.state_runner.post_install())
+        elif self.route == "/cancel":
             self.respond(self.state_runner.post_cancel())
-        elif self.path == "/revert":
+        elif self.route == "/revert":
             self.respond(self.state_runner.post_revert())
-        elif self.path == "/bootstate":
-            length = self.headers["content-length"]
-
-            # length here is a string.
-            if length is None or length == "0":
+        elif self.route == "/bootstate":
+            if self.body is None:
                 # This isn't an error; it allows the client to clear out the state.
                 data = ""
             else:
-                data = self.rfile.read(int(length)).decode("utf-8")
-            
+                data = self.body.read().decode("utf-8")
+
             self.respond(self.state_runner.post_boot_state(data))
         else:
             self.respond(BadRouteResponse())
 
+    def do_PUT(self):
+        self.parse_path()
+
+        if self.route.startswith("/upload/"):
+            self.respond(self.receive_upload_range(self.route[8:]))
+        elif self.route.startswith("/update/chunk/"):
+            self.respond(self.receive_chunk(self.route[14:].lower()))
+        else:
+            self.respond(BadRouteResponse())
+
+    def receive_update(self, body) -> Response:
+        # Only one upload may be streamed at a time; a second one is refused rather than
+        # left to compete for disk bandwidth with the first.
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            return self.stream_update(body)
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def stream_update(self, body) -> Response:
+        try:
+            expected_sha256 = get_expected_sha256(self.headers)
+        except ValueError:
+            return InvalidDigestResponse()
+
+        try:
+            reader = open_decoder(body, self.headers["content-encoding"])
+        except ValueError:
+            return UnsupportedEncodingResponse()
+
+        # Nothing has been read yet so what remains is the whole of Content-Length.  That is
+        # the size of the bundle unless it is compressed, in which case it is still the least
+        # room the bundle will need.  A chunked upload has no declared size.
+        declared_size = body.remaining if isinstance(body, LengthReader) else 0
+        if not has_free_space(self.config.update_write_path, declared_size, self.config.staging_min_free_bytes):
+            return InsufficientStorageResponse()
+
+        size = declared_size if reader is body else None
+
+        if self.is_pipelined():
+            if size:
+                return self.stream_pipelined_update(body, size, expected_sha256)
+
+            # RAUC has to be able to ask for any part of the bundle, so its size must be known.
+            logging.info("Only an uncompressed upload of known size can be pipelined; installing once it is in")
+
+        try:
+            path = create_staging_file(self.config.update_write_path, size)
+        except OSError:
+            logging.error(f"Unable to create a staging file next to '{self.config.update_write_path}'")
+            return WriteFailedResponse()
+
+        progress = UploadProgress(
+            body, self.state_runner.update_upload_progress, self.config.upload_progress_interval_s
+        )
+
+        digest = hashlib.sha256()
+
+        try:
+            written = stream_to_file(
+                reader,
+                path,
+                self.config.upload_chunk_size,
+                # A preallocated file must be written into rather than truncated.
+                offset=0 if size else None,
+                progress=progress,
+                digest=digest,
+                throttle=WriteThrottle(self.config),
+                sync_bytes=self.config.staging_sync_bytes,
+            )
+        except (EOFError, *connection_errors):
+            # The connection dropped, perhaps part way through a compressed stream.
+            written = -1
+        except DecodeError:
+            logging.error("Upload could not be decompressed")
+            remove_file(path)
+            return UndecodableDataResponse()
+        except OSError:
+            logging.error(f"Unable to write upload to '{path}'")
+            remove_file(path)
+            return WriteFailedResponse()
+        finally:
+            progress.finish()
+
+        if written <= 0 or not body.is_complete():
+            logging.error(f"Upload ended after {body.received} bytes")
+            remove_file(path)
+            return IncompleteDataResponse()
+
+        self.state_runner.metrics.upload_throughput.observe(progress.get_rate())
+
+        # A digest mismatch is reported by the state machine so it shows up as the last error.
+        response = self.state_runner.post_update(
+            UpdateFile(path, written, digest.hexdigest(), expected_sha256, self.is_stage_only())
+        )
+        if response.code != 200:
+            remove_file(path)
+
+        return response
+
+    def stream_pipelined_update(self, body, size: int, expected_sha256) -> Response:
+        try:
+            path = create_staging_file(self.config.update_write_path, size)
+        except OSError:
+            logging.error(f"Unable to create a staging file next to '{self.config.update_write_path}'")
+            return WriteFailedResponse()
+
+        bundle = PipelinedBundle(path, size, temporary=True)
+        response = self.state_runner.post_pipeline(bundle)
+        if response.code != 200:
+            remove_file(path)
+            return response
+
+        # From here on the staging file belongs to the state machine, which removes it if the
+        # install doesn't go ahead.
+        progress = UploadProgress(
+            body, self.state_runner.update_upload_progress, self.config.upload_progress_interval_s
+        )
+
+        digest = hashlib.sha256()
+
+        try:
+            # RAUC reads the bundle back as soon as it lands, so it is left in the page cache.
+            written = stream_to_file(
+                body,
+                path,
+                self.config.upload_chunk_size,
+                offset=0,
+                progress=bundle.track(0, progress),
+                digest=digest,
+                throttle=WriteThrottle(self.config),
+            )
+        except PipelineAbortedError:
+            return UpdateAbortedResponse()
+        except connection_errors:
+            written = -1
+        except OSError:
+            logging.error(f"Unable to write upload to '{path}'")
+            self.state_runner.post_pipeline_upload_failed(bundle, "unable to write update file")
+            return WriteFailedResponse()
+        finally:
+            progress.finish()
+
+        if written != size or not body.is_complete():
+            logging.error(f"Pipelined upload ended after {body.received} bytes")
+            self.state_runner.post_pipeline_upload_failed(bundle, "upload ended early")
+            return IncompleteDataResponse()
+
+        self.state_runner.metrics.upload_throughput.observe(progress.get_rate())
+
+        return self.state_runner.post_pipeline_upload(
+            bundle, UpdateFile(path, written, digest.hexdigest(), expected_sha256)
+        )
+
+    def create_upload_session(self) -> Response:
+        try:
+            size = int(self.headers["x-upload-length"])
+        except (TypeError, ValueError):
+            return NoDataResponse()
+
+        if size <= 0:
+            return NoDataResponse()
+
+        try:
+            expected_sha256 = get_expected_sha256(self.headers)
+        except ValueError:
+            return InvalidDigestResponse()
+
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            # A pipelined install reads the staging file as it arrives, so the file can't be
+            # replaced until the install is over.
+            if self.state_runner.is_pipelining():
+                return UploadInProgressResponse()
+
+            pipelined = self.is_pipelined()
+            if pipelined and not self.state_runner.can_trigger("pipeline"):
+                return InvalidUpdateStateResponse()
+
+            # The old session's staging file makes way for the new one.
+            old_session = self.state_runner.upload_session
+            reclaimed = old_session.size if old_session is not None else 0
+            if not has_free_space(self.config.update_write_path, size - reclaimed, self.config.staging_min_free_bytes):
+                return InsufficientStorageResponse()
+
+            # There is only one staging file so a new session replaces any old one.
+            if old_session is not None:
+                old_session.remove()
+                self.state_runner.upload_session = None
+
+            try:
+                session = UploadSession.create(self.config.update_write_path, size, expected_sha256)
+            except OSError:
+                logging.error(f"Unable to create an upload session next to '{self.config.update_write_path}'")
+                return WriteFailedResponse()
+
+            self.state_runner.upload_session = session
+
+            # A pipelined session starts the install straight away and takes its ranges in
+            # any order, so the client can send the end of the bundle first.
+            if pipelined:
+                session.bundle = PipelinedBundle(session.path, size, temporary=False)
+                response = self.state_runner.post_pipeline(session.bundle)
+                if response.code != 200:
+                    session.remove()
+                    self.state_runner.upload_session = None
+                    return response
+
+            return Response(200, session.to_json())
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def get_upload_session(self, id: str) -> Response:
+        session = self.state_runner.upload_session
+        if session is None or session.id != id:
+            return NoUploadSessionResponse()
+
+        return Response(200, session.to_json())
+
+    def receive_upload_range(self, id: str) -> Response:
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            session = self.state_runner.upload_session
+            if session is None or session.id != id:
+                return NoUploadSessionResponse()
+
+            # Content-Range looks like "bytes 0-1023/4096".  Ranges may overlap what we already
+            # have but must not leave a gap.
+            try:
+                unit, _, spec = self.headers["content-range"].partition(" ")
+                span, _, total = spec.partition("/")
+                start, _, end = span.partition("-")
+                start = int(start)
+                length = int(end) - start + 1
+                total_matches = total in ("*", str(session.size))
+            except (AttributeError, ValueError):
+                return InvalidRangeResponse()
+
+            # Should the pipelined install be over, the session carries on as an ordinary one.
+            if session.bundle is not None and session.bundle.aborted:
+                session.bundle = None
+
+            if (
+                unit != "bytes"
+                or not total_matches
+                or (start > session.offset and session.bundle is None)
+                or length <= 0
+                or start + length > session.size
+                or self.headers["content-length"] != str(length)
+            ):
+                return InvalidRangeResponse()
+
+            body = self.body
+            bundle = session.bundle
+
+            try:
+                written = stream_to_file(
+                    body,
+                    session.path,
+                    self.config.upload_chunk_size,
+                    start,
+                    progress=bundle.track(start) if bundle is not None else None,
+                    digest=session.get_range_digest(start),
+                    throttle=WriteThrottle(self.config),
+                    # A pipelined install reads the bundle back straight away.
+                    sync_bytes=self.config.staging_sync_bytes if bundle is None else 0,
+                )
+            except StreamInterruptedError as e:
+                # Whatever was written before the connection dropped still counts; the digest
+                # has had exactly those bytes, so it stays in step with the offset.
+                logging.error(f"Upload range ended after {e.written} bytes")
+                written = e.written
+            except PipelineAbortedError:
+                session.digest = None
+                return UpdateAbortedResponse()
+            except OSError:
+                # We can't tell how much of the range the digest had before the failure.
+                session.digest = None
+                logging.error(f"Unable to write upload range to '{session.path}'")
+                return WriteFailedResponse()
+
+            # With ranges out of order, the offset is how much has arrived without a gap.
+            if bundle is not None:
+                session.offset = bundle.get_contiguous()
+            else:
+                session.offset = max(session.offset, start + written)
+            session.save()
+
+            if written != length:
+                return IncompleteDataResponse()
+
+            return Response(200, session.to_json())
+        except OSError:
+            logging.error(f"Unable to save upload session {session.id}")
+            return WriteFailedResponse()
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def commit_upload_session(self, id: str) -> Response:
+        try:
+            expected_sha256 = get_expected_sha256(self.headers)
+        except ValueError:
+            return InvalidDigestResponse()
+
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            session = self.state_runner.upload_session
+            if session is None or session.id != id:
+                return NoUploadSessionResponse()
+
+            if not session.is_complete():
+                return UploadIncompleteResponse()
+
+            # A digest given at commit takes precedence over one given when the session started.
+            try:
+                sha256 = session.get_sha256(self.config.upload_chunk_size, self.config.staging_sync_bytes > 0)
+            except OSError:
+                logging.error(f"Unable to read back '{session.path}'")
+                return WriteFailedResponse()
+
+            update = UpdateFile(
+                session.path, session.size, sha256, expected_sha256 or session.expected_sha256, self.is_stage_only()
+            )
+
+            if session.bundle is not None and not session.bundle.aborted:
+                response = self.state_runner.post_pipeline_upload(session.bundle, update)
+            else:
+                response = self.state_runner.post_update(update)
+            if response.code == 200:
+                # The staging file now belongs to the state machine.
+                session.close()
+                self.state_runner.upload_session = None
+
+            return response
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def receive_fetch(self) -> Response:
+        if self.body is None:
+            return NoDataResponse()
+
+        try:
+            request = FetchRequest.from_json(loads(self.body.read()), self.is_stage_only())
+        except ValueError:
+            return InvalidFetchRequestResponse()
+
+        return self.state_runner.post_fetch(request)
+
+    def receive_manifest(self) -> Response:
+        if self.body is None:
+            return NoDataResponse()
+
+        data = self.read_body(self.config.chunk_manifest_max_bytes)
+        if data is None:
+            return ManifestTooLargeResponse()
+
+        try:
+            manifest = ChunkManifest.from_json(loads(data))
+        except ValueError:
+            return InvalidManifestResponse()
+
+        # As with upload sessions there is only one delta upload at a time, so a new manifest
+        # replaces any old one.
+        self.state_runner.chunk_manifest = manifest
+        return Response(200, dumps({"missing": self.state_runner.chunk_store.get_missing(manifest)}))
+
+    def read_body(self, max_bytes: int) -> Optional[bytes]:
+        """
+        Reads the whole body into memory, or returns None once it turns out to be longer than
+        max_bytes.
+        """
+
+        data = bytearray()
+
+        while True:
+            piece = self.body.read(max_bytes + 1 - len(data))
+            if not piece:
+                return bytes(data)
+
+            data += piece
+            if len(data) > max_bytes:
+                return None
+
+    def receive_chunk(self, sha256: str) -> Response:
+        if not is_sha256(sha256):
+            return BadRouteResponse()
+
+        try:
+            length = int(self.headers["content-length"])
+        except (TypeError, ValueError):
+            return NoDataResponse()
+
+        if length <= 0:
+            return NoDataResponse()
+
+        if length > self.config.chunk_max_bytes:
+            return ChunkTooLargeResponse()
+
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            body = self.body
+
+            try:
+                size = self.state_runner.chunk_store.put(
+                    sha256, body, self.config.upload_chunk_size, WriteThrottle(self.config)
+                )
+            except OSError:
+                logging.error(f"Unable to write chunk {sha256}")
+                return WriteFailedResponse()
+
+            if not body.is_complete():
+                return IncompleteDataResponse()
+
+            if size is None:
+                return ChunkMismatchResponse()
+
+            self.state_runner.chunk_store.evict(self.state_runner.chunk_manifest)
+            return SuccessResonse()
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def assemble_update(self) -> Response:
+        manifest = self.state_runner.chunk_manifest
+        if manifest is None:
+            return NoManifestResponse()
+
+        if not self.state_runner.can_trigger("update"):
+            return InvalidUpdateStateResponse()
+
+        if not self.state_runner.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            if self.state_runner.chunk_store.get_missing(manifest):
+                return MissingChunksResponse()
+
+            size = self.state_runner.chunk_store.get_size(manifest)
+            if not has_free_space(self.config.update_write_path, size, self.config.staging_min_free_bytes):
+                return InsufficientStorageResponse()
+
+            try:
+                path = create_staging_file(self.config.update_write_path, size)
+            except OSError:
+                logging.error(f"Unable to create a staging file next to '{self.config.update_write_path}'")
+                return WriteFailedResponse()
+
+            digest = hashlib.sha256()
+
+            try:
+                written = self.state_runner.chunk_store.assemble(
+                    manifest,
+                    path,
+                    self.config.upload_chunk_size,
+                    digest,
+                    WriteThrottle(self.config),
+                    self.config.staging_sync_bytes,
+                )
+            except KeyError:
+                remove_file(path)
+                return MissingChunksResponse()
+            except OSError:
+                logging.error(f"Unable to assemble bundle in '{path}'")
+                remove_file(path)
+                return WriteFailedResponse()
+
+            self.state_runner.update_upload_progress(0, written, 0)
+
+            response = self.state_runner.post_update(
+                UpdateFile(path, written, digest.hexdigest(), manifest.sha256, self.is_stage_only())
+            )
+            if response.code != 200:
+                remove_file(path)
+                return response
+
+            self.state_runner.chunk_manifest = None
+            self.state_runner.chunk_store.evict(manifest)
+            return response
+        finally:
+            self.state_runner.upload_lock.release()
+
+    def get_history(self) -> Response:
+        try:
+            seq = int(self.query.get("since", ["0"])[-1])
+        except ValueError:
+            return InvalidParameterResponse()
+
+        if seq < 0:
+            return InvalidParameterResponse()
+
+        return self.state_runner.get_history(seq)
+
+    def wait_for_status(self) -> Response:
+        try:
+            version = int(self.query["wait"][-1])
+        except ValueError:
+            return InvalidParameterResponse()
+
+        if not self.state_runner.subscriber_slots.acquire(blocking=False):
+            return TooManySubscribersResponse()
+
+        try:
+            return self.state_runner.get_status(version)
+        finally:
+            self.state_runner.subscriber_slots.release()
+
+    def stream_status(self) -> None:
+        """
+        Sends the status as a server-sent event whenever it changes, for as long as the
+        client stays connected.  Intermediate changes are skipped if the client can't keep
+        up; each event is always the latest status.
+        """
+
+        if not self.state_runner.subscriber_slots.acquire(blocking=False):
+            self.respond(TooManySubscribersResponse())
+            return
+
+        try:
+            # The stream has no length so it ends when the connection does.
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+
+            version = self.get_last_event_version()
+
+            while True:
+                new_version, json = self.state_runner.wait_for_status(
+                    version, self.config.status_stream_keepalive_s
+                )
+
+                if new_version == version:
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    version = new_version
+                    event_id = self.state_runner.get_status_tag(version).encode()
+                    self.wfile.write(b"id: %s\nevent: status\ndata: %s\n\n" % (event_id, json))
+
+                self.wfile.flush()
+        except OSError:
+            # The client went away.
+            pass
+        finally:
+            self.state_runner.subscriber_slots.release()
+
+        self.record_request(200)
+
+    def get_last_event_version(self) -> int:
+        # A reconnecting client tells us the last event it saw; if it is from this process
+        # we only need to send it something newer.
+        last_event_id = self.headers["last-event-id"]
+        if last_event_id is not None:
+            version = self.state_runner.get_status_version(last_event_id.strip())
+            if version is not None:
+                return version
+
+        return -1
+
+    def get_flag(self, name: str) -> bool:
+        # A flag is set by "?name" on its own or with any value other than 0 or false.
+        values = self.query.get(name)
+        return values is not None and values[-1].lower() not in ("0", "false")
+
+    def is_pretty(self) -> bool:
+        return self.get_flag("pretty")
+
+    def is_stage_only(self) -> bool:
+        return self.config.install_mode == "staged" or self.get_flag("stage")
+
+    def is_pipelined(self) -> bool:
+        return (self.config.install_mode == "pipelined" or self.get_flag("pipeline")) and not self.get_flag("stage")
+
+    def is_not_modified(self, etag: str) -> bool:
+        if_none_match = self.headers["if-none-match"]
+        if if_none_match is None:
+            return False
+
+        # If-None-Match uses the weak comparison so ignore any W/ prefix.
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
     def respond(self, response: Response) -> None:
+        json = response.json
+        etag = response.etag
+
+        # Pretty print on request in case we're using curl or something to test.
+        if self.is_pretty() and json and response.content_type == "application/json":
+            json = dumps(loads(json), indent=2)
+            if etag is not None:
+                etag = f'{etag[:-1]}-pretty"'
+
+        if etag is not None and self.is_not_modified(etag):
+            response = NotModifiedResponse(etag)
+            json = ""
+
+        if isinstance(json, str):
+            json = json.encode(encoding="utf_8")
+
+        # Whatever is left of an unread body would be taken for the next request.
+        if self.body is not None and not self.body.is_complete():
+            self.close_connection = True
+
         self.send_response(response.code)
-        self.send_header("Content-type", "application/json")
+        if json:
+            self.send_header("Content-type", response.content_type)
+        if response.code != 304:
+            self.send_header("Content-Length", str(len(json)))
+        if etag is not None:
+            self.send_header("ETag", etag)
+        for name, value in response.headers.items():
+            self.send_header(name, value)
         self.end_headers()
 
-        # Pretty print in case we're using curl or something to test.  All our
-        # JSON is pretty minimal so this doesn't hurt.
-        pretty_json = dumps(loads(response.json), indent=2)
-        self.wfile.write(pretty_json.encode(encoding="utf_8"))
+        self.wfile.write(json)
+
+        self.record_request(response.code)
+
+    def record_request(self, code: int) -> None:
+        route = get_route_label(self.route)
+        self.state_runner.metrics.requests.inc(self.command, route, str(code))
+        self.state_runner.metrics.request_duration.observe(
+            time.monotonic() - self.request_start, self.command, route
+        )
@@ -1,7 +1,12 @@
 class Response:
-    def __init__(self, code, json):
+    def __init__(self, code, json, etag=None, headers=None, content_type="application/json"):
         self.code = code
+        # Either a str or pre-encoded UTF-8 bytes.  Despite the name, this is only JSON if
+        # the content type says so.
         self.json = json
+        self.etag = etag
+        self.headers = headers or {}
+        self.content_type = content_type
 
 
 class SuccessResonse(Response):
@@ -9,6 +14,11 @@ class SuccessResonse(Response):
         Response.__init__(self, 200, '{"response": "success"}')
 
 
+class NotModifiedResponse(Response):
+    def __init__(self, etag):
+        Response.__init__(self, 304, "", etag)
+
+
 class ErrorResponse(Response):
     def __init__(self, code, error_string):
         Response.__init__(self, code, f'{{"response": "{error_string}"}}')
@@ -24,11 +34,26 @@ class NoVersionResponse(ErrorResponse):
         ErrorResponse.__init__(self, 500, "no version found")
 
 
+class NoHistoryResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 404, "no history kept")
+
+
+class NoSlotsResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 500, "no slot information")
+
+
 class InvalidUpdateStateResponse(ErrorResponse):
     def __init__(self):
         ErrorResponse.__init__(self, 403, "invalid state for update")
 
 
+class InvalidInstallStateResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 403, "invalid state for install")
+
+
 class InvalidCancelStateResponse(ErrorResponse):
     def __init__(self):
         ErrorResponse.__init__(self, 403, "invalid state for cancel")
@@ -42,3 +67,103 @@ class InvalidRevertStateResponse(ErrorResponse):
 class NoDataResponse(ErrorResponse):
     def __init__(self):
         ErrorResponse.__init__(self, 400, "no data provided")
+
+
+class IncompleteDataResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "incomplete data")
+
+
+class WriteFailedResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 500, "unable to write update file")
+
+
+class InsufficientStorageResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 507, "insufficient storage")
+
+
+class UpdateAbortedResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 409, "update aborted")
+
+
+class UploadInProgressResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 409, "upload already in progress")
+
+
+class InvalidParameterResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "invalid parameter")
+
+
+class TooManySubscribersResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 503, "too many status subscribers")
+
+
+class NoUploadSessionResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 404, "no such upload")
+
+
+class InvalidRangeResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 416, "invalid content range")
+
+
+class UploadIncompleteResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 409, "upload incomplete")
+
+
+class UnsupportedEncodingResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 415, "unsupported content encoding")
+
+
+class UndecodableDataResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "unable to decompress data")
+
+
+class InvalidDigestResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "invalid digest")
+
+
+class InvalidManifestResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "invalid chunk manifest")
+
+
+class NoManifestResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 404, "no chunk manifest")
+
+
+class ChunkMismatchResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "chunk digest mismatch")
+
+
+class ChunkTooLargeResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 413, "chunk too large")
+
+
+class ManifestTooLargeResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 413, "chunk manifest too large")
+
+
+class MissingChunksResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 409, "missing chunks")
+
+
+class InvalidFetchRequestResponse(ErrorResponse):
+    def __init__(self):
+        ErrorResponse.__init__(self, 400, "invalid fetch request")
@@ -0,0 +1,25 @@
+from datetime import datetime, time
+
+from .configuration import Configuration
+
+
+def is_in_window(now: time, start: time, end: time) -> bool:
+    # A window like 22:00-04:00 wraps past midnight.
+    if start <= end:
+        return start <= now < end
+
+    return now >= start or now < end
+
+
+def is_install_window_open(config: Configuration) -> bool:
+    """
+    Decides whether the install window (local time) allows a scheduled install to start now;
+    an unconfigured window always allows it.  The idle check is run separately, on a worker,
+    since it may take a while.
+    """
+
+    if config.install_window is None:
+        return True
+
+    start, end = [time.fromisoformat(t) for t in config.install_window]
+    return is_in_window(datetime.now().time(), start, end)
@@ -0,0 +1,33 @@
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from threading import BoundedSemaphore
+
+
+class BoundedThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server that handles each connection on its own thread so that a long upload
+    doesn't hold up status polling.  The number of connections being handled at once is
+    capped; once the cap is reached, new connections wait in the listen backlog until a
+    handler thread finishes.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, max_connections: int):
+        self.connection_slots = BoundedSemaphore(max_connections)
+        HTTPServer.__init__(self, server_address, handler_class)
+
+    def process_request(self, request, client_address) -> None:
+        self.connection_slots.acquire()
+
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except BaseException:
+            self.connection_slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connection_slots.release()
@@ -0,0 +1,135 @@
+from glob import escape, glob
+import logging
+import os
+import tempfile
+from typing import Optional
+
+
+def create_staging_file(update_write_path: str, size: Optional[int] = None) -> str:
+    """
+    Uploads are streamed to a uniquely named staging file next to the final update path.
+    The staging file is only moved into place by the write_update state so that a
+    half-received upload can never be mistaken for a complete bundle, and an upload that
+    is refused because another one got there first can't clobber the winner's file.
+
+    If the size of the bundle is known the file is preallocated to it so the bundle ends up
+    in as few extents as possible.  Raises OSError if the file can't be created or there
+    isn't room for it.
+    """
+
+    directory, name = os.path.split(update_write_path)
+    fd, path = tempfile.mkstemp(prefix=f"{name}.", suffix=".part", dir=directory or None)
+
+    try:
+        if size:
+            preallocate(fd, size)
+    except OSError:
+        os.close(fd)
+        remove_file(path)
+        raise
+
+    os.close(fd)
+    return path
+
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserves the blocks for the first size bytes of the file, which also sets its size.
+    Raises OSError if the disk is full.
+    """
+
+    if not hasattr(os, "posix_fallocate"):
+        return
+
+    os.posix_fallocate(fd, 0, size)
+
+
+def has_free_space(update_write_path: str, size: int, min_free_bytes: int) -> bool:
+    """
+    Returns whether a bundle of the given size can be staged next to update_write_path and
+    still leave min_free_bytes free for everything else on the disk.  If the free space
+    can't be found out, the upload is let through and will fail if it runs out of room.
+    """
+
+    try:
+        stats = os.statvfs(os.path.dirname(update_write_path) or ".")
+    except OSError:
+        logging.warning(f"Unable to check the free space next to '{update_write_path}'")
+        return True
+
+    free = stats.f_bavail * stats.f_frsize
+    if free - size < min_free_bytes:
+        logging.error(f"Not enough room to stage a {size} byte bundle; {free} bytes free")
+        return False
+
+    return True
+
+
+def flush_and_drop(fd: int, offset: int, length: int) -> None:
+    """
+    Syncs the file to disk and then drops the given range of it from the page cache.  Dirty
+    pages can't be dropped, hence the sync first.
+    """
+
+    os.fdatasync(fd)
+    drop_cache(fd, offset, length)
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0) -> None:
+    """
+    Drops the given range of the file from the page cache; a length of 0 means to the end
+    of the file.  Only clean pages are dropped.
+    """
+
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+
+class StagingWriter:
+    """
+    Writes a staging file while keeping it out of the page cache.  Once a bundle is staged
+    it is only read once more, by RAUC, so caching it just evicts pages the rest of the
+    system needs.  Every sync_bytes the range written since the last sync is flushed and
+    dropped.  A sync_bytes of 0 leaves caching to the kernel.
+    """
+
+    def __init__(self, f, sync_bytes: int, offset: int = 0):
+        self.f = f
+        self.sync_bytes = sync_bytes
+        self.position = offset
+        self.synced = offset
+
+    def write(self, data) -> None:
+        self.f.write(data)
+        self.position += len(data)
+
+        if self.sync_bytes and self.position - self.synced >= self.sync_bytes:
+            self.sync()
+
+    def sync(self) -> None:
+        if not self.sync_bytes or self.position == self.synced:
+            return
+
+        self.f.flush()
+        flush_and_drop(self.f.fileno(), self.synced, self.position - self.synced)
+        self.synced = self.position
+
+
+def remove_stale_staging_files(update_write_path: str) -> None:
+    """
+    Staging files from plain uploads and fetches that were cut short can never be resumed,
+    so they are removed on start.
+    """
+
+    for path in glob(f"{escape(update_write_path)}.*.part"):
+        logging.info(f"Removing stale staging file '{path}'")
+        remove_file(path)
+
+
+def remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logging.error(f"Unable to remove '{path}'")
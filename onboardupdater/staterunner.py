@@ -1,22 +1,34 @@
-from json import dumps
 import logging
 from queue import Empty, SimpleQueue
-from threading import RLock
-import time
-
-from transitions import MachineError
+from threading import BoundedSemaphore, Lock
+from typing import Optional, Tuple
 
+from .chunkstore import ChunkStore
 from .configuration import Configuration
-from .model import Model
+from .engine import MachineError
+from .fetch import FetchRequest
+from .inventory import Inventory
+from .journal import Journal, recover_status
+from .logsetup import log_context
+from .metrics import Metrics
+from .model import Model, states
+from .pipeline import PipelinedBundle
 from .response import (
     InvalidCancelStateResponse,
+    InvalidInstallStateResponse,
     InvalidRevertStateResponse,
     InvalidUpdateStateResponse,
+    NoHistoryResponse,
+    NoSlotsResponse,
     NoVersionResponse,
     Response,
     SuccessResonse,
+    UpdateAbortedResponse,
+    UploadInProgressResponse,
 )
+from .staging import remove_stale_staging_files
 from .trigger import Trigger
+from .upload import UpdateFile, UploadSession
 
 
 class StateRunner:
@@ -26,66 +38,188 @@ class StateRunner:
     from executing states in the state machine model itself after the state determines an
     operation was successful or failed.
 
-    The class attempts to read the firmware version on start.  The version is protected by a
-    lock since the HTTP request handler thread is going to query it.
+    The firmware version and the slot information are served from the inventory, which keeps
+    them up to date in the background so request handler threads never wait on a file or a
+    RAUC command.  The upload lock is held by whichever request handler thread is currently
+    streaming an update to disk, and each status long-poll or event stream holds one of the
+    subscriber slots.  Any resumable upload session left over from before a restart is picked
+    up again on start, as is the status recorded in the journal.  The chunk store and the
+    manifest of the delta upload in progress, if any, are also kept here.
     """
 
     def __init__(self, config: Configuration):
         self.config = config
-        self.model = Model(config, self.post_trigger)
+
+        remove_stale_staging_files(config.update_write_path)
+
+        # Pick up where we left off if there is a journal.
+        self.journal = None
+        status = None
+        if config.journal_path is not None:
+            self.journal = Journal(config.journal_path, config.journal_flush_interval_s, config.journal_max_bytes)
+            status = recover_status(self.journal.load(), config, [state["name"] for state in states])
+
         self.triggers = SimpleQueue()
-        self.version = ""
-        self.version_lock = RLock()
+        self.metrics = Metrics(self.triggers.qsize)
+        self.inventory = Inventory(config)
+        self.model = Model(config, self.post_trigger, status, self.journal, self.metrics, self.inventory)
+        self.upload_lock = Lock()
+        self.subscriber_slots = BoundedSemaphore(config.status_max_subscribers)
+        self.upload_session = UploadSession.load(config.update_write_path)
+        self.chunk_store = ChunkStore(config.update_write_path, config.chunk_store_budget_bytes)
+        self.chunk_store.load()
+        self.chunk_manifest = None
 
     def execute(self) -> None:
-        # Reading the version isn't actually in a state since it's a oneshot
-        # at startup.
-        self.read_version()
+        if self.journal is not None:
+            self.journal.start()
+
+        # The inventory isn't part of the state machine; it refreshes itself when the
+        # version file changes and when the model tells it the slots have.
+        self.inventory.start()
 
         while True:
-            try:
-                trigger = self.triggers.get(block=False)
+            # Block until a trigger arrives.  States that need a periodic "tick" event say so
+            # by having a "tick" transition; only then do we wake up without a trigger.
+            timeout = None
+            if self.can_trigger("tick"):
+                timeout = self.config.tick_period_s
 
-                try:
-                    self.model.trigger(trigger.name, trigger.data)
-                except MachineError:
-                    logging.error(f"Tried to trigger {trigger.name} from state {self.model.state}")
+            try:
+                trigger = self.triggers.get(timeout=timeout)
             except Empty:
-                # This is common -- the queue is most likely empty.  We don't do it right now but
-                # if any states needed a "tick" event we could put it here like so:
-                #
-                # if "tick" in self.model.get_triggers(self.model.state):
-                #    self.model.trigger("tick", None)
-                pass
+                trigger = Trigger("tick")
+
+            self.metrics.triggers.inc(trigger.name)
+            log_context.trigger = trigger.name
+
+            try:
+                self.model.trigger(trigger.name, trigger.data)
+            except MachineError:
+                self.metrics.rejected_triggers.inc(trigger.name, self.model.state)
+                logging.error(f"Tried to trigger {trigger.name} from state {self.model.state}")
+            finally:
+                log_context.trigger = ""
 
-            time.sleep(0.1)
+    def get_status(self, wait_version: Optional[int] = None) -> Response:
+        if wait_version is None:
+            version, json = self.model.get_status_snapshot()
+        else:
+            version, json = self.model.wait_for_status(wait_version, self.config.status_wait_timeout_s)
 
-    def get_status(self) -> Response:
-        return Response(200, dumps(vars(self.model.get_status())))
+        return Response(200, json, f'"{self.get_status_tag(version)}"', {"X-Status-Version": str(version)})
+
+    def wait_for_status(self, version: int, timeout_s: float) -> Tuple[int, bytes]:
+        return self.model.wait_for_status(version, timeout_s)
+
+    def get_status_tag(self, version: int) -> str:
+        """
+        Identifies a status version, for use as an ETag or event ID.
+        """
+
+        return f"{self.model.status_epoch}-{version}"
+
+    def get_status_version(self, tag: str) -> Optional[int]:
+        """
+        The reverse of get_status_tag; None if the tag is malformed or from another process.
+        """
+
+        epoch, _, version = tag.partition("-")
+        if epoch != self.model.status_epoch or not version.isdigit():
+            return None
+
+        return int(version)
+
+    def get_history(self, seq: int) -> Response:
+        history = self.model.get_history(seq)
+        if history is None:
+            return NoHistoryResponse()
+
+        return Response(200, history)
+
+    def get_metrics(self) -> Response:
+        return Response(200, self.metrics.render(), content_type=Metrics.content_type)
 
     def get_version(self) -> Response:
-        with self.version_lock:
-            if self.version == "":
-                return NoVersionResponse()
+        version = self.inventory.get_version()
+        if version is None:
+            return NoVersionResponse()
 
-            return Response(200, self.version)
+        return Response(200, version, self.inventory.get_version_tag())
 
-    def read_version(self) -> None:
-        with self.version_lock:
-            try:
-                with open(self.config.version_path, "r") as f:
-                    self.version = f.read()
-            except OSError:
-                logging.error(f"Unable to read version file at {self.config.version_path}")
+    def get_slots(self) -> Response:
+        slots = self.inventory.get_slots()
+        if slots is None:
+            return NoSlotsResponse()
+
+        return Response(200, slots, self.inventory.get_slots_tag())
 
     def post_trigger(self, trigger: Trigger) -> None:
         self.triggers.put(trigger)
 
-    def post_update(self, data: bytes) -> Response:
-        if "update" not in self.model.get_triggers(self.model.state):
+    def can_trigger(self, name: str) -> bool:
+        return name in self.model.get_triggers(self.model.state)
+
+    def is_pipelining(self) -> bool:
+        """
+        Returns whether a pipelined install is reading the upload staging file, either
+        from a session still being uploaded or from one that has been committed.
+        """
+
+        session = self.upload_session
+        for bundle in [session.bundle if session is not None else None, self.model.pipelined_bundle]:
+            if bundle is not None and not bundle.aborted:
+                return True
+
+        return False
+
+    def post_update(self, update: UpdateFile) -> Response:
+        if not self.can_trigger("update"):
+            return InvalidUpdateStateResponse()
+
+        self.triggers.put(Trigger("update", update))
+        return SuccessResonse()
+
+    def post_fetch(self, request: FetchRequest) -> Response:
+        # Hold the upload lock so a fetch can't start underneath an upload that is still
+        # streaming to disk.
+        if not self.upload_lock.acquire(blocking=False):
+            return UploadInProgressResponse()
+
+        try:
+            if not self.can_trigger("fetch"):
+                return InvalidUpdateStateResponse()
+
+            self.triggers.put(Trigger("fetch", request))
+            return SuccessResonse()
+        finally:
+            self.upload_lock.release()
+
+    def post_pipeline(self, bundle: PipelinedBundle) -> Response:
+        if not self.can_trigger("pipeline"):
             return InvalidUpdateStateResponse()
 
-        self.triggers.put(Trigger("update", data))
+        self.triggers.put(Trigger("pipeline", bundle))
+        return SuccessResonse()
+
+    def post_pipeline_upload(self, bundle: PipelinedBundle, update: UpdateFile) -> Response:
+        # Once the pipelined install is over nothing is waiting for the upload.  Otherwise the
+        # bundle is the state machine's from here on, to move into place or remove.
+        if not bundle.hand_over():
+            return UpdateAbortedResponse()
+
+        self.triggers.put(Trigger("pipeline_upload_success", update))
+        return SuccessResonse()
+
+    def post_pipeline_upload_failed(self, bundle: PipelinedBundle, error: str) -> None:
+        if not bundle.aborted:
+            self.triggers.put(Trigger("pipeline_upload_failed", error))
+
+    def post_install(self) -> Response:
+        if not self.can_trigger("install"):
+            return InvalidInstallStateResponse()
+
+        self.triggers.put(Trigger("install"))
         return SuccessResonse()
 
     def post_cancel(self) -> Response:
@@ -102,6 +236,9 @@ class StateRunner:
         self.triggers.put(Trigger("revert"))
         return SuccessResonse()
 
+    def update_upload_progress(self, received: int, written: int, rate: int) -> None:
+        self.model.update_upload_progress(received, written, rate)
+
     def post_boot_state(self, data: str) -> Response:
         self.model.update_boot_state(data)
         return SuccessResonse()
@@ -4,3 +4,11 @@ class Status:
         self.rauc_state = ""
         self.last_error = ""
         self.boot_state = ""
+        # Progress of the most recent upload.  Received counts bytes off the wire, written
+        # counts bundle bytes on disk (they differ for compressed uploads) and rate is the
+        # written bytes per second.
+        self.upload_received = 0
+        self.upload_written = 0
+        self.upload_rate = 0
+        # SHA-256 of the bundle currently staged at the update path.
+        self.bundle_sha256 = ""
@@ -0,0 +1,162 @@
+import logging
+import os
+import time
+from typing import List, Optional
+
+from .configuration import Configuration
+
+
+class TokenBucket:
+    """
+    Limits a byte stream to rate_bps on average while allowing bursts of up to burst bytes.
+    Callers block in consume() until the bytes they want to use are available.
+    """
+
+    def __init__(self, rate_bps: int, burst: int):
+        self.rate_bps = rate_bps
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def consume(self, n: int) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate_bps)
+        self.last = now
+        self.tokens -= n
+
+        # Going into debt lets a chunk bigger than the burst through; the sleep pays it back.
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate_bps)
+
+
+class IoPressureMonitor:
+    """
+    Reads the kernel's I/O pressure stall information.  "some avg10" is the percentage of
+    the last ten seconds in which at least one task was stalled waiting on I/O; when that
+    goes over the threshold, the recorder is likely to be struggling.
+    """
+
+    def __init__(self, threshold: float, path: str = "/proc/pressure/io"):
+        self.threshold = threshold
+        self.path = path
+        self.available = os.path.exists(path)
+
+        if not self.available:
+            logging.info(f"{path} is not available; not backing off on I/O pressure")
+
+    def read(self) -> float:
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    if line.startswith("some "):
+                        for field in line.split()[1:]:
+                            name, _, value = field.partition("=")
+                            if name == "avg10":
+                                return float(value)
+        except (OSError, ValueError):
+            logging.error(f"Unable to read {self.path}")
+            self.available = False
+
+        return 0.0
+
+    def is_high(self) -> bool:
+        return self.available and self.read() > self.threshold
+
+
+class WriteThrottle:
+    """
+    Paces writes of the staged bundle so they don't starve the recorder of eMMC bandwidth.
+    Writes are limited by a token bucket if a rate is configured, and paused for a while
+    whenever system I/O pressure is high, up to max_stall_s in all.
+    """
+
+    def __init__(self, config: Configuration):
+        self.bucket = None
+        if config.upload_rate_limit_bps > 0:
+            self.bucket = TokenBucket(config.upload_rate_limit_bps, config.upload_rate_limit_burst)
+
+        self.monitor = None
+        if config.io_pressure_threshold is not None:
+            self.monitor = IoPressureMonitor(config.io_pressure_threshold)
+
+        self.check_period_s = config.io_pressure_check_period_s
+        self.backoff_s = config.io_pressure_backoff_s
+        self.max_stall_s = config.io_pressure_max_stall_s
+        self.stalled_s = 0.0
+        self.next_check = 0.0
+
+    def wait(self, n: int) -> None:
+        if self.bucket is not None:
+            self.bucket.consume(n)
+
+        if self.monitor is None:
+            return
+
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+
+        while self.monitor.is_high():
+            if self.stalled_s >= self.max_stall_s:
+                # The upload holds the upload lock, so it can't wait forever.
+                logging.error(f"I/O pressure still high after pausing for {self.stalled_s:g}s; carrying on")
+                self.monitor = None
+                return
+
+            pause_s = min(self.backoff_s, self.max_stall_s - self.stalled_s)
+            logging.info(f"I/O pressure is high; pausing writes for {pause_s}s")
+            time.sleep(pause_s)
+            self.stalled_s += pause_s
+
+        self.next_check = time.monotonic() + self.check_period_s
+
+
+def get_priority_cmds(config: Configuration) -> List[str]:
+    """
+    Returns a command prefix that runs the RAUC command at the configured CPU and I/O
+    priority.
+    """
+
+    cmds = []
+
+    if config.rauc_ionice_class is not None:
+        cmds += ["ionice", "-c", str(config.rauc_ionice_class)]
+        if config.rauc_ionice_level is not None:
+            cmds += ["-n", str(config.rauc_ionice_level)]
+
+    if config.rauc_nice is not None:
+        cmds += ["nice", "-n", str(config.rauc_nice)]
+
+    return cmds
+
+
+def apply_cgroup(config: Configuration, pid: Optional[int] = None) -> None:
+    """
+    Applies the configured cgroup v2 limits and moves pid (if given) into the cgroup.
+    Failures are logged but not fatal; an unthrottled install is better than none.
+    """
+
+    if config.rauc_cgroup_path is None:
+        return
+
+    settings = {
+        "io.max": config.rauc_cgroup_io_max,
+        "cpu.weight": config.rauc_cgroup_cpu_weight,
+        "cgroup.procs": pid,
+    }
+
+    try:
+        os.makedirs(config.rauc_cgroup_path, exist_ok=True)
+    except OSError:
+        logging.error(f"Unable to create cgroup {config.rauc_cgroup_path}")
+        return
+
+    for name, value in settings.items():
+        if value is None:
+            continue
+
+        try:
+            with open(os.path.join(config.rauc_cgroup_path, name), "w") as f:
+                f.write(str(value))
+        except OSError:
+            logging.error(f"Unable to write '{value}' to {name} in cgroup {config.rauc_cgroup_path}")
@@ -0,0 +1,322 @@
+from base64 import b64decode
+import binascii
+import hashlib
+from json import dumps, loads
+import logging
+import os
+import time
+from typing import Callable, Optional
+from uuid import uuid4
+
+from .body import connection_errors
+from .staging import StagingWriter, drop_cache, preallocate, remove_file
+
+
+class UpdateFile:
+    """
+    Describes an update bundle that has already been streamed to disk.  This is what gets
+    passed to the state machine with the "update" trigger rather than the bundle content
+    itself so that memory use doesn't scale with the size of the bundle.
+    """
+
+    def __init__(
+        self, path: str, size: int, sha256: str, expected_sha256: Optional[str] = None, stage_only: bool = False
+    ):
+        self.path = path
+        self.size = size
+        # Hex digest of what was written, and what the client said it should be, if anything.
+        self.sha256 = sha256
+        self.expected_sha256 = expected_sha256
+        # Stop once the bundle is in place rather than going on to install it.
+        self.stage_only = stage_only
+
+    def is_digest_valid(self) -> bool:
+        return self.expected_sha256 is None or self.expected_sha256 == self.sha256
+
+
+class StreamInterruptedError(ConnectionError):
+    """
+    Raised by stream_to_file when the connection it is reading from drops or times out.
+    Written is how much was written, and synced, before it did.
+    """
+
+    def __init__(self, written: int):
+        ConnectionError.__init__(self, f"Stream interrupted after {written} bytes")
+        self.written = written
+
+
+def get_expected_sha256(headers) -> Optional[str]:
+    """
+    Returns the bundle's SHA-256 as lowercase hex if the client gave one, either as hex in
+    X-Bundle-SHA256 or base64 in a "Digest: sha-256=..." header.  The digest is always of
+    the bundle itself, i.e. after any Content-Encoding is undone.  Raises ValueError if the
+    header is malformed.
+    """
+
+    value = headers["x-bundle-sha256"]
+
+    if value is None and headers["digest"] is not None:
+        for item in headers["digest"].split(","):
+            algorithm, _, encoded = item.strip().partition("=")
+            if algorithm.lower() == "sha-256":
+                try:
+                    value = b64decode(encoded, validate=True).hex()
+                except binascii.Error:
+                    raise ValueError(f"Invalid digest '{encoded}'")
+
+    if value is None:
+        return None
+
+    value = value.strip().lower()
+    if len(value) != 64 or any(c not in "0123456789abcdef" for c in value):
+        raise ValueError(f"Invalid SHA-256 '{value}'")
+
+    return value
+
+
+def hash_file(path: str, chunk_size: int, uncached: bool = False) -> str:
+    """
+    Returns the SHA-256 of the file as hex.  If uncached, what was read is dropped from the
+    page cache afterwards.
+    """
+
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+
+            digest.update(view[:n])
+
+        if uncached:
+            drop_cache(f.fileno())
+
+    return digest.hexdigest()
+
+
+def stream_to_file(
+    reader,
+    path: str,
+    chunk_size: int,
+    offset: Optional[int] = None,
+    progress: Optional[Callable[[int], None]] = None,
+    digest=None,
+    throttle=None,
+    sync_bytes: int = 0,
+) -> int:
+    """
+    Copies everything from reader into the file at path using a single fixed-size buffer and
+    returns the number of bytes written.  It is up to the caller to check whether the
+    reader got everything it expected.  Raises OSError if the file can't be written, and
+    StreamInterruptedError if the reader's connection fails part way through.
+
+    With no offset the file is created (or truncated) first.  With an offset the bytes are
+    written into the existing file at that position and synced to disk before returning.
+    If a hashlib digest is given, it is updated with the bytes as they are written.  If a
+    throttle is given, it is waited on after each write.  If sync_bytes is given, what has
+    been written is synced and dropped from the page cache that often, and once more at
+    the end.
+    """
+
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    written = 0
+
+    with open(path, "wb" if offset is None else "r+b") as f:
+        if offset is not None:
+            f.seek(offset)
+
+        writer = StagingWriter(f, sync_bytes, offset or 0)
+
+        interrupted = False
+
+        while True:
+            try:
+                n = reader.readinto(view)
+            except connection_errors:
+                # Keep what did arrive, so it can be picked up from where it left off.
+                interrupted = True
+                break
+
+            if not n:
+                break
+
+            writer.write(view[:n])
+            written += n
+
+            if digest is not None:
+                digest.update(view[:n])
+
+            if throttle is not None:
+                throttle.wait(n)
+
+            if progress is not None:
+                # Anything reading the file as it is written (a pipelined install) must be
+                # able to see what has been reported.
+                f.flush()
+                progress(written)
+
+        writer.sync()
+
+        if offset is not None:
+            f.flush()
+            os.fsync(f.fileno())
+
+    if interrupted:
+        raise StreamInterruptedError(written)
+
+    return written
+
+
+class UploadProgress:
+    """
+    Tracks how an upload is going and publishes it at most every interval_s, so a fast
+    upload doesn't flood status subscribers with changes.
+    """
+
+    def __init__(self, body, publish: Callable[[int, int, int], None], interval_s: float):
+        self.body = body
+        self.publish = publish
+        self.interval_s = interval_s
+        self.start = time.monotonic()
+        self.last_publish = self.start
+        self.written = 0
+        self.publish(0, 0, 0)
+
+    def __call__(self, written: int) -> None:
+        self.written = written
+
+        now = time.monotonic()
+        if now - self.last_publish >= self.interval_s:
+            self.last_publish = now
+            self.report(now)
+
+    def finish(self) -> None:
+        self.report(time.monotonic())
+
+    def get_rate(self, now: Optional[float] = None) -> int:
+        # The rate is of bundle bytes landing on disk, i.e. after any decompression.
+        return int(self.written / max((now or time.monotonic()) - self.start, 1e-3))
+
+    def report(self, now: float) -> None:
+        self.publish(self.body.received, self.written, self.get_rate(now))
+
+
+class UploadSession:
+    """
+    A resumable upload.  The client sends the bundle as a series of byte ranges which are
+    written into a staging file; the offset is how much of the bundle, from the start, has
+    been received and synced to disk.  The client can resume from the offset after a
+    dropped connection, and commits the session once the offset reaches the size.
+
+    There is at most one session at a time.  Its record is kept in a small JSON file next
+    to update_write_path so that an upload can be resumed after a restart.
+
+    While ranges arrive in order the SHA-256 of the bundle is worked out as they are
+    written.  If that chain is broken (by an overlapping range or a restart) the digest is
+    worked out from the staging file at commit instead.
+    """
+
+    def __init__(
+        self, update_write_path: str, id: str, size: int, offset: int = 0, expected_sha256: Optional[str] = None
+    ):
+        self.id = id
+        self.size = size
+        self.offset = offset
+        self.expected_sha256 = expected_sha256
+        self.path = f"{update_write_path}.upload"
+        self.record_path = f"{update_write_path}.session"
+        self.digest = hashlib.sha256() if offset == 0 else None
+        # The pipelined install reading the bundle as it arrives, if any.  This isn't saved;
+        # after a restart the install is gone and the session is an ordinary one.
+        self.bundle = None
+
+    @staticmethod
+    def create(update_write_path: str, size: int, expected_sha256: Optional[str] = None) -> "UploadSession":
+        session = UploadSession(update_write_path, uuid4().hex, size, expected_sha256=expected_sha256)
+
+        # The whole bundle is reserved up front so ranges land in as few extents as possible.
+        with open(session.path, "wb") as f:
+            preallocate(f.fileno(), size)
+
+        session.save()
+        return session
+
+    @staticmethod
+    def load(update_write_path: str) -> Optional["UploadSession"]:
+        record_path = f"{update_write_path}.session"
+
+        try:
+            with open(record_path, "r") as f:
+                record = loads(f.read())
+
+            session = UploadSession(
+                update_write_path, record["id"], record["size"], record["offset"], record.get("sha256")
+            )
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError):
+            logging.error(f"Discarding unreadable upload session '{record_path}'")
+            remove_file(record_path)
+            return None
+
+        # Never trust the record beyond what actually made it to disk.
+        try:
+            session.offset = min(session.offset, os.path.getsize(session.path))
+        except OSError:
+            session.offset = 0
+
+        # The digest so far was lost with the old process.
+        session.digest = None
+
+        logging.info(f"Resuming upload session {session.id} at {session.offset} of {session.size} bytes")
+        return session
+
+    def save(self) -> None:
+        # Write the record atomically so a power cut leaves either the old or the new one.
+        temp_path = f"{self.record_path}.tmp"
+
+        with open(temp_path, "w") as f:
+            f.write(self.to_json())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(temp_path, self.record_path)
+
+    def close(self) -> None:
+        """
+        Forgets the session but leaves the staging file for whoever now owns it.
+        """
+
+        remove_file(self.record_path)
+
+    def remove(self) -> None:
+        self.close()
+        remove_file(self.path)
+
+    def is_complete(self) -> bool:
+        return self.offset == self.size
+
+    def get_range_digest(self, start: int):
+        """
+        Returns the digest to update with a range starting at start, or None if the range
+        doesn't carry on exactly where the digest left off.
+        """
+
+        if self.digest is not None and start != self.offset:
+            self.digest = None
+
+        return self.digest
+
+    def get_sha256(self, chunk_size: int, uncached: bool = False) -> str:
+        if self.digest is None:
+            return hash_file(self.path, chunk_size, uncached)
+
+        return self.digest.hexdigest()
+
+    def to_json(self) -> str:
+        return dumps({"id": self.id, "size": self.size, "offset": self.offset, "sha256": self.expected_sha256})
@@ -0,0 +1,135 @@
+import logging
+import os
+import selectors
+import signal
+import subprocess
+from threading import Lock, Thread
+from typing import Callable, List, Optional
+
+
+class Worker:
+    """
+    Runs a long-lived command on a thread of its own so that the state runner stays free
+    to process triggers (e.g. a cancel) while the command runs.  on_start is called with the
+    child's pid once it has been spawned.
+
+    Output is read from the child's pipe without blocking and handed to on_output a line
+    at a time.  When the child exits, on_exit is called with its return code; the callback
+    is expected to post the trigger that moves the state machine on.  A cancelled worker
+    kills its child and never calls on_exit, so a stale result can't reach a state that
+    has already moved on.
+    """
+
+    # Guard against a child that writes without ever sending a newline.
+    max_line_length = 64 * 1024
+
+    def __init__(
+        self,
+        cmds: List[str],
+        on_output: Optional[Callable[[str], None]] = None,
+        on_exit: Optional[Callable[[int], None]] = None,
+        kill_timeout_s: float = 2,
+        on_start: Optional[Callable[[int], None]] = None,
+    ):
+        self.cmds = cmds
+        self.on_output = on_output
+        self.on_exit = on_exit
+        self.kill_timeout_s = kill_timeout_s
+        self.on_start = on_start
+        self.process = None
+        self.cancelled = False
+        self.lock = Lock()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        try:
+            # Put the child in a session of its own so that cancelling also takes out anything
+            # it spawned, which would otherwise hold the pipe open.  stderr is folded into
+            # stdout since RAUC writes its final failure message there.
+            self.process = subprocess.Popen(
+                self.cmds, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True
+            )
+        except OSError:
+            logging.error(f"Unable to run {self.cmds}")
+            self.finish(-1)
+            return
+
+        if self.on_start is not None:
+            self.on_start(self.process.pid)
+
+        self.thread.start()
+
+    def cancel(self) -> None:
+        with self.lock:
+            if self.cancelled:
+                return
+
+            self.cancelled = True
+
+        if self.process is None or self.process.poll() is not None:
+            return
+
+        logging.info(f"Cancelling {self.cmds}")
+        self.signal(signal.SIGTERM)
+
+        try:
+            self.process.wait(timeout=self.kill_timeout_s)
+        except subprocess.TimeoutExpired:
+            logging.error(f"{self.cmds} ignored SIGTERM; killing it")
+            self.signal(signal.SIGKILL)
+            self.process.wait()
+
+        self.thread.join(self.kill_timeout_s)
+
+    def signal(self, signum: int) -> None:
+        try:
+            os.killpg(self.process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def run(self) -> None:
+        fd = self.process.stdout.fileno()
+        os.set_blocking(fd, False)
+
+        pending = b""
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+
+            while True:
+                selector.select()
+
+                try:
+                    chunk = os.read(fd, 4096)
+                except BlockingIOError:
+                    continue
+
+                if not chunk:
+                    break
+
+                pending += chunk
+                *lines, pending = pending.split(b"\n")
+                if len(pending) > self.max_line_length:
+                    lines.append(pending)
+                    pending = b""
+
+                for line in lines:
+                    self.output(line)
+
+        if pending:
+            self.output(pending)
+
+        self.process.stdout.close()
+        self.finish(self.process.wait())
+
+    def output(self, line: bytes) -> None:
+        if self.on_output is not None:
+            self.on_output(line.strip().decode("utf-8", errors="replace"))
+
+    def finish(self, return_code: int) -> None:
+        with self.lock:
+            if self.cancelled:
+                return
+
+            if self.on_exit is not None:
+                self.on_exit(return_code)
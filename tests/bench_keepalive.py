@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.bench_keepalive".
+
+import http.client
+import time
+
+from onboardupdater.configuration import Configuration
+from tests.common import get_config, start_ou
+
+REQUEST_COUNT = 2000
+
+
+def poll_status(config: Configuration, keep_alive: bool) -> float:
+    """
+    Polls /status REQUEST_COUNT times and returns the number of requests per second, using
+    either one persistent connection or a new connection for every request.
+    """
+
+    connection = None
+    start = time.perf_counter()
+
+    for _ in range(REQUEST_COUNT):
+        if connection is None:
+            connection = http.client.HTTPConnection("localhost", config.server_port)
+
+        connection.request("GET", "/status", headers={} if keep_alive else {"Connection": "close"})
+        response = connection.getresponse()
+        response.read()
+
+        if not keep_alive or response.will_close:
+            connection.close()
+            connection = None
+
+    return REQUEST_COUNT / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    config = get_config(8086, "/tmp/update.rauc")
+    start_ou(config)
+
+    # Warm up.
+    poll_status(config, True)
+
+    without_keep_alive = poll_status(config, False)
+    with_keep_alive = poll_status(config, True)
+
+    print(f"/status without keep-alive: {without_keep_alive:8.0f} requests/s")
+    print(f"/status with keep-alive:    {with_keep_alive:8.0f} requests/s")
+    print(f"Speed-up: {with_keep_alive / without_keep_alive:.2f}x")
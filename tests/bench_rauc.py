@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.bench_rauc".
+
+import time
+import tracemalloc
+
+from onboardupdater.rauc import RaucProgressParser
+
+LINE_COUNT = 100000
+
+
+def synthetic_install_log(line_count: int):
+    """
+    Generates a long install log in the same shape as the mock RAUC scripts: nested steps
+    that each print a start and a "done." line, ending with a failure.
+    """
+
+    for i in range(line_count - 3):
+        percent = i * 100 // line_count
+        if i % 2 == 0:
+            yield f"{percent:3d}% Copying image to rootfs.{i // 2}"
+        else:
+            yield f"{percent:3d}% Copying image to rootfs.{i // 2} done."
+
+    yield "100% Installing failed."
+    yield "LastError: Failed updating slot rootfs.0"
+    yield "Installing `/tmp/update.raucb` failed"
+
+
+if __name__ == "__main__":
+    lines = list(synthetic_install_log(LINE_COUNT))
+
+    parser = RaucProgressParser()
+    start = time.perf_counter()
+
+    for line in lines:
+        parser.feed(line)
+        parser.status()
+
+    elapsed = time.perf_counter() - start
+
+    # Measure memory on a separate pass since tracing allocations skews the timing.
+    parser = RaucProgressParser()
+    tracemalloc.start()
+
+    for line in lines:
+        parser.feed(line)
+        parser.status()
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"Parsed {LINE_COUNT} lines in {elapsed:.3f}s ({elapsed / LINE_COUNT * 1e9:.0f} ns/line)")
+    print(f"Peak memory while parsing: {peak} bytes")
+    print(f"Final status: {parser.status()}")
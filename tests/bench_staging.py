@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.bench_staging".  Run with --help for
+# the options.  Use a path on a real disk; on tmpfs the page cache is the file.
+#
+# Stages a bundle the way an upload does, once with the kernel left to cache it as it
+# likes and once through the staging writer (preallocated, synced and dropped from the
+# page cache as it goes).  For each it reports the write throughput, both to the last
+# write and with the final sync included, how much the page cache grew at its peak, and how
+# much of the staged bundle is still cached once it has been written.
+
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import os
+import threading
+import time
+
+from onboardupdater.staging import create_staging_file, remove_file
+from onboardupdater.upload import stream_to_file
+
+BLOCK_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class BundleReader:
+    """
+    Stands in for an upload body: size bytes of random data, served from one block so the
+    reader itself doesn't take up memory.
+    """
+
+    def __init__(self, size: int):
+        self.block = memoryview(os.urandom(BLOCK_SIZE))
+        self.remaining = size
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.remaining, BLOCK_SIZE)
+        b[:n] = self.block[:n]
+        self.remaining -= n
+        return n
+
+
+def get_cached_kb() -> int:
+    with open("/proc/meminfo", "r") as f:
+        for line in f:
+            if line.startswith("Cached:"):
+                return int(line.split()[1])
+
+    return 0
+
+
+class CacheSampler:
+    """
+    Samples the size of the page cache on a thread of its own and keeps the peak.
+    """
+
+    def __init__(self, period_s: float = 0.01):
+        self.period_s = period_s
+        self.start_kb = get_cached_kb()
+        self.peak_kb = self.start_kb
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.period_s):
+            self.peak_kb = max(self.peak_kb, get_cached_kb())
+
+    def stop(self) -> int:
+        """
+        Returns the peak growth in the page cache, in kB.
+        """
+
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak_kb, get_cached_kb()) - self.start_kb
+
+
+def get_resident_bytes(path: str) -> int:
+    """
+    Returns how much of the file is in the page cache, using mincore on a mapping of it.
+    """
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    size = os.path.getsize(path)
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    vector = (ctypes.c_ubyte * pages)()
+
+    with open(path, "rb") as f:
+        # A private mapping, so ctypes can take its address; nothing in it is touched.
+        mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+
+    try:
+        buffer = (ctypes.c_char * size).from_buffer(mapping)
+        result = libc.mincore(ctypes.c_void_p(ctypes.addressof(buffer)), ctypes.c_size_t(size), vector)
+        del buffer
+
+        if result != 0:
+            raise OSError(ctypes.get_errno(), "mincore failed")
+    finally:
+        mapping.close()
+
+    return sum(page & 1 for page in vector) * mmap.PAGESIZE
+
+
+def stage(path: str, size: int, staged: bool, sync_bytes: int) -> dict:
+    os.sync()
+
+    sampler = CacheSampler()
+    start = time.perf_counter()
+
+    if staged:
+        staging_path = create_staging_file(path, size)
+        written = stream_to_file(BundleReader(size), staging_path, CHUNK_SIZE, offset=0, sync_bytes=sync_bytes)
+    else:
+        staging_path = create_staging_file(path)
+        written = stream_to_file(BundleReader(size), staging_path, CHUNK_SIZE)
+
+    written_s = time.perf_counter() - start
+
+    # The bundle has to be on disk before it is installed, so count the sync too.
+    fd = os.open(staging_path, os.O_RDONLY)
+    os.fdatasync(fd)
+    os.close(fd)
+
+    synced_s = time.perf_counter() - start
+    cache_growth_kb = sampler.stop()
+    resident = get_resident_bytes(staging_path)
+    remove_file(staging_path)
+
+    return {
+        "write_mb_s": written / written_s / 1e6,
+        "synced_mb_s": written / synced_s / 1e6,
+        "cache_growth_mb": cache_growth_kb / 1024,
+        "resident_mb": resident / 1024 / 1024,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks staging a bundle with and without the staging writer.")
+    parser.add_argument("--path", default="/var/tmp/bench_staging.raucb", help="update_write_path to stage next to")
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the bundle")
+    parser.add_argument("--sync-mb", type=int, default=8, help="staging_sync_bytes, in MiB")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+
+    for name, staged in [("page cache", False), ("staging", True)]:
+        for _ in range(args.runs):
+            result = stage(args.path, size, staged, args.sync_mb * 1024 * 1024)
+            print(
+                f"{name:10s} write {result['write_mb_s']:7.1f} MB/s   with sync {result['synced_mb_s']:7.1f} MB/s"
+                f"   cache peak +{result['cache_growth_mb']:6.1f} MiB   bundle cached {result['resident_mb']:6.1f} MiB"
+            )
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.bench_startup".
+#
+# Compares how long the OU takes to start with each state engine: the time to import the
+# package, the time to set it up (building the state runner and its engine, which is when
+# the transitions engine imports transitions), and the time from launching the process
+# until the first /status is served.  Each run is a fresh process so nothing is already
+# imported or cached in memory.
+
+import http.client
+import logging
+from statistics import median
+import subprocess
+import sys
+import time
+
+RUN_COUNT = 10
+PORT = 8088
+
+
+def wait_for_status(timeout_s: float) -> None:
+    deadline = time.perf_counter() + timeout_s
+
+    while True:
+        try:
+            connection = http.client.HTTPConnection("localhost", PORT)
+            connection.request("GET", "/status")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+
+            time.sleep(0.001)
+
+
+def run(engine: str):
+    """
+    Starts the OU with the given engine and returns the import and setup times it reports
+    and the time until it served the first /status.
+    """
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "tests.bench_startup", "--serve", engine], stdout=subprocess.PIPE, text=True
+    )
+
+    try:
+        wait_for_status(10)
+        first_status_s = time.perf_counter() - start
+        import_s, setup_s = [float(value) for value in process.stdout.readline().split()]
+    finally:
+        process.kill()
+        process.wait()
+
+    return import_s, setup_s, first_status_s
+
+
+def serve(engine: str) -> None:
+    start = time.perf_counter()
+    from onboardupdater.onboardupdater import OnboardUpdater
+    from tests.common import get_config
+
+    import_s = time.perf_counter() - start
+
+    config = get_config(PORT, "/tmp/update.rauc")
+    config.state_engine = engine
+
+    logging.basicConfig(level=logging.WARNING)
+
+    start = time.perf_counter()
+    ou = OnboardUpdater(config)
+    print(import_s, time.perf_counter() - start, flush=True)
+
+    ou.start()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--serve":
+        serve(sys.argv[2])
+        sys.exit(0)
+
+    for engine in ["transitions", "table"]:
+        results = [run(engine) for _ in range(RUN_COUNT)]
+        import_ms, setup_ms, first_status_ms = [median(times) * 1000 for times in zip(*results)]
+        print(
+            f"{engine:12s} import {import_ms:7.1f}ms   setup {setup_ms:7.1f}ms   "
+            f"first /status {first_status_ms:7.1f}ms"
+        )
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.benchmark".  Run with --help for the
+# options.
+#
+# Boots the OU in a child process with the mock RAUC scripts and drives it over HTTP:
+#
+#   * upload: one large /update upload, with several clients polling /status throughout.
+#     Reports upload throughput and the status latency seen while the upload is going.
+#   * trigger: the time from posting a trigger (update, cancel) until the status shows the
+#     state it leads to.
+#   * install: an immediate /update run through install, reboot and back to ready.  RAUC is
+#     mocked, so this measures the OU's own overhead around an install rather than RAUC:
+#     the time until the install starts and the time from there until the OU is ready
+#     again, less the time the mock install script takes.
+#   * notify: the time from a status change (a /bootstate post) until a client waiting on
+#     /status?wait gets the new status.
+#
+# Latencies are reported as p50/p99 in milliseconds, along with the peak RSS and CPU time
+# of the OU process.  The results are saved as JSON so runs can be compared between
+# releases.
+
+import argparse
+from datetime import datetime, timezone
+import http.client
+from json import dump, dumps, loads
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from typing import List
+
+from onboardupdater.onboardupdater import OnboardUpdater
+from tests.common import get_config
+
+BLOCK_SIZE = 1024 * 1024
+# How long the mock update script takes: 24 lines, 0.2 s apart.
+MOCK_INSTALL_S = 24 * 0.2
+
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(samples: List[float]) -> dict:
+    """
+    Summarizes latencies given in seconds, in milliseconds.
+    """
+
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "max_ms": round(max(samples, default=0) * 1000, 3),
+    }
+
+
+class Client:
+    """
+    A keep-alive connection to the OU.
+    """
+
+    def __init__(self, port: int, timeout_s: float = 60):
+        self.connection = http.client.HTTPConnection("localhost", port, timeout=timeout_s)
+
+    def request(self, method: str, route: str, body=None, headers: dict = {}) -> http.client.HTTPResponse:
+        self.connection.request(method, route, body=body, headers=headers)
+        response = self.connection.getresponse()
+        response.data = response.read()
+        return response
+
+    def get_status(self, wait_version: int = None):
+        """
+        Returns the status version and the status, waiting for it to change from
+        wait_version if given.
+        """
+
+        route = "/status" if wait_version is None else f"/status?wait={wait_version}"
+        response = self.request("GET", route)
+        return int(response.headers["X-Status-Version"]), loads(response.data)
+
+    def wait_for_state(self, state: str, timeout_s: float = 30) -> float:
+        """
+        Returns the time at which the status was seen in the given state.
+        """
+
+        deadline = time.perf_counter() + timeout_s
+        version, status = self.get_status()
+
+        while status["state"] != state:
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Timed out waiting for state '{state}', still in '{status['state']}'")
+
+            version, status = self.get_status(version)
+
+        return time.perf_counter()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class ServerProcess:
+    """
+    The OU running in a child process, so that its memory and CPU use can be measured
+    apart from the clients driving it.
+    """
+
+    def __init__(self, port: int, update_write_path: str):
+        cmds = [sys.executable, "-m", "tests.benchmark", "--serve", "--port", str(port)]
+        self.process = subprocess.Popen(cmds + ["--update-write-path", update_write_path])
+
+        # Wait for the server to come up.
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                Client(port).get_status()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def get_cpu_s(self) -> float:
+        with open(f"/proc/{self.process.pid}/stat", "r") as f:
+            # Skip past the command name, which may contain spaces.
+            fields = f.read().rpartition(")")[2].split()
+
+        # utime and stime are the 14th and 15th fields.
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+    def get_peak_rss_kb(self) -> int:
+        with open(f"/proc/{self.process.pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+
+        return 0
+
+    def stop(self) -> None:
+        self.process.kill()
+        self.process.wait()
+
+
+def generate_bundle(size: int):
+    block = os.urandom(BLOCK_SIZE)
+
+    for offset in range(0, size, BLOCK_SIZE):
+        yield block[: min(BLOCK_SIZE, size - offset)]
+
+
+def bench_upload(port: int, size: int, pollers: int) -> dict:
+    stop = threading.Event()
+    latencies = [[] for _ in range(pollers)]
+
+    def poll(samples: List[float]) -> None:
+        client = Client(port)
+        while not stop.is_set():
+            start = time.perf_counter()
+            client.get_status()
+            samples.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+        client.close()
+
+    threads = [threading.Thread(target=poll, args=(samples,)) for samples in latencies]
+    for thread in threads:
+        thread.start()
+
+    client = Client(port, timeout_s=600)
+    start = time.perf_counter()
+    response = client.request("POST", "/update?stage", generate_bundle(size), {"Content-Length": str(size)})
+    elapsed = time.perf_counter() - start
+
+    client.wait_for_state("staged")
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    # Leave the OU ready for the next benchmark.
+    client.request("POST", "/cancel")
+    client.wait_for_state("ready")
+    client.close()
+
+    return {
+        "response": response.status,
+        "bytes": size,
+        "seconds": round(elapsed, 3),
+        "throughput_mb_s": round(size / elapsed / 1e6, 2),
+        "status_latency": summarize([sample for samples in latencies for sample in samples]),
+    }
+
+
+def bench_trigger(port: int, iterations: int) -> dict:
+    client = Client(port)
+    samples = {"update": [], "cancel": []}
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        client.request("POST", "/update?stage", b"not really a bundle")
+        samples["update"].append(client.wait_for_state("staged") - start)
+
+        start = time.perf_counter()
+        client.request("POST", "/cancel")
+        samples["cancel"].append(client.wait_for_state("ready") - start)
+
+    client.close()
+    return {trigger: summarize(latencies) for trigger, latencies in samples.items()}
+
+
+def bench_install(port: int, iterations: int) -> dict:
+    client = Client(port)
+    samples = {"start": [], "install": []}
+    failed = 0
+
+    for _ in range(iterations):
+        start = time.perf_counter()
+        client.request("POST", "/update", b"not really a bundle")
+        started = client.wait_for_state("rauc_update")
+        samples["start"].append(started - start)
+
+        # The reboot state passes too quickly to be seen reliably, so time through to ready.
+        samples["install"].append(client.wait_for_state("ready") - started - MOCK_INSTALL_S)
+        if client.get_status()[1]["rauc_state"] != "success":
+            failed += 1
+
+    client.close()
+    result = {step: summarize(latencies) for step, latencies in samples.items()}
+    result["failed"] = failed
+    return result
+
+
+def bench_notify(port: int, iterations: int) -> dict:
+    samples = []
+    waiting = threading.Event()
+    done = threading.Event()
+
+    def subscribe() -> None:
+        client = Client(port)
+        version, _ = client.get_status()
+
+        while not done.is_set():
+            waiting.set()
+            version, status = client.get_status(version)
+            received = time.perf_counter()
+
+            if status["boot_state"]:
+                samples.append(received - float(status["boot_state"]))
+
+        client.close()
+
+    thread = threading.Thread(target=subscribe)
+    thread.start()
+
+    client = Client(port)
+    for i in range(iterations):
+        waiting.wait()
+        waiting.clear()
+        # Give the subscriber time to get back into its wait.
+        time.sleep(0.005)
+
+        if i == iterations - 1:
+            done.set()
+        client.request("POST", "/bootstate", str(time.perf_counter()).encode())
+
+    thread.join()
+    client.request("POST", "/bootstate")
+    client.close()
+
+    return summarize(samples)
+
+
+def serve(port: int, update_write_path: str) -> None:
+    logging.basicConfig(level=logging.WARNING)
+
+    OnboardUpdater(get_config(port, update_write_path)).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the OU's HTTP API.")
+    parser.add_argument("--port", type=int, default=8087)
+    parser.add_argument("--update-write-path", default="/tmp/update.rauc")
+    parser.add_argument("--upload-mb", type=int, default=256, help="size of the upload benchmark bundle")
+    parser.add_argument("--pollers", type=int, default=4, help="clients polling /status during the upload")
+    parser.add_argument("--iterations", type=int, default=200, help="samples for the trigger and notify benchmarks")
+    parser.add_argument("--installs", type=int, default=5, help="samples for the install benchmark")
+    parser.add_argument("--output", default="benchmark.json", help="where to save the results")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port, args.update_write_path)
+        sys.exit(0)
+
+    server = ServerProcess(args.port, args.update_write_path)
+    results = {
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmarks": {},
+    }
+
+    try:
+        benchmarks = [
+            ("upload", lambda: bench_upload(args.port, args.upload_mb * 1024 * 1024, args.pollers)),
+            ("trigger", lambda: bench_trigger(args.port, args.iterations)),
+            ("install", lambda: bench_install(args.port, args.installs)),
+            ("notify", lambda: bench_notify(args.port, args.iterations)),
+        ]
+
+        for name, bench in benchmarks:
+            cpu_s = server.get_cpu_s()
+            result = bench()
+            result["server_cpu_s"] = round(server.get_cpu_s() - cpu_s, 3)
+            results["benchmarks"][name] = result
+            print(f"{name}: {dumps(result)}")
+
+        results["server_peak_rss_kb"] = server.get_peak_rss_kb()
+        print(f"server peak RSS: {results['server_peak_rss_kb']} kB")
+    finally:
+        server.stop()
+
+    with open(args.output, "w") as f:
+        dump(results, f, indent=2)
+
+    print(f"Results saved to {args.output}")
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.cancel".
+
+import sys
+import time
+
+from tests.common import Client, get_config, start_ou
+
+PORT = 8081
+# A cancel has to stop the install and get back to ready within this long.  The mock
+# install on its own takes 45 seconds.
+MAX_CANCEL_LATENCY_S = 1.0
+
+
+if __name__ == "__main__":
+    # Start an install with a mock RAUC that takes a long time, cancel it part way through
+    # and check the cancel takes effect straight away rather than after the install ends.
+    config = get_config(PORT, "/tmp/update.rauc")
+    config.update_cmds = ["tests/rauc/mock_rauc_update_slow.sh"]
+    start_ou(config)
+    client = Client(PORT)
+
+    print(client.request("POST", "/update", b"not really a bundle"))
+    print(client.wait_for_state("rauc_update", timeout_s=5))
+    time.sleep(1)
+
+    start = time.monotonic()
+    print(client.request("POST", "/cancel"))
+    print(client.wait_for_state("ready", timeout_s=10))
+    latency = time.monotonic() - start
+
+    print(f"Cancel took {latency:.3f}s")
+    sys.exit(0 if latency < MAX_CANCEL_LATENCY_S else 1)
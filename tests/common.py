@@ -0,0 +1,124 @@
+#
+# Helpers shared by the test and benchmark scripts.  Each script runs the OU on a dev
+# computer, with the mock executables in tests/rauc standing in for RAUC, and drives it
+# over HTTP.
+
+import http.client
+from json import loads
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+from onboardupdater.configuration import Configuration
+from onboardupdater.onboardupdater import OnboardUpdater
+
+
+def get_config(port: int, update_write_path: str) -> Configuration:
+    """
+    Returns a configuration that runs the OU against the mock RAUC executables, with every
+    command succeeding and no reboot after an install.  There is no journal, so each run
+    starts from a clean slate whatever an earlier run left behind.
+    """
+
+    config = Configuration()
+    config.journal_path = None
+    config.override_cmds = ["tests/rauc/mock_rauc_success.sh"]
+    config.reboot_after_update = False
+    config.reboot_sleep_time_s = 0
+    config.revert_cmds = ["tests/rauc/mock_rauc_success.sh"]
+    config.server_port = port
+    config.slots_cmds = ["tests/rauc/mock_rauc_status.sh"]
+    config.update_cmds = ["tests/rauc/mock_rauc_update_success.sh"]
+    config.update_write_path = update_write_path
+    config.version_path = "tests/data/version.json"
+    return config
+
+
+def start_ou(config: Configuration) -> None:
+    """
+    Starts the OU on a thread of its own and returns once it is serving.
+    """
+
+    logging.basicConfig(level=logging.WARNING)
+
+    ou = OnboardUpdater(config)
+    threading.Thread(target=ou.start, daemon=True).start()
+    Client(config.server_port).wait_until_serving()
+
+
+class Client:
+    """
+    Talks to the OU over HTTP.  Each request has a connection of its own, so one client can
+    be shared between threads.
+    """
+
+    def __init__(self, port: int, timeout_s: float = 60):
+        self.port = port
+        self.timeout_s = timeout_s
+
+    def send(self, method: str, route: str, body=None, headers: dict = {}) -> http.client.HTTPResponse:
+        """
+        Returns the response with its body read into data.
+        """
+
+        connection = http.client.HTTPConnection("localhost", self.port, timeout=self.timeout_s)
+
+        try:
+            connection.request(method, route, body=body, headers=headers)
+            response = connection.getresponse()
+            response.data = response.read()
+            return response
+        finally:
+            connection.close()
+
+    def request(self, method: str, route: str, body=None, headers: dict = {}) -> Tuple[int, dict]:
+        response = self.send(method, route, body, headers)
+        return response.status, loads(response.data)
+
+    def get_status(self) -> dict:
+        return self.request("GET", "/status")[1]
+
+    def get_status_version(self, wait_version: Optional[int] = None) -> Tuple[int, dict]:
+        """
+        Returns the status version and the status, waiting for it to change from
+        wait_version if given.
+        """
+
+        route = "/status" if wait_version is None else f"/status?wait={wait_version}"
+        response = self.send("GET", route)
+        return int(response.headers["X-Status-Version"]), loads(response.data)
+
+    def wait_for_state(self, *states: str, timeout_s: float = 30) -> dict:
+        """
+        Returns the status once it is in any of the states given.
+        """
+
+        deadline = time.monotonic() + timeout_s
+
+        while time.monotonic() < deadline:
+            status = self.get_status()
+            if status["state"] in states:
+                return status
+
+            time.sleep(0.01)
+
+        raise TimeoutError(f"Timed out waiting for {' or '.join(states)}, still in {status['state']}")
+
+    def wait_until_serving(self, timeout_s: float = 10) -> None:
+        deadline = time.monotonic() + timeout_s
+
+        while True:
+            try:
+                self.get_status()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+
+                time.sleep(0.01)
+
+
+def check(name: str, passed: bool) -> bool:
+    print(f"{name}: {'ok' if passed else 'FAILED'}")
+    return passed
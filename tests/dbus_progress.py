@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.dbus_progress".  Needs jeepney and
+# dbus-daemon.
+
+import subprocess
+import sys
+import time
+
+from tests.common import Client, get_config, start_ou
+
+
+def follow_install(client: Client, timeout_s: float) -> list:
+    """
+    Returns every status seen from rauc_update until the OU leaves it.
+    """
+
+    deadline = time.monotonic() + timeout_s
+    statuses = []
+    version = -1
+
+    while time.monotonic() < deadline:
+        version, status = client.get_status_version(version)
+
+        if status["state"] == "rauc_update":
+            statuses.append(status)
+        elif statuses:
+            statuses.append(status)
+            return statuses
+
+    raise TimeoutError("Timed out following the install")
+
+
+if __name__ == "__main__":
+    # Install through a mock RAUC service on a private bus, once succeeding and once failing,
+    # and check the progress and result come through in the status.
+    bus = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address=1"], stdout=subprocess.PIPE, text=True
+    )
+    address = bus.stdout.readline().strip()
+
+    rauc = subprocess.Popen([sys.executable, "tests/rauc/mock_rauc_dbus.py", address], stdout=subprocess.PIPE)
+    rauc.stdout.readline()
+
+    results = []
+
+    try:
+        runs = [(8084, "/tmp/update.rauc", "success"), (8085, "/tmp/update-fail.rauc", "failed")]
+        for port, update_write_path, expected in runs:
+            config = get_config(port, update_write_path)
+            config.progress_source = "dbus"
+            config.rauc_dbus_bus = address
+            start_ou(config)
+            client = Client(port)
+
+            print(client.request("POST", "/update", b"not really a bundle"))
+            statuses = follow_install(client, 10)
+
+            for status in statuses:
+                print(status["state"], status["rauc_state"])
+
+            rauc_states = [status["rauc_state"] for status in statuses]
+            results.append(any(state.endswith("%") for state in rauc_states) and rauc_states[-1].startswith(expected))
+    finally:
+        rauc.kill()
+        bus.kill()
+
+    sys.exit(0 if all(results) else 1)
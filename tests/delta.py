@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.delta".
+#
+# Sends a bundle as a delta upload (manifest, missing chunks, assemble) and then a second
+# bundle that shares most of its chunks with the first, checking that only the changed
+# chunks are asked for and that each bundle is staged with the right digest.  Also checks
+# that bad chunks, early assembles and oversized manifests are refused.
+
+import hashlib
+from json import dumps
+import os
+import shutil
+import sys
+import time
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8096
+CHUNK_SIZE = 64 * 1024
+CHUNK_COUNT = 32
+MANIFEST_MAX_BYTES = 16 * 1024
+
+client = Client(PORT, timeout_s=10)
+
+
+def get_manifest(chunks: list) -> str:
+    bundle = b"".join(chunks)
+    return dumps(
+        {
+            "chunks": [hashlib.sha256(chunk).hexdigest() for chunk in chunks],
+            "sha256": hashlib.sha256(bundle).hexdigest(),
+        }
+    )
+
+
+def send_missing(chunks: list, missing: list) -> None:
+    by_hash = {hashlib.sha256(chunk).hexdigest(): chunk for chunk in chunks}
+    for sha256 in missing:
+        client.request("PUT", f"/update/chunk/{sha256}", by_hash[sha256])
+
+
+if __name__ == "__main__":
+    config = get_config(PORT, "/tmp/update-delta.raucb")
+    config.chunk_manifest_max_bytes = MANIFEST_MAX_BYTES
+    shutil.rmtree(f"{config.update_write_path}.chunks", ignore_errors=True)
+    start_ou(config)
+
+    # The last chunk repeats the first, so it should only be asked for once.
+    chunks = [os.urandom(CHUNK_SIZE) for _ in range(CHUNK_COUNT - 1)]
+    chunks.append(chunks[0])
+    results = []
+
+    print("First bundle")
+    status, response = client.request("POST", "/update/manifest", get_manifest(chunks))
+    missing = response["missing"]
+    expected = [hashlib.sha256(chunk).hexdigest() for chunk in chunks[:-1]]
+    results.append(check(f"{status}: {len(missing)} missing", status == 200 and missing == expected))
+
+    status, _ = client.request("PUT", f"/update/chunk/{missing[0]}", chunks[1])
+    results.append(check(f"chunk that doesn't match its hash: {status}", status == 400))
+
+    send_missing(chunks, missing[:-1])
+    status, _ = client.request("POST", "/update/assemble?stage")
+    results.append(check(f"assemble with a chunk missing: {status}", status == 409))
+
+    send_missing(chunks, missing[-1:])
+    status, _ = client.request("POST", "/update/assemble?stage")
+    bundle = b"".join(chunks)
+    staged = client.wait_for_state("staged")
+    results.append(check("staged", status == 200 and staged["bundle_sha256"] == hashlib.sha256(bundle).hexdigest()))
+    with open(config.update_write_path, "rb") as f:
+        results.append(check("bundle in place", f.read() == bundle))
+
+    print("Second bundle, two chunks changed")
+    chunks[3] = os.urandom(CHUNK_SIZE)
+    chunks[10] = os.urandom(CHUNK_SIZE)
+    _, response = client.request("POST", "/update/manifest", get_manifest(chunks))
+    missing = response["missing"]
+    expected = [hashlib.sha256(chunks[3]).hexdigest(), hashlib.sha256(chunks[10]).hexdigest()]
+    results.append(check(f"{len(missing)} missing", missing == expected))
+
+    send_missing(chunks, missing)
+    client.request("POST", "/update/assemble?stage")
+    sha256 = hashlib.sha256(b"".join(chunks)).hexdigest()
+    # Already staged, so wait for the new bundle to take the old one's place.
+    deadline = time.monotonic() + 10
+    while client.get_status()["bundle_sha256"] != sha256 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    results.append(check("staged", client.wait_for_state("staged")["bundle_sha256"] == sha256))
+
+    print("Oversized manifest")
+    chunks = [os.urandom(16) for _ in range(MANIFEST_MAX_BYTES // 64)]
+    status, response = client.request("POST", "/update/manifest", get_manifest(chunks))
+    results.append(check(f"{status} {response}", status == 413))
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.fetch".
+
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+import os
+import sys
+import threading
+import time
+
+from tests.common import Client, get_config, start_ou
+
+PORT = 8082
+BUNDLE_PORT = 8083
+BUNDLE_SIZE = 5 * 1024 * 1024 + 123
+# Every this many responses, the stand-in server drops the connection part way through.
+DROP_EVERY = 3
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for the server the bundle is fetched from.  It supports single Range
+    requests over keep-alive connections and now and then cuts a response short so that
+    resuming gets exercised.  With stingy set it instead cuts every response longer than
+    that short, with range_offset set it reports a Content-Range other than the one asked
+    for, and with silent set it hangs up without answering at all.
+    """
+
+    protocol_version = "HTTP/1.1"
+    bundle = b""
+    served = 0
+    stingy = 0
+    range_offset = 0
+    silent = False
+    lock = threading.Lock()
+
+    def do_GET(self):
+        start, end = 0, len(self.bundle) - 1
+        status = 200
+
+        if self.headers["range"] is not None:
+            first, _, last = self.headers["range"].partition("=")[2].partition("-")
+            start, end = int(first), min(int(last or end), end)
+            status = 206
+
+        with RangeRequestHandler.lock:
+            RangeRequestHandler.served += 1
+            drop = RangeRequestHandler.served % DROP_EVERY == 0
+
+        if self.silent:
+            self.close_connection = True
+            return
+
+        body = self.bundle[start : end + 1]
+        if self.stingy:
+            drop = len(body) > self.stingy
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 206:
+            offset = self.range_offset
+            self.send_header("Content-Range", f"bytes {start + offset}-{end + offset}/{len(self.bundle)}")
+        self.end_headers()
+
+        try:
+            if drop:
+                self.wfile.write(body[: len(body) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+        except ConnectionError:
+            # The updater hung up on a response it didn't want.
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    # Have the updater fetch a bundle from a local server that keeps dropping connections,
+    # then check the bundle arrived intact and was handed on to RAUC.  Then check a fetch
+    # with the wrong digest fails before RAUC runs, that a segment which keeps dropping
+    # isn't given up on while it makes progress and that a range other than the one asked
+    # for is refused.
+    RangeRequestHandler.bundle = os.urandom(BUNDLE_SIZE)
+    sha256 = hashlib.sha256(RangeRequestHandler.bundle).hexdigest()
+
+    server = ThreadingHTTPServer(("localhost", BUNDLE_PORT), RangeRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    config = get_config(PORT, "/tmp/update.rauc")
+    config.fetch_retry_backoff_s = 0.1
+    config.fetch_segment_bytes = 1024 * 1024
+    start_ou(config)
+    client = Client(PORT)
+
+    fetch = {"url": f"http://localhost:{BUNDLE_PORT}/bundle.raucb", "sha256": sha256, "size": BUNDLE_SIZE}
+
+    start = time.monotonic()
+    print(client.request("POST", "/update/fetch?stage", dumps(fetch).encode()))
+    status = client.wait_for_state("staged")
+    print(f"Fetched {status['upload_written']} bytes in {time.monotonic() - start:.3f}s")
+
+    with open(config.update_write_path, "rb") as f:
+        fetched_ok = f.read() == RangeRequestHandler.bundle
+
+    print(f"Fetched bundle {'matches' if fetched_ok else 'does not match'}")
+
+    fetch["sha256"] = "0" * 64
+    print(client.request("POST", "/update/fetch", dumps(fetch).encode()))
+    status = client.wait_for_state("failed")
+    print(status["last_error"])
+    digest_ok = "digest mismatch" in status["last_error"]
+
+    # Every segment drops several times, each time after getting halfway.
+    config.fetch_retries = 1
+    RangeRequestHandler.stingy = 128 * 1024
+    fetch["sha256"] = sha256
+    print(client.request("POST", "/update/fetch?stage", dumps(fetch).encode()))
+    status = client.wait_for_state("staged")
+    print(f"Fetched {status['upload_written']} bytes from a server that keeps dropping")
+    RangeRequestHandler.stingy = 0
+
+    RangeRequestHandler.range_offset = 1
+    print(client.request("POST", "/update/fetch", dumps(fetch).encode()))
+    status = client.wait_for_state("failed")
+    print(status["last_error"])
+    range_ok = "server sent 'bytes " in status["last_error"]
+    RangeRequestHandler.range_offset = 0
+
+    # Cancel while every connection is waiting to retry; none should be retried.
+    config.fetch_retries = 5
+    config.fetch_retry_backoff_s = 1
+    RangeRequestHandler.silent = True
+    print(client.request("POST", "/update/fetch", dumps(fetch).encode()))
+    time.sleep(0.3)
+    print(client.request("POST", "/cancel"))
+    served = RangeRequestHandler.served
+    time.sleep(config.fetch_retry_backoff_s * 1.5)
+    status = client.get_status()
+    parts = [name for name in os.listdir("/tmp") if name.startswith("update.rauc.") and name.endswith(".part")]
+    print(f"{RangeRequestHandler.served - served} requests after the cancel, {status['state']}, staging files {parts}")
+    cancel_ok = RangeRequestHandler.served == served and status["state"] == "ready" and not parts
+
+    sys.exit(0 if fetched_ok and digest_ok and range_ok and cancel_ok else 1)
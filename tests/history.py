@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.history".
+#
+# Posts more boot states than the history holds and checks what /history returns for
+# various values of since: only newer events, the number to ask for next, and whether
+# anything asked for has been overwritten.  Then fails an install and checks the history
+# is written to the log.
+
+import logging
+import sys
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8093
+CAPACITY = 8
+
+client = Client(PORT, timeout_s=10)
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+def get_history(since: int = None) -> dict:
+    return client.request("GET", "/history" if since is None else f"/history?since={since}")[1]
+
+
+if __name__ == "__main__":
+    config = get_config(PORT, "/tmp/update-history.raucb")
+    config.history_capacity = CAPACITY
+    config.history_log_on_failure = True
+    config.update_cmds = ["tests/rauc/mock_rauc_update_failed.sh"]
+
+    logging.basicConfig(level=logging.WARNING)
+    capture = Capture()
+    logging.getLogger().addHandler(capture)
+    start_ou(config)
+
+    results = []
+
+    print("Before the ring wraps")
+    for n in range(3):
+        client.request("POST", "/bootstate", f"boot {n}".encode())
+    history = get_history()
+    values = [event["value"] for event in history["events"]]
+    results.append(check(f"all held: {values}", values == ["boot 0", "boot 1", "boot 2"] and not history["dropped"]))
+    first_next = history["next"]
+    results.append(check(f"nothing new after {first_next}", get_history(first_next)["events"] == []))
+
+    print("After the ring wraps")
+    for n in range(3, 3 + CAPACITY):
+        client.request("POST", "/bootstate", f"boot {n}".encode())
+    history = get_history(first_next)
+    seqs = [event["seq"] for event in history["events"]]
+    results.append(
+        check(
+            f"since {first_next}: seqs {seqs}, next {history['next']}",
+            seqs == list(range(first_next + 1, first_next + CAPACITY + 1)) and not history["dropped"],
+        )
+    )
+    history = get_history(0)
+    results.append(check(f"since 0: {len(history['events'])} held", len(history["events"]) == CAPACITY))
+    results.append(check("dropped reported", history["dropped"]))
+    history = get_history(history["next"] - 2)
+    values = [event["value"] for event in history["events"]]
+    results.append(check(f"last two: {values}", values == [f"boot {1 + CAPACITY}", f"boot {2 + CAPACITY}"]))
+    history = get_history(history["next"] + 100)
+    results.append(check("a number from a previous run starts over", len(history["events"]) == CAPACITY))
+
+    print("Bad since")
+    for since in ["-5", "x"]:
+        status, _ = client.request("GET", f"/history?since={since}")
+        results.append(check(f"since={since}: {status}", status == 400))
+
+    print("Log on failure")
+    client.request("POST", "/update", b"x" * 1024)
+    client.wait_for_state("failed")
+    logged = [message for message in capture.messages if message.startswith("History ")]
+    results.append(
+        check(
+            f"{len(logged)} events logged, last '{logged[-1] if logged else ''}'",
+            len(logged) == CAPACITY and "last_error" in logged[-1],
+        )
+    )
+
+    sys.exit(0 if all(results) else 1)
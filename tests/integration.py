@@ -18,6 +18,7 @@ if __name__ == "__main__":
     # config.override_cmds = ["tests/rauc/mock_rauc_failed.sh"]
     config.reboot_after_update = False
     config.revert_cmds = ["tests/rauc/mock_rauc_success.sh"]
+    config.slots_cmds = ["tests/rauc/mock_rauc_status.sh"]
     # config.revert_cmds = ["tests/rauc/mock_rauc_failed.sh"]
     config.update_cmds = ["tests/rauc/mock_rauc_update_success.sh"]
     # config.update_cmds = ["tests/rauc/mock_rauc_update_failed.sh"]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.inventory".
+#
+# Checks that /version follows the version file as it changes on disk and that /slots is
+# served from the cache: the slots command runs at start and after a revert, not once per
+# request, and output it can't make sense of neither breaks /slots nor stops it refreshing.
+
+from json import loads
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8091
+DIRECTORY = "/tmp/inventory-test"
+VERSION_PATH = f"{DIRECTORY}/version.json"
+# What the slots command prints, and a line per run of it.
+SLOTS_PATH = f"{DIRECTORY}/slots.json"
+RUNS_PATH = f"{DIRECTORY}/runs"
+
+client = Client(PORT, timeout_s=10)
+
+
+def request(method: str, route: str, headers: dict = {}):
+    response = client.send(method, route, headers=headers)
+    return response.status, response.headers["ETag"], response.data
+
+
+def get_runs() -> int:
+    with open(RUNS_PATH, "r") as f:
+        return len(f.readlines())
+
+
+def wait_for(condition, timeout_s: float = 5) -> bool:
+    deadline = time.monotonic() + timeout_s
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+
+        time.sleep(0.01)
+
+    return False
+
+
+def write_slots(data: bytes) -> None:
+    with open(SLOTS_PATH, "wb") as f:
+        f.write(data)
+
+
+def revert() -> None:
+    client.request("POST", "/revert")
+    client.wait_for_state("ready", timeout_s=5)
+
+
+if __name__ == "__main__":
+    shutil.rmtree(DIRECTORY, ignore_errors=True)
+    os.makedirs(DIRECTORY)
+    shutil.copy("tests/data/version.json", VERSION_PATH)
+    rauc_status = subprocess.run(["tests/rauc/mock_rauc_status.sh"], stdout=subprocess.PIPE).stdout
+    write_slots(rauc_status)
+    open(RUNS_PATH, "w").close()
+
+    config = get_config(PORT, f"{DIRECTORY}/update.raucb")
+    config.slots_cmds = ["sh", "-c", f"echo run >> {RUNS_PATH}; cat {SLOTS_PATH}"]
+    config.version_path = VERSION_PATH
+    start_ou(config)
+
+    results = []
+
+    print("Version")
+    status, etag, data = request("GET", "/version")
+    results.append(check(f"served: {status} {etag}", status == 200 and "branch" in loads(data)))
+    results.append(check("unchanged is not modified", request("GET", "/version", {"If-None-Match": etag})[0] == 304))
+
+    # Replace the file the way an installer would, with a rename.
+    with open(f"{VERSION_PATH}.tmp", "w") as f:
+        f.write('{"version": "9.9.9"}')
+    os.replace(f"{VERSION_PATH}.tmp", VERSION_PATH)
+    results.append(check("follows a replaced file", wait_for(lambda: b"9.9.9" in request("GET", "/version")[2])))
+
+    with open(VERSION_PATH, "w") as f:
+        f.write('{"version": "10.0.0"}')
+    results.append(check("follows a rewritten file", wait_for(lambda: b"10.0.0" in request("GET", "/version")[2])))
+    results.append(check("tag changes with the file", request("GET", "/version", {"If-None-Match": etag})[0] == 200))
+
+    print("Slots")
+    results.append(check("read at start", wait_for(lambda: request("GET", "/slots")[0] == 200)))
+    status, etag, data = request("GET", "/slots")
+    slots = loads(data)
+    results.append(
+        check(
+            f"booted {slots['booted']}, rootfs.0 {slots['slots']['rootfs.0']['bundle_version']}",
+            slots["booted"] == "A" and slots["slots"]["rootfs.0"]["bundle_version"] == "1.4.2",
+        )
+    )
+
+    for _ in range(50):
+        request("GET", "/slots")
+    results.append(check(f"50 requests, {get_runs()} runs", get_runs() == 1))
+
+    write_slots(b'{"slots": [{"rootfs.0": null}]}')
+    revert()
+    results.append(check("refreshed after a revert", wait_for(lambda: get_runs() == 2)))
+    status, _, data = request("GET", "/slots")
+    results.append(check("bad output keeps the last slots", status == 200 and loads(data) == slots))
+
+    write_slots(rauc_status.replace(b'"booted":"A"', b'"booted":"B"'))
+    revert()
+    refreshed = wait_for(lambda: loads(request("GET", "/slots")[2])["booted"] == "B")
+    results.append(check("still refreshing after bad output", refreshed))
+    results.append(check("tag changes with the slots", request("GET", "/slots", {"If-None-Match": etag})[0] == 200))
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.pipeline".
+#
+# Installs through a mock streaming installer that reads the bundle with Range requests
+# (tests/rauc/mock_rauc_stream_install.py), with the upload paced so that uploading and
+# installing take about as long as each other.  Compares the time to install with and
+# without pipelining, and checks that a cancel, a dropped upload and a bad digest all
+# shut both sides down and that a new upload session can't replace one being installed.
+
+import hashlib
+import os
+import socket
+import sys
+import threading
+import time
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8089
+BUNDLE_SIZE = 8 * 1024 * 1024
+PIECE_SIZE = 256 * 1024
+# The upload sends a piece, and the installer takes a piece, this often.
+PIECE_PERIOD_S = 0.05
+
+client = Client(PORT)
+
+
+def paced(data: bytes, stop_after: int = None):
+    for offset in range(0, len(data), PIECE_SIZE):
+        if stop_after is not None and offset >= stop_after:
+            return
+
+        yield data[offset : offset + PIECE_SIZE]
+        time.sleep(PIECE_PERIOD_S)
+
+
+def install(bundle: bytes, route: str, headers: dict = {}) -> float:
+    """
+    Uploads the bundle and returns how long it took until the install was over.
+    """
+
+    start = time.monotonic()
+
+    try:
+        status, response = client.request("POST", route, paced(bundle), {"Content-Length": str(len(bundle)), **headers})
+        print(f"  {route}: {status} {response}")
+    except ConnectionError as e:
+        # The OU stops reading an upload whose install has been cancelled.
+        print(f"  {route}: {e!r}")
+
+    # With reboot_after_update off, a successful install goes through reboot back to ready.
+    client.wait_for_state("ready", "failed")
+
+    return time.monotonic() - start
+
+
+def upload_tail_first(bundle: bytes, headers: dict = {}) -> None:
+    """
+    Sends the bundle through a pipelined upload session, starting with its last piece, and
+    commits it with the headers given.
+    """
+
+    status, session = client.request("POST", "/upload?pipeline", headers={"X-Upload-Length": str(len(bundle))})
+    print(f"  session: {status} {session}")
+
+    pieces = list(range(0, len(bundle), PIECE_SIZE))
+    for offset in pieces[-1:] + pieces[:-1]:
+        piece = bundle[offset : offset + PIECE_SIZE]
+        content_range = f"bytes {offset}-{offset + len(piece) - 1}/{len(bundle)}"
+        status, _ = client.request("PUT", f"/upload/{session['id']}", piece, {"Content-Range": content_range})
+        if status != 200:
+            raise RuntimeError(f"Range {content_range} refused with {status}")
+
+        time.sleep(PIECE_PERIOD_S)
+
+    route = f"/upload/{session['id']}/commit"
+    print(f"  commit: {client.request('POST', route, headers=headers)}")
+
+
+def drop_upload(bundle: bytes, after: int) -> None:
+    # Send part of the bundle then drop the connection.
+    connection = socket.create_connection(("localhost", PORT))
+    connection.sendall(f"POST /update?pipeline HTTP/1.1\r\nContent-Length: {len(bundle)}\r\n\r\n".encode())
+    for piece in paced(bundle, after):
+        connection.sendall(piece)
+    connection.close()
+
+
+if __name__ == "__main__":
+    config = get_config(PORT, "/tmp/update-pipeline.raucb")
+    config.update_cmds = [
+        sys.executable,
+        "tests/rauc/mock_rauc_stream_install.py",
+        "--tail-first",
+        f"--chunk-bytes={PIECE_SIZE}",
+        f"--delay-s={PIECE_PERIOD_S}",
+    ]
+    start_ou(config)
+
+    bundle = os.urandom(BUNDLE_SIZE)
+    digest = {"X-Bundle-SHA256": hashlib.sha256(bundle).hexdigest()}
+    results = []
+
+    # The streaming installer reads the signature at the end first, so only the upload
+    # session, which can send the end first, gets any overlap.  A plain upload still works.
+    print("Plain upload, installed once it is in")
+    sequential_s = install(bundle, "/update", digest)
+    results.append(check(f"sequential install {sequential_s:.2f}s", client.get_status()["rauc_state"] == "success"))
+
+    print("Plain upload, pipelined")
+    plain_pipelined_s = install(bundle, "/update?pipeline", digest)
+    results.append(check(f"pipelined install {plain_pipelined_s:.2f}s", client.get_status()["rauc_state"] == "success"))
+
+    print("Upload session, tail first, pipelined")
+    start = time.monotonic()
+    upload_tail_first(bundle)
+    client.wait_for_state("ready", "failed")
+    session_pipelined_s = time.monotonic() - start
+    status = client.get_status()
+    results.append(
+        check(
+            f"pipelined session install {session_pipelined_s:.2f}s vs {sequential_s:.2f}s sequential",
+            status["rauc_state"] == "success" and session_pipelined_s < sequential_s * 0.75,
+        )
+    )
+    with open(config.update_write_path, "rb") as f:
+        results.append(check("bundle in place", hashlib.sha256(f.read()).hexdigest() == digest["X-Bundle-SHA256"]))
+
+    print("Cancel part way through")
+    thread = threading.Thread(target=install, args=(bundle, "/update?pipeline", digest))
+    thread.start()
+    client.wait_for_state("pipelined_update")
+    time.sleep(0.5)
+    print(f"  cancel: {client.request('POST', '/cancel')}")
+    thread.join()
+    parts = [name for name in os.listdir("/tmp") if name.startswith("update-pipeline.raucb.")]
+    parts = [name for name in parts if name.endswith(".part")]
+    status = client.get_status()
+    cancelled = status["state"] == "ready" and not parts
+    results.append(check(f"cancelled: {status['state']}, staging files {parts}", cancelled))
+
+    print("Upload dropped part way through")
+    drop_upload(bundle, BUNDLE_SIZE // 2)
+    status = client.wait_for_state("failed")
+    results.append(check(f"dropped: {status['last_error']}", status["last_error"] == "upload ended early"))
+
+    print("New session while a pipelined one is installing")
+    length = {"X-Upload-Length": str(len(bundle))}
+    _, session = client.request("POST", "/upload?pipeline", headers=length)
+    client.wait_for_state("pipelined_update")
+    replacements = [client.request("POST", route, headers=length)[0] for route in ["/upload", "/upload?pipeline"]]
+    staging_path = f"{config.update_write_path}.upload"
+    results.append(
+        check(
+            f"refused with {replacements}, staging file kept",
+            replacements == [409, 409] and os.path.getsize(staging_path) == len(bundle),
+        )
+    )
+    results.append(check("session kept", client.request("GET", f"/upload/{session['id']}")[0] == 200))
+    client.request("POST", "/cancel")
+    client.wait_for_state("ready")
+    status, _ = client.request("POST", "/upload", headers=length)
+    results.append(check(f"accepted once the install is over: {status}", status == 200))
+
+    print("Wrong digest")
+    install(bundle, "/update?pipeline", {"X-Bundle-SHA256": "0" * 64})
+    status = client.get_status()
+    results.append(check(f"bad digest: {status['last_error']}", status["last_error"].startswith("bundle digest")))
+
+    print("Upload session, wrong digest at commit")
+    upload_tail_first(bundle, {"X-Bundle-SHA256": "0" * 64})
+    # Failed if the install was still going, or rolled back to ready if it had finished.
+    client.wait_for_state("ready", "failed")
+    status = client.get_status()
+    leftovers = [
+        name
+        for name in os.listdir("/tmp")
+        if name.startswith("update-pipeline.raucb.") and name.endswith((".part", ".upload", ".session"))
+    ]
+    results.append(
+        check(
+            f"bad session digest: rauc_state '{status['rauc_state']}', files left {leftovers}",
+            status["last_error"].startswith("bundle digest")
+            and not status["rauc_state"].startswith("in progress")
+            and not leftovers,
+        )
+    )
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# A stand-in for the RAUC service's D-Bus API, for testing the "dbus" progress source
+# without RAUC.  Run it against a private bus:
+#
+#   tests/rauc/mock_rauc_dbus.py <bus address>
+#
+# InstallBundle reports progress much as RAUC does, then completes.  A bundle path with
+# "fail" in it fails part way through.
+
+import sys
+import time
+
+from jeepney import DBusAddress, HeaderFields, MessageType, new_error, new_method_return, new_signal
+from jeepney.bus_messages import message_bus
+from jeepney.io.blocking import open_dbus_connection
+
+INTERFACE = "de.pengutronix.rauc.Installer"
+INSTALLER = DBusAddress("/", interface=INTERFACE)
+PROPERTIES = DBusAddress("/", interface="org.freedesktop.DBus.Properties")
+
+STEPS = [
+    (0, "Installing", 1),
+    (10, "Determining slot states", 2),
+    (20, "Determining slot states done.", 2),
+    (40, "Checking bundle", 2),
+    (60, "Checking bundle done.", 2),
+    (80, "Copying image to rootfs.0", 2),
+    (100, "Installing done.", 1),
+]
+
+
+class MockRauc:
+    def __init__(self, connection):
+        self.connection = connection
+        self.properties = {"Operation": ("s", "idle"), "LastError": ("s", ""), "Progress": ("(isi)", (0, "", 0))}
+
+    def set_properties(self, **changed) -> None:
+        for name, value in changed.items():
+            self.properties[name] = (self.properties[name][0], value)
+
+        values = {name: self.properties[name] for name in changed}
+        self.connection.send(new_signal(PROPERTIES, "PropertiesChanged", "sa{sv}as", (INTERFACE, values, [])))
+
+    def install(self, path: str) -> None:
+        self.set_properties(Operation="installing", LastError="")
+
+        for percent, message, depth in STEPS:
+            if "fail" in path and percent == 80:
+                self.set_properties(LastError="Failed updating slot rootfs.0")
+                self.set_properties(Progress=(100, "Installing failed.", 1), Operation="idle")
+                self.connection.send(new_signal(INSTALLER, "Completed", "i", (1,)))
+                return
+
+            self.set_properties(Progress=(percent, message, depth))
+            time.sleep(0.05)
+
+        self.set_properties(Operation="idle")
+        self.connection.send(new_signal(INSTALLER, "Completed", "i", (0,)))
+
+    def handle(self, message) -> None:
+        if message.header.message_type != MessageType.method_call:
+            return
+
+        member = message.header.fields.get(HeaderFields.member)
+        interface = message.header.fields.get(HeaderFields.interface)
+
+        if interface == INTERFACE and member == "InstallBundle":
+            self.connection.send(new_method_return(message))
+            self.install(message.body[0])
+        elif interface == PROPERTIES.interface and member == "Get":
+            self.connection.send(new_method_return(message, "v", (self.properties[message.body[1]],)))
+        else:
+            self.connection.send(new_error(message, "org.freedesktop.DBus.Error.UnknownMethod"))
+
+
+if __name__ == "__main__":
+    connection = open_dbus_connection(sys.argv[1])
+    connection.send_and_get_reply(message_bus.RequestName("de.pengutronix.rauc"))
+    print("ready", flush=True)
+
+    rauc = MockRauc(connection)
+    while True:
+        rauc.handle(connection.receive())
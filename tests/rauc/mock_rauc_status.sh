@@ -0,0 +1,7 @@
+#!/usr/bin/env sh
+#
+# Stands in for "rauc status --detailed --output-format=json" on an A/B system booted from A.
+
+cat <<'JSON'
+{"compatible":"onboard-computer","variant":"","booted":"A","boot_primary":"rootfs.0","slots":[{"rootfs.0":{"class":"rootfs","device":"/dev/mmcblk0p2","type":"ext4","bootname":"A","state":"booted","parent":null,"mountpoint":"/","boot_status":"good","slot_status":{"bundle":{"compatible":"onboard-computer","version":"1.4.2","description":null,"build":"20260915","hash":null},"checksum":{"sha256":"1fd5ec1e49a4ccb07c44bd8d9fbd5c3e2fa9e2a1d3e77e0ad0cee7d6d2f7b3c9","size":268435456},"installed":{"timestamp":"2026-09-16T08:12:45Z","count":3},"activated":{"timestamp":"2026-09-16T08:12:46Z","count":3},"status":"ok"}}},{"rootfs.1":{"class":"rootfs","device":"/dev/mmcblk0p3","type":"ext4","bootname":"B","state":"inactive","parent":null,"mountpoint":null,"boot_status":"good","slot_status":{"bundle":{"compatible":"onboard-computer","version":"1.4.1","description":null,"build":"20260802","hash":null},"checksum":{"sha256":"9a0c1f4e3b7d2a6c5e8f1b0d4a7c3e6f2b9d8a1c5e4f7b0a3d6c9e2f1b8a7d4c","size":268435456},"installed":{"timestamp":"2026-08-03T10:01:12Z","count":2},"activated":{"timestamp":"2026-08-03T10:01:13Z","count":2},"status":"ok"}}}]}
+JSON
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Stands in for "rauc install" with a streaming bundle.  Given a URL it reads the bundle
+# with Range requests as RAUC does, optionally starting with the signature at the end of
+# the bundle; given a path it reads the file.  It prints progress like "rauc install" and
+# sleeps after each chunk to stand in for writing the slot.
+#
+# Usage: mock_rauc_stream_install.py [--chunk-bytes N] [--delay-s S] [--tail-first] <bundle>
+
+import argparse
+import http.client
+import os
+import sys
+import time
+from urllib.parse import urlsplit
+
+SIGNATURE_BYTES = 8192
+
+
+class HttpBundle:
+    def __init__(self, url: str):
+        self.url = urlsplit(url)
+        self.connection = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=120)
+        self.connection.request("HEAD", self.url.path)
+        response = self.connection.getresponse()
+        response.read()
+
+        if response.status != 200:
+            raise OSError(f"HEAD returned {response.status}")
+
+        self.size = int(response.headers["Content-Length"])
+
+    def read(self, start: int, length: int) -> bytes:
+        headers = {"Range": f"bytes={start}-{start + length - 1}"}
+        self.connection.request("GET", self.url.path, headers=headers)
+        response = self.connection.getresponse()
+
+        if response.status != 206:
+            raise OSError(f"GET returned {response.status}")
+
+        data = response.read()
+        if len(data) != length:
+            raise OSError(f"Got {len(data)} of {length} bytes at {start}")
+
+        return data
+
+
+class FileBundle:
+    def __init__(self, path: str):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+
+    def read(self, start: int, length: int) -> bytes:
+        return os.pread(self.fd, length, start)
+
+
+def install(args) -> None:
+    print("installing", flush=True)
+    print("  0% Installing", flush=True)
+    print("  0% Checking bundle", flush=True)
+
+    if args.bundle.startswith("http://"):
+        bundle = HttpBundle(args.bundle)
+    else:
+        bundle = FileBundle(args.bundle)
+
+    if args.tail_first:
+        print("  0% Verifying signature", flush=True)
+        length = min(SIGNATURE_BYTES, bundle.size)
+        bundle.read(bundle.size - length, length)
+        print(" 10% Verifying signature done.", flush=True)
+
+    print(" 10% Checking bundle done.", flush=True)
+    print(" 10% Copying image to rootfs.0", flush=True)
+
+    position = 0
+    last_percent = 10
+
+    while position < bundle.size:
+        length = min(args.chunk_bytes, bundle.size - position)
+        bundle.read(position, length)
+        position += length
+        time.sleep(args.delay_s)
+
+        percent = 10 + position * 90 // bundle.size
+        if percent // 10 != last_percent // 10 and percent < 100:
+            print(f"{percent:3d}% Copying image to rootfs.0", flush=True)
+        last_percent = percent
+
+    print("100% Copying image to rootfs.0 done.", flush=True)
+    print("100% Installing done.", flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--delay-s", type=float, default=0.0)
+    parser.add_argument("--tail-first", action="store_true")
+    parser.add_argument("bundle")
+    args = parser.parse_args()
+
+    try:
+        install(args)
+    except (OSError, http.client.HTTPException) as e:
+        print(f"LastError: {e}", flush=True)
+        # RAUC writes the final failure notification to stderr, not stdout.
+        print(f"Installing `{args.bundle}` failed", file=sys.stderr, flush=True)
+        sys.exit(1)
+
+    print(f"Installing `{args.bundle}` succeeded", flush=True)
@@ -0,0 +1,21 @@
+#!/usr/bin/env sh
+
+set -eu
+
+write_line()
+{
+    echo "$@"
+    sleep 5
+}
+
+write_line "installing"
+write_line "  0% Installing"
+write_line "  0% Determining slot states"
+write_line " 20% Determining slot states done."
+write_line " 20% Checking bundle"
+write_line " 40% Checking bundle done."
+write_line " 80% Updating slots"
+write_line "100% Installing done."
+write_line "Installing \`/tmp/update.raucb\` succeeded"
+
+exit 0
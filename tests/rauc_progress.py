@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.rauc_progress".
+#
+# Feeds "rauc install" output to the progress parser a line at a time and checks the
+# rauc_state it gives after each line.
+
+import sys
+
+from onboardupdater.rauc import RaucProgressParser
+
+CASES = [
+    (
+        "success",
+        [
+            ("installing", "in progress: pending"),
+            ("  0% Installing", "in progress:   0%"),
+            (" 40% Checking bundle done.", "in progress:  40%"),
+            ("100% Installing done.", "in progress: 100%"),
+            ("Installing `/tmp/update.raucb` succeeded", "success"),
+        ],
+    ),
+    (
+        "failure",
+        [
+            (" 20% Checking bundle", "in progress:  20%"),
+            (" 40% Checking bundle failed.", "in progress:  40%"),
+            ("100% Installing failed.", "in progress: 100%"),
+            # The error counts as a failure as soon as it arrives, even if nothing follows.
+            ("LastError: Signature size exceeds bundle size", "failed: signature size exceeds bundle size"),
+            ("Installing `/tmp/update.raucb` failed", "failed: signature size exceeds bundle size"),
+        ],
+    ),
+    (
+        "only the first error",
+        [
+            ("LastError: Failed mounting bundle", "failed: failed mounting bundle"),
+            ("LastError: Something else", "failed: failed mounting bundle"),
+        ],
+    ),
+    (
+        "failure without an error",
+        [
+            ("Installing `/tmp/update.raucb` failed", "failed"),
+        ],
+    ),
+    (
+        "percentage RAUC didn't print as a number",
+        [
+            ("n/a% Checking bundle", "in progress: n/a%"),
+        ],
+    ),
+]
+
+
+if __name__ == "__main__":
+    results = []
+
+    parser = RaucProgressParser()
+    results.append(parser.status() == "in progress: starting")
+    print(f"no output: {parser.status()}")
+
+    for name, lines in CASES:
+        parser = RaucProgressParser()
+        print(name)
+
+        for line, expected in lines:
+            parser.feed(line)
+            status = parser.status()
+            passed = status == expected
+            results.append(passed)
+            print(f"  {line!r}: {status!r} {'ok' if passed else f'FAILED, expected {expected!r}'}")
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.recovery".
+#
+# Writes a range of journals, as a restart might find them, and checks the state runner
+# recovers a status from each that it can carry on from, with either engine.  Then checks
+# that upload progress is left out of the journal.
+
+from json import dumps
+import logging
+import os
+import shutil
+import sys
+
+from onboardupdater.configuration import Configuration
+from onboardupdater.staterunner import StateRunner
+from tests.common import check
+
+DIRECTORY = "/tmp/recovery-test"
+
+# The last journal record, whether the bundle is on disk, and the state, rauc_state and
+# last_error expected after recovery.
+CASES = [
+    ({"state": "ready"}, False, ("ready", "", "")),
+    ({"state": "reboot"}, False, ("ready", "", "")),
+    ({"state": "staged", "bundle_sha256": "ab" * 32}, True, ("staged", "", "")),
+    ({"state": "staged", "bundle_sha256": "ab" * 32}, False, ("ready", "", "")),
+    (
+        {"state": "rauc_update", "rauc_state": "in progress:  40%"},
+        True,
+        ("failed", "", "interrupted during rauc_update"),
+    ),
+    ({"state": "fetching_update"}, False, ("failed", "", "unknown state 'fetching_update' in journal")),
+    ({"state": "failed", "rauc_state": "failed: bad signature"}, False, ("failed", "failed: bad signature", "")),
+]
+
+
+def write_journal(path: str, record: dict) -> None:
+    with open(path, "w") as f:
+        f.write(dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+
+    shutil.rmtree(DIRECTORY, ignore_errors=True)
+    os.makedirs(DIRECTORY)
+
+    config = Configuration()
+    config.journal_path = f"{DIRECTORY}/journal"
+    config.update_write_path = f"{DIRECTORY}/update.raucb"
+    results = []
+
+    for engine in ["transitions", "table"]:
+        config.state_engine = engine
+        print(f"{engine} engine")
+
+        for record, bundle_exists, expected in CASES:
+            write_journal(config.journal_path, record)
+            if bundle_exists:
+                open(config.update_write_path, "wb").close()
+            elif os.path.exists(config.update_write_path):
+                os.remove(config.update_write_path)
+
+            try:
+                runner = StateRunner(config)
+            except ValueError as e:
+                results.append(check(f"  {record['state']}: {e!r}", False))
+                continue
+
+            status = runner.model.get_status()
+            recovered = (status.state, status.rauc_state, status.last_error)
+            # Whatever was recovered, an update has to be able to start from it.
+            passed = recovered == expected and (runner.can_trigger("update") or runner.can_trigger("install"))
+            where = "on" if bundle_exists else "off"
+            results.append(check(f"  {record['state']}, bundle {where} disk: {recovered}", passed))
+
+    print("Upload progress")
+    write_journal(config.journal_path, {"state": "ready"})
+    runner = StateRunner(config)
+    journal = runner.journal
+    journal.pending = []
+    runner.model.update_upload_progress(1024, 1024, 2048)
+    results.append(check("progress not journaled", journal.pending == []))
+    runner.model.update_last_error("something went wrong")
+    results.append(check("other changes journaled", len(journal.pending) == 1 and b"upload_" not in journal.pending[0]))
+
+    sys.exit(0 if all(results) else 1)
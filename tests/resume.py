@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.resume".
+#
+# Sends a range of an upload session, resets the connection part way through, then resumes,
+# once from where the OU says it got to and once from the start.  Either way the staged
+# bundle must have the right digest, and what arrived before the reset must still count.
+
+import hashlib
+import os
+import socket
+import struct
+import sys
+import time
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8090
+BUNDLE_SIZE = 1024 * 1024
+DROP_AFTER = 128 * 1024
+
+client = Client(PORT)
+
+
+def drop_range(id: str, bundle: bytes, start: int, sent: int) -> None:
+    """
+    Starts a PUT of the rest of the bundle from start, sends only sent bytes of it, then
+    resets the connection.
+    """
+
+    connection = socket.create_connection(("localhost", PORT))
+    content_range = f"bytes {start}-{len(bundle) - 1}/{len(bundle)}"
+    head = f"PUT /upload/{id} HTTP/1.1\r\nContent-Range: {content_range}\r\n"
+    head += f"Content-Length: {len(bundle) - start}\r\n\r\n"
+    connection.sendall(head.encode() + bundle[start : start + sent])
+    time.sleep(0.2)
+    # Linger with a zero timeout so the close sends a reset rather than a clean FIN.
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    connection.close()
+    time.sleep(0.2)
+
+
+def upload(bundle: bytes, resume_from_start: bool) -> dict:
+    digest = hashlib.sha256(bundle).hexdigest()
+    _, session = client.request("POST", "/upload", headers={"X-Upload-Length": str(len(bundle))})
+
+    drop_range(session["id"], bundle, 0, DROP_AFTER)
+    _, session = client.request("GET", f"/upload/{session['id']}")
+    print(f"  after reset: offset {session['offset']}")
+
+    start = 0 if resume_from_start else session["offset"]
+    content_range = f"bytes {start}-{len(bundle) - 1}/{len(bundle)}"
+    status, _ = client.request("PUT", f"/upload/{session['id']}", bundle[start:], {"Content-Range": content_range})
+    print(f"  resume from {start}: {status}")
+
+    route = f"/upload/{session['id']}/commit?stage"
+    print(f"  commit: {client.request('POST', route, headers={'X-Bundle-SHA256': digest})}")
+
+    return session
+
+
+if __name__ == "__main__":
+    config = get_config(PORT, "/tmp/update-resume.raucb")
+    start_ou(config)
+
+    bundle = os.urandom(BUNDLE_SIZE)
+    digest = hashlib.sha256(bundle).hexdigest()
+    results = []
+
+    for name, resume_from_start in [("from the offset", False), ("from the start", True)]:
+        print(f"Reset part way through a range, resumed {name}")
+        session = upload(bundle, resume_from_start)
+        results.append(check(f"bytes before the reset kept ({session['offset']})", session["offset"] > 0))
+
+        status = client.wait_for_state("staged", "failed")
+        results.append(
+            check(
+                f"staged: {status['state']} {status['last_error']}",
+                status["state"] == "staged" and status["bundle_sha256"] == digest,
+            )
+        )
+        with open(config.update_write_path, "rb") as f:
+            results.append(check("bundle in place", hashlib.sha256(f.read()).hexdigest() == digest))
+
+        client.request("POST", "/cancel")
+        client.wait_for_state("ready")
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# To run, from the project root, run "python3 -m tests.schedule".
+#
+# Stages a bundle and checks that a cancel while staged drops it before the state goes
+# back to ready, that a slow idle check doesn't hold up a cancel while scheduled, and that
+# the install goes ahead once the idle check passes.
+
+import hashlib
+import os
+import sys
+import time
+
+from tests.common import Client, check, get_config, start_ou
+
+PORT = 8092
+# How long the slow idle check takes, far longer than a cancel may.
+SLOW_CHECK_S = 30
+MAX_CANCEL_LATENCY_S = 1.0
+
+client = Client(PORT)
+
+
+def get_first_status(state: str, version: int) -> dict:
+    """
+    Returns the first status after version to show the given state, following every
+    change rather than polling so that what is seen on the way there can be checked.
+    """
+
+    while True:
+        version, status = client.get_status_version(version)
+        if status["state"] == state:
+            return status
+
+
+def stage(bundle: bytes) -> dict:
+    client.request("POST", "/update?stage", bundle, {"X-Bundle-SHA256": hashlib.sha256(bundle).hexdigest()})
+    return client.wait_for_state("staged")
+
+
+if __name__ == "__main__":
+    config = get_config(PORT, "/tmp/update-schedule.raucb")
+    config.install_idle_cmds = ["sleep", str(SLOW_CHECK_S)]
+    config.tick_period_s = 0.1
+    start_ou(config)
+
+    bundle = os.urandom(64 * 1024)
+    results = []
+
+    print("Cancel while staged")
+    status = stage(bundle)
+    results.append(check("staged", os.path.exists(config.update_write_path) and status["bundle_sha256"] != ""))
+    version, _ = client.get_status_version()
+    since = client.request("GET", "/history")[1]["next"]
+    client.request("POST", "/cancel")
+    status = get_first_status("ready", version)
+    results.append(
+        check(
+            f"dropped: sha256 '{status['bundle_sha256']}'",
+            not os.path.exists(config.update_write_path) and status["bundle_sha256"] == "",
+        )
+    )
+    # The history has every change in order, however quickly they came.
+    events = client.request("GET", f"/history?since={since}")[1]["events"]
+    changes = [(event["field"], event["value"]) for event in events]
+    results.append(check(f"dropped before ready: {changes}", changes == [("bundle_sha256", ""), ("state", "ready")]))
+
+    print("Cancel while scheduled, with the idle check still going")
+    stage(bundle)
+    client.request("POST", "/install")
+    client.wait_for_state("scheduled")
+    time.sleep(0.5)
+    start = time.monotonic()
+    client.request("POST", "/cancel")
+    client.wait_for_state("staged")
+    latency = time.monotonic() - start
+    results.append(check(f"cancelled in {latency:.3f}s", latency < MAX_CANCEL_LATENCY_S))
+    results.append(check("bundle still staged", os.path.exists(config.update_write_path)))
+
+    print("Idle check passes")
+    config.install_idle_cmds = ["true"]
+    client.request("POST", "/install")
+    client.wait_for_state("rauc_update")
+    status = client.wait_for_state("ready")
+    results.append(check(f"installed: {status['rauc_state']}", status["rauc_state"] == "success"))
+
+    sys.exit(0 if all(results) else 1)